@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ssdp import SimpleServiceDiscoveryProtocol
+from scpd import DescriptionParser
+from registry import DeviceRegistry
+
+NOTIFY = (
+    "NOTIFY * HTTP/1.1\r\n"
+    "HOST: 239.255.255.250:1900\r\n"
+    "CACHE-CONTROL: max-age=1800\r\n"
+    "LOCATION: {location}\r\n"
+    "NT: {nt}\r\n"
+    "NTS: ssdp:alive\r\n"
+    "USN: {usn}\r\n"
+    "\r\n"
+)
+
+DESCRIPTION = """<?xml version="1.0" encoding="utf-8"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <device>
+    <deviceType>urn:schemas-upnp-org:device:MediaRenderer:1</deviceType>
+    <friendlyName>Living Room {i}</friendlyName>
+    <manufacturer>Example Corp</manufacturer>
+    <manufacturerURL>http://www.example.com</manufacturerURL>
+    <modelName>Speaker {model}</modelName>
+    <modelNumber>S{model}</modelNumber>
+    <serialNumber>{i:012d}</serialNumber>
+    <UDN>uuid:{uuid}</UDN>
+    <iconList>
+      <icon><mimetype>image/png</mimetype><width>48</width><height>48</height>
+        <depth>24</depth><url>/img/icon-48.png</url></icon>
+    </iconList>
+    <serviceList>
+      <service>
+        <serviceType>urn:schemas-upnp-org:service:AVTransport:1</serviceType>
+        <serviceId>urn:upnp-org:serviceId:AVTransport</serviceId>
+        <SCPDURL>/xml/AVTransport1.xml</SCPDURL>
+        <controlURL>/MediaRenderer/AVTransport/Control</controlURL>
+        <eventSubURL>/MediaRenderer/AVTransport/Event</eventSubURL>
+      </service>
+      <service>
+        <serviceType>urn:schemas-upnp-org:service:RenderingControl:1</serviceType>
+        <serviceId>urn:upnp-org:serviceId:RenderingControl</serviceId>
+        <SCPDURL>/xml/RenderingControl1.xml</SCPDURL>
+        <controlURL>/MediaRenderer/RenderingControl/Control</controlURL>
+        <eventSubURL>/MediaRenderer/RenderingControl/Event</eventSubURL>
+      </service>
+    </serviceList>
+  </device>
+</root>
+"""
+
+TARGETS = [
+    'upnp:rootdevice',
+    'urn:schemas-upnp-org:device:MediaRenderer:1',
+    'urn:schemas-upnp-org:service:AVTransport:1',
+    'urn:schemas-upnp-org:service:RenderingControl:1',
+]
+
+
+def device_uuid(i):
+    return f'{i:08x}-0000-4000-8000-000000000000'
+
+
+def notifies(i):
+    uuid = device_uuid(i)
+    location = f'http://10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:1400/xml/device_description.xml'
+    yield NOTIFY.format(location=location, nt=f'uuid:{uuid}',
+                        usn=f'uuid:{uuid}').encode('utf-8')
+    for nt in TARGETS:
+        yield NOTIFY.format(location=location, nt=nt,
+                            usn=f'uuid:{uuid}::{nt}').encode('utf-8')
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, kept
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    addr = ('10.0.0.1', 1900)
+
+    for count in args.counts:
+        def build_registry():
+            registry = DeviceRegistry(loop)
+            protocol = SimpleServiceDiscoveryProtocol(
+                device_callback=registry.add, refresh_callback=registry.touch)
+            for i in range(count):
+                for data in notifies(i):
+                    protocol.datagram_received(data, addr)
+            return registry
+
+        def build_metadata():
+            metadata = {}
+            for i in range(count):
+                parser = DescriptionParser()
+                parser.feed(DESCRIPTION.format(
+                    i=i, model=i % 8, uuid=device_uuid(i)).encode('utf-8'))
+                metadata[i] = parser.close()
+            return metadata
+
+        start = time.perf_counter()
+        registry_bytes, registry = measure(build_registry)
+        metadata_bytes, metadata = measure(build_metadata)
+        elapsed = time.perf_counter() - start
+
+        print(f"devices: {len(registry):,} ({len(registry.usns):,} usns), "
+              f"built in {elapsed:.1f} s")
+        print(f"  registry  {registry_bytes / count:10,.0f} bytes/device")
+        print(f"  metadata  {metadata_bytes / count:10,.0f} bytes/device")
+        print(f"  total     {(registry_bytes + metadata_bytes) / count:10,.0f} bytes/device")
+        registry.close()
+        del registry, metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report the memory used per discovered device.')
+    parser.add_argument('--counts', type=int, nargs='+', default=[10000, 100000])
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import ssdp
+from ssdp import SimpleServiceDiscoveryProtocol
+from registry import DeviceRegistry
+
+NOTIFY = (
+    "NOTIFY * HTTP/1.1\r\n"
+    "HOST: 239.255.255.250:1900\r\n"
+    "CACHE-CONTROL: max-age=1800\r\n"
+    "LOCATION: http://10.0.0.{i}:1400/xml/device_description.xml\r\n"
+    "NT: upnp:rootdevice\r\n"
+    "NTS: ssdp:alive\r\n"
+    "SERVER: Linux UPnP/1.0 Sonos/57.3\r\n"
+    "USN: uuid:RINCON_{i:012d}01400::upnp:rootdevice\r\n"
+    "\r\n"
+)
+
+IMPORT = '''
+import sys, time
+sys.path.insert(0, {tree!r})
+start = time.perf_counter()
+import upnpy
+print(time.perf_counter() - start, len(sys.modules))
+'''
+
+
+def import_time(tree, runs):
+    # seconds to import upnpy in a fresh interpreter, and the modules loaded
+    times = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', IMPORT.format(tree=tree)],
+            capture_output=True, text=True, check=True, cwd=tree).stdout
+        elapsed, modules = out.split()
+        times.append(float(elapsed))
+    return statistics.median(times), int(modules)
+
+
+async def throughput(datagrams, batch):
+    # datagrams/s received through a UDP transport and handled, sent in
+    # batches that are waited for so none is dropped
+    loop = asyncio.get_running_loop()
+    registry = DeviceRegistry(loop)
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: SimpleServiceDiscoveryProtocol(
+            device_callback=registry.add, refresh_callback=registry.touch),
+        local_addr=('127.0.0.1', 0))
+    addr = transport.get_extra_info('sockname')
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    messages = [NOTIFY.format(i=i % 250).encode() for i in range(batch)]
+    received = ssdp.RECEIVED_NOTIFY
+
+    start = time.perf_counter()
+    for _ in range(datagrams // batch):
+        target = received[0] + batch
+        for data in messages:
+            sender.sendto(data, addr)
+        while received[0] < target:
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+
+    sender.close()
+    transport.close()
+    registry.close()
+    return datagrams // batch * batch / elapsed
+
+
+def loops():
+    yield 'asyncio', False, None
+    yield 'asyncio debug', True, None
+    try:
+        import uvloop
+    except ImportError:
+        return
+    yield 'uvloop', False, uvloop.EventLoopPolicy()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Import time of the upnpy library and datagram handling '
+                    'throughput with and without asyncio debug mode.')
+    parser.add_argument('--runs', type=int, default=15)
+    parser.add_argument('--compare', default=None,
+                        help='Another tree to measure the import of, e.g. an '
+                             'older checkout.')
+    parser.add_argument('--datagrams', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+
+    for name, tree in (('this tree', ROOT), ('compared', args.compare)):
+        if tree is None:
+            continue
+        elapsed, modules = import_time(os.path.abspath(tree), args.runs)
+        print(f"import upnpy, {name + ':':11}{elapsed * 1000:8.1f} ms, "
+              f"{modules} modules loaded")
+
+    default_policy = asyncio.get_event_loop_policy()
+    for name, debug, policy in loops():
+        asyncio.set_event_loop_policy(policy or default_policy)
+        rate = asyncio.run(throughput(args.datagrams, args.batch), debug=debug)
+        print(f"{name + ':':15}{rate:10,.0f} datagrams/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import urllib.parse
+import uuid
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import gena
+from upnpy import UPnPDevice
+from scpd import MetadataServer, MetadataClient, ConnectionPool, HTTP_REQUESTS
+from control import UPnPService, ControlClient
+from gena import EventSubscriber
+
+RENDERING_CONTROL = 'urn:schemas-upnp-org:service:RenderingControl:1'
+
+
+def rendering_control():
+    service = UPnPService(RENDERING_CONTROL)
+    service.add_variable('A_ARG_TYPE_InstanceID', 'ui4')
+    service.add_variable('Volume', 'ui2', 0, minimum=0, maximum=100,
+                         send_events=True)
+    service.add_action('GetVolume', lambda InstanceID: {
+        'CurrentVolume': int(service.values.get('Volume', 0))},
+        [('InstanceID', 'A_ARG_TYPE_InstanceID')],
+        [('CurrentVolume', 'Volume')])
+    return service
+
+
+async def serve(devices, port):
+    servers = []
+    targets = []
+    for i in range(devices):
+        device = UPnPDevice('127.0.0.1', port + i, uuid.uuid4(),
+                            'urn:schemas-upnp-org:device:MediaRenderer:1',
+                            f'Renderer {i}')
+        service = rendering_control()
+        device.services.append(service)
+        servers.append(await MetadataServer(device).start())
+        location = f'http://127.0.0.1:{port + i}/root_desc.xml'
+        desc = await MetadataClient(location).fetch_metadata()
+        targets.append((f'uuid:{device.uuid}', location, desc['services'][0],
+                        service))
+    return servers, targets
+
+
+def requests():
+    return sum(HTTP_REQUESTS.get((method,)) for method in
+               ('GET', 'POST', 'NOTIFY', 'SUBSCRIBE', 'UNSUBSCRIBE'))
+
+
+async def change(targets, duration, interval, changed):
+    # every device changes its volume at random, about once per interval
+    loop = asyncio.get_running_loop()
+    end = loop.time() + duration
+    while loop.time() < end:
+        await asyncio.sleep(random.expovariate(len(targets) / interval))
+        usn, _, _, service = random.choice(targets)
+        volume = (int(service.values.get('Volume', 0)) + 1) % 100
+        changed[usn, str(volume)] = loop.time()
+        service.set_values({'Volume': volume})
+
+
+async def poll(targets, duration, interval, changed):
+    loop = asyncio.get_running_loop()
+    client = ControlClient(ConnectionPool())
+    delays = []
+    seen = {}
+    end = loop.time() + duration
+    while loop.time() < end:
+        start = loop.time()
+        results = await client.batch(
+            (location, service, 'GetVolume', {'InstanceID': 0})
+            for _, location, service, _ in targets)
+        now = loop.time()
+        for (usn, _, _, _), result in zip(targets, results):
+            volume = str(result.get('CurrentVolume')) if isinstance(result, dict) else None
+            if volume is not None and seen.get(usn) != volume:
+                seen[usn] = volume
+                if (usn, volume) in changed:
+                    delays.append(now - changed[usn, volume])
+        await asyncio.sleep(max(0, interval - (loop.time() - start)))
+    client.pool.close()
+    return delays
+
+
+async def push(targets, duration, interval, changed):
+    loop = asyncio.get_running_loop()
+    delays = []
+
+    def on_event(subscription, values):
+        key = (subscription.usn, values.get('Volume'))
+        if key in changed:
+            delays.append(loop.time() - changed[key])
+
+    subscriber = EventSubscriber(on_event, ConnectionPool())
+    for usn, location, service, _ in targets:
+        await subscriber.subscribe(
+            usn, urllib.parse.urljoin(location, service['eventSubURL']),
+            service['serviceId'])
+    await asyncio.sleep(duration)
+    await subscriber.close()
+    subscriber.pool.close()
+    return delays
+
+
+async def compare(args, targets):
+    print(f"{args.devices} devices changing every {args.change:g} s on "
+          f"average, for {args.duration:g} s")
+    print(f"{'':16}{'requests':>10}{'delay ms':>10}{'changes seen':>14}")
+    for name, follow in (('poll', poll), ('events', push)):
+        changed = {}
+        before = requests()
+        changer = asyncio.get_running_loop().create_task(
+            change(targets, args.duration, args.change, changed))
+        delays = await follow(targets, args.duration, args.poll, changed)
+        await changer
+        await asyncio.sleep(0.1)
+        label = f'poll {args.poll:g} s' if follow is poll else name
+        delay = statistics.mean(delays) * 1000 if delays else float('nan')
+        print(f"{label:16}{requests() - before:10,}{delay:10.1f}"
+              f"{len(delays):>8,} / {len(changed):,}")
+
+
+async def fan_out(args, targets):
+    # one service, many subscribers of it
+    usn, location, service, served = targets[0]
+    url = urllib.parse.urljoin(location, service['eventSubURL'])
+    received = [0]
+
+    def on_event(subscription, values):
+        received[0] += 1
+
+    # each a control point with its own callback server
+    pool = ConnectionPool()
+    subscribers = [EventSubscriber(on_event, pool)
+                   for _ in range(args.subscribers)]
+    for subscriber in subscribers:
+        await subscriber.subscribe(usn, url, service['serviceId'])
+    await asyncio.sleep(0.5)
+    received[0] = 0
+
+    start = time.perf_counter()
+    for i in range(args.events):
+        served.set_values({'Volume': i % 100})
+        await asyncio.sleep(gena.MODERATION * 1.5)
+    expected = args.events * args.subscribers
+    deadline = time.perf_counter() + 30
+    while received[0] < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    print(f"fan-out: {args.events} events to {args.subscribers} subscribers, "
+          f"{received[0]:,} of {expected:,} delivered, "
+          f"{received[0] / elapsed:,.0f} notifications/s")
+    for subscriber in subscribers:
+        await subscriber.close()
+    pool.close()
+
+
+async def run(args):
+    servers, targets = await serve(args.devices, args.port)
+    try:
+        await compare(args, targets)
+        await fan_out(args, targets)
+    finally:
+        await asyncio.sleep(0.1)
+        for server in servers:
+            server.close()
+        for _, _, _, service in targets:
+            service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Following the state of local devices by polling an '
+                    'action against subscribing to their events, and the '
+                    'fan-out of events to many subscribers.')
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--change', type=float, default=5.0,
+                        help='Average seconds between changes of a device.')
+    parser.add_argument('--poll', type=float, default=1.0,
+                        help='Seconds between polls of all devices.')
+    parser.add_argument('--subscribers', type=int, default=200)
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--port', type=int, default=19200)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from scpd import MetadataServer, ROOT_DESC_PATH, ICON_PATH
+
+
+class BenchDevice():
+
+    def __init__(self, port, icon_size):
+        self.host = '127.0.0.1'
+        self.port = port
+        self.uuid = '00000000-0000-0000-0000-000000000000'
+        self.type = 'urn:schemas-upnp-org:device:Basic:1'
+        self.name = 'Bench Device'
+        self.icon = os.urandom(icon_size)
+
+
+async def read_response(reader):
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line == b'\r\n':
+            break
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':', 1)[1])
+    await reader.readexactly(length)
+
+
+async def client(port, requests, depth, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    paths = (ROOT_DESC_PATH, ICON_PATH)
+    sent = 0
+    while sent < requests:
+        batch = min(depth, requests - sent)
+        start = time.perf_counter()
+        for i in range(batch):
+            path = paths[(sent + i) % 2]
+            writer.write(
+                f'GET {path} HTTP/1.1\r\nHOST: 127.0.0.1:{port}\r\n\r\n'.encode())
+        for _ in range(batch):
+            await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+        sent += batch
+    writer.close()
+
+
+async def run(args):
+    server = await MetadataServer(BenchDevice(args.port, args.icon_size)).start()
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        client(args.port, args.requests, args.depth, latencies)
+        for _ in range(args.clients)
+    ))
+    elapsed = time.perf_counter() - start
+
+    server.close()
+    await server.wait_closed()
+
+    latencies.sort()
+    total = len(latencies)
+    print(f"clients: {args.clients}, requests/client: {args.requests}, "
+          f"pipeline depth: {args.depth}")
+    print(f"requests/s:  {total / elapsed:12,.0f}")
+    print(f"p50 latency: {latencies[total // 2] * 1000:12.3f} ms")
+    print(f"p99 latency: {latencies[int(total * 0.99)] * 1000:12.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Loopback load test of the MetadataServer.')
+    parser.add_argument('--port', type=int, default=18990)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--depth', type=int, default=1,
+                        help='Number of pipelined requests per round trip.')
+    parser.add_argument('--icon-size', type=int, default=4096)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
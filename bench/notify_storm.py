@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ssdp import SimpleServiceDiscoveryProtocol
+from registry import DeviceRegistry
+
+NOTIFY = (
+    "NOTIFY * HTTP/1.1\r\n"
+    "HOST: 239.255.255.250:1900\r\n"
+    "CACHE-CONTROL: max-age=1800\r\n"
+    "LOCATION: http://10.0.{hi}.{lo}:1400/xml/device_description.xml\r\n"
+    "NT: {nt}\r\n"
+    "NTS: ssdp:alive\r\n"
+    "SERVER: Linux UPnP/1.0 Sonos/57.3\r\n"
+    "USN: {usn}\r\n"
+    "\r\n"
+)
+
+
+def make_storm(devices, services, total):
+    datagrams = []
+    for i in range(devices):
+        uuid = f'uuid:RINCON_{i:012d}01400'
+        targets = ['upnp:rootdevice'] + [
+            f'urn:schemas-upnp-org:service:Service{j}:1' for j in range(services)]
+        for nt in targets:
+            datagrams.append(NOTIFY.format(
+                hi=i // 256, lo=i % 256, nt=nt,
+                usn=f'{uuid}::{nt}').encode('utf-8'))
+
+    storm = []
+    while len(storm) < total:
+        storm.extend(datagrams)
+    return storm[:total], len(datagrams)
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    registry = DeviceRegistry(loop)
+    protocol = SimpleServiceDiscoveryProtocol(
+        device_callback=registry.add, refresh_callback=registry.touch)
+
+    storm, unique = make_storm(args.devices, args.services, args.datagrams)
+    addr = ('10.0.0.1', 1900)
+
+    start = time.perf_counter()
+    for data in storm:
+        protocol.datagram_received(data, addr)
+    elapsed = time.perf_counter() - start
+
+    registry.close()
+    print(f"datagrams:     {len(storm)} ({unique} unique usns)")
+    print(f"root devices:  {len(registry)}")
+    print(f"elapsed:       {elapsed:.3f} s")
+    print(f"throughput:    {len(storm) / elapsed:,.0f} datagrams/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a synthetic NOTIFY storm through datagram_received.')
+    parser.add_argument('--datagrams', type=int, default=100000)
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--services', type=int, default=20)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ssdp import SimpleServiceDiscoveryProtocol, SSDPDevice
+
+SEARCH = (
+    "M-SEARCH * HTTP/1.1\r\n"
+    "HOST: 239.255.255.250:1900\r\n"
+    'MAN: "ssdp:discover"\r\n'
+    "ST: {st}\r\n"
+    "MX: 1\r\n"
+    "\r\n"
+)
+
+
+class LegacyProtocol(SimpleServiceDiscoveryProtocol):
+    # scans a list of devices and splits every usn per search, as before
+    # the target index existed
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.device_list = []
+
+    def announce_device(self, device):
+        self.device_list.append(device)
+        super().announce_device(device)
+
+    def remove_device(self, device):
+        self.device_list.remove(device)
+        super().remove_device(device)
+
+    def search_responses(self, st):
+        responses = []
+        for device in self.device_list:
+            try:
+                target = device.usn.split('::')[1]
+            except IndexError:
+                target = device.usn
+            if st == 'ssdp:all' or st == target:
+                responses.append(self.templates[device.usn].responses[st])
+        return responses
+
+
+def make_devices(n):
+    devices = []
+    for i in range(n // 3):
+        uuid = f'uuid:{i:08d}-0000-0000-0000-000000000000'
+        location = f'http://127.0.0.1:2000/{uuid[5:]}/root_desc.xml'
+        for usn in (f'{uuid}::upnp:rootdevice', uuid,
+                    f'{uuid}::urn:schemas-upnp-org:device:Device{i % 50}:1'):
+            devices.append(SSDPDevice(usn, location))
+    return devices
+
+
+async def measure(cls, devices, targets, sink):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: cls(schedule_responses=False), local_addr=('127.0.0.1', 0))
+    protocol.filter = True  # answer the search target, not everything
+    protocol.announcer.close = lambda: None
+    protocol.announcer.add = lambda templates: None
+    protocol.announcer.send_burst = lambda templates, nts: None
+
+    start = time.perf_counter()
+    for device in devices:
+        protocol.announce_device(device)
+    announce = time.perf_counter() - start
+
+    searches = [SEARCH.format(st=st).encode('utf-8') for st in targets]
+    start = time.perf_counter()
+    for data in searches:
+        protocol.datagram_received(data, sink)
+    search = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for device in reversed(devices):
+        protocol.remove_device(device)
+    remove = time.perf_counter() - start
+
+    transport.close()
+    return announce, search, remove
+
+
+async def run(args):
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    addr = sink.getsockname()
+
+    devices = make_devices(args.devices)
+    roots = len(devices) // 3
+    targets = []
+    for i in range(args.searches):
+        if i % 2:
+            targets.append(f'uuid:{i % roots:08d}-0000-0000-0000-000000000000')
+        else:
+            targets.append(f'urn:schemas-upnp-org:device:Device{i % 50}:1')
+
+    print(f"local usns: {len(devices)}, targeted searches: {args.searches}")
+    results = {}
+    for name, cls in (('legacy', LegacyProtocol),
+                      ('indexed', SimpleServiceDiscoveryProtocol)):
+        announce, search, remove = await measure(cls, devices, targets, addr)
+        results[name] = search
+        print(f"  {name:8} announce {announce * 1000:9.1f} ms  "
+              f"searches {args.searches / search:10,.0f}/s  "
+              f"remove {remove * 1000:9.1f} ms")
+    print(f"  search speedup {results['legacy'] / results['indexed']:10.1f}x")
+    sink.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure targeted M-SEARCH handling with many local usns.')
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--searches', type=int, default=2000)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ssdp import SimpleServiceDiscoveryProtocol, SSDPDevice
+
+SEARCH = (
+    "M-SEARCH * HTTP/1.1\r\n"
+    "HOST: 239.255.255.250:1900\r\n"
+    'MAN: "ssdp:discover"\r\n'
+    "ST: {st}\r\n"
+    "MX: 1\r\n"
+    "\r\n"
+)
+
+
+class LegacyProtocol(SimpleServiceDiscoveryProtocol):
+    # formats and encodes every response, as before templates existed
+
+    def handle_search(self, message, addr):
+        for device in self.local_devices.values():
+            data = (
+                "HTTP/1.1 200 OK\r\n"
+                "CACHE-CONTROL: max-age=3600\r\n"
+                "LOCATION: {loc}\r\n"
+                "SERVER: 'Linux UPnP/1.0 upnpy/0.1'\r\n"
+                "ST: {st}\r\n"
+                "USN: {usn}\r\n"
+                "\r\n"
+            ).format(loc=device.location, st='ssdp:all', usn=device.usn)
+            self.transport.sendto(data.encode('utf-8'), addr)
+
+
+def make_devices(n):
+    devices = []
+    for i in range(n // 3):
+        location = f'http://127.0.0.1:{2000 + i}/root_desc.xml'
+        for usn in (f'uuid:{i:08d}-0000-0000-0000-000000000000::upnp:rootdevice',
+                    f'uuid:{i:08d}-0000-0000-0000-000000000000',
+                    f'uuid:{i:08d}-0000-0000-0000-000000000000::urn:schemas-upnp-org:device:Basic:1'):
+            devices.append(SSDPDevice(usn, location))
+    return devices
+
+
+async def measure(cls, devices, searches, sink):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: cls(schedule_responses=False), local_addr=('127.0.0.1', 0))
+    for device in devices:
+        if cls is LegacyProtocol:
+            protocol.local_devices[device.usn] = device
+        else:
+            protocol.announce_device(device)
+
+    search = SEARCH.format(st='ssdp:all').encode('utf-8')
+    start = time.perf_counter()
+    for _ in range(searches):
+        protocol.datagram_received(search, sink)
+    elapsed = time.perf_counter() - start
+    transport.close()
+    return searches * len(devices) / elapsed
+
+
+async def run(args):
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    addr = sink.getsockname()
+
+    devices = make_devices(args.devices)
+    print(f"local usns: {len(devices)}, searches: {args.searches}")
+    results = {}
+    for name, cls in (('legacy', LegacyProtocol),
+                      ('templates', SimpleServiceDiscoveryProtocol)):
+        results[name] = await measure(cls, devices, args.searches, addr)
+        print(f"  {name:10} {results[name]:12,.0f} responses/s")
+    print(f"  speedup    {results['templates'] / results['legacy']:12.2f}x")
+    sink.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure M-SEARCH responses/s for announced devices.')
+    parser.add_argument('--devices', type=int, default=300)
+    parser.add_argument('--searches', type=int, default=200)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from upnpy import UPnPDevice
+from scpd import MetadataServer, MetadataClient, ConnectionPool
+from control import UPnPService, ControlClient
+
+RENDERING_CONTROL = 'urn:schemas-upnp-org:service:RenderingControl:1'
+
+
+def rendering_control():
+    service = UPnPService(RENDERING_CONTROL)
+    service.add_variable('A_ARG_TYPE_InstanceID', 'ui4')
+    service.add_variable('A_ARG_TYPE_Channel', 'string',
+                         allowed=['Master', 'LF', 'RF'])
+    service.add_variable('Volume', 'ui2', 0, minimum=0, maximum=100)
+    volume = {}
+
+    def get_volume(InstanceID, Channel):
+        return {'CurrentVolume': volume.get(Channel, 20)}
+
+    def set_volume(InstanceID, Channel, DesiredVolume):
+        volume[Channel] = DesiredVolume
+
+    channel = [('InstanceID', 'A_ARG_TYPE_InstanceID'),
+               ('Channel', 'A_ARG_TYPE_Channel')]
+    service.add_action('GetVolume', get_volume, channel,
+                       [('CurrentVolume', 'Volume')])
+    service.add_action('SetVolume', set_volume,
+                       channel + [('DesiredVolume', 'Volume')])
+    return service
+
+
+async def serve(devices, port):
+    # a server per device, as devices on a network each have their own host
+    servers = []
+    locations = []
+    for i in range(devices):
+        device = UPnPDevice('127.0.0.1', port + i, uuid.uuid4(),
+                            'urn:schemas-upnp-org:device:MediaRenderer:1',
+                            f'Renderer {i}')
+        device.services.append(rendering_control())
+        metadata_server = MetadataServer(device)
+        servers.append(await metadata_server.start())
+        locations.append(f'http://127.0.0.1:{port + i}/root_desc.xml')
+    return servers, locations
+
+
+async def measure(locations, calls, pooled, per_host):
+    pool = ConnectionPool(max_idle=per_host) if pooled else None
+    client = ControlClient(pool, per_host=per_host)
+    services = []
+    for location in locations:
+        desc = await MetadataClient(location).fetch_metadata()
+        services.append((location, desc['services'][0]))
+
+    batch = []
+    for i in range(calls):
+        location, service = services[i % len(services)]
+        if i % 2:
+            batch.append((location, service, 'SetVolume',
+                          {'InstanceID': 0, 'Channel': 'Master',
+                           'DesiredVolume': i % 100}))
+        else:
+            batch.append((location, service, 'GetVolume',
+                          {'InstanceID': 0, 'Channel': 'Master'}))
+
+    await client.batch(batch[:len(services)])  # SCPDs fetched and compiled
+    start = time.perf_counter()
+    results = await client.batch(batch)
+    elapsed = time.perf_counter() - start
+    if pool is not None:
+        pool.close()
+    errors = [r for r in results if isinstance(r, Exception)]
+    return calls / elapsed, errors
+
+
+async def run(args):
+    servers, locations = await serve(args.devices, args.port)
+    print(f"{args.calls:,} actions across {args.devices} devices")
+    print(f"{'connections':>12}{'per host':>10}{'actions/s':>12}{'errors':>8}")
+    try:
+        for pooled in (False, True):
+            for per_host in args.per_host:
+                rate, errors = await measure(locations, args.calls, pooled,
+                                             per_host)
+                name = 'keep-alive' if pooled else 'per action'
+                print(f"{name:>12}{per_host:>10}{rate:12,.0f}{len(errors):>8}")
+                if errors:
+                    print(f"  {errors[0]!r}")
+    finally:
+        await asyncio.sleep(0.1)  # servers see the pooled connections close
+        for server in servers:
+            server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Batched SOAP actions against local devices, with a new '
+                    'connection per action or pooled keep-alive connections.')
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--calls', type=int, default=5000)
+    parser.add_argument('--per-host', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--port', type=int, default=19100)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ssdp import SimpleServiceDiscoveryProtocol, SSDPDevice, parse_max_age
+
+NOTIFY = (
+    "NOTIFY * HTTP/1.1\r\n"
+    "HOST: 239.255.255.250:1900\r\n"
+    "CACHE-CONTROL: max-age=1800\r\n"
+    "LOCATION: http://10.0.0.{i}:1400/xml/device_description.xml\r\n"
+    "NT: {nt}\r\n"
+    "NTS: ssdp:alive\r\n"
+    "SERVER: Linux UPnP/1.0 Sonos/57.3 (ZPS1)\r\n"
+    "USN: uuid:RINCON_{i:012d}01400::{nt}\r\n"
+    "X-RINCON-HOUSEHOLD: Sonos_abcdefghijklmnopqrstuvwxyz\r\n"
+    "X-RINCON-BOOTSEQ: 123\r\n"
+    "BOOTID.UPNP.ORG: 123\r\n"
+    "CONFIGID.UPNP.ORG: 42\r\n"
+    "\r\n"
+)
+
+SEARCH = (
+    "M-SEARCH * HTTP/1.1\r\n"
+    "HOST: 239.255.255.250:1900\r\n"
+    'MAN: "ssdp:discover"\r\n'
+    "ST: urn:dial-multiscreen-org:service:dial:1\r\n"
+    "MX: 1\r\n"
+    "\r\n"
+)
+
+TARGETS = [
+    'upnp:rootdevice',
+    'urn:schemas-upnp-org:device:ZonePlayer:1',
+    'urn:schemas-upnp-org:service:AVTransport:1',
+    'urn:schemas-upnp-org:service:RenderingControl:1',
+]
+
+
+class LegacyProtocol(SimpleServiceDiscoveryProtocol):
+    # the str based parser this module used before working on bytes
+
+    def __init__(self, device_callback=None, filter=None):
+        super().__init__(device_callback=device_callback, filter=filter)
+        self.legacy_handlers = {
+            'NOTIFY * HTTP/1.1': self.legacy_notify,
+            'M-SEARCH * HTTP/1.1': lambda data, addr: None,
+            'HTTP/1.1 200 OK': self.legacy_notify,
+        }
+
+    def datagram_received(self, data, addr):
+        data = data.decode()
+        data = data.splitlines()
+
+        if len(data) < 1 or data[0] not in self.legacy_handlers.keys():
+            return
+
+        headers = {
+            p[0].strip().lower(): p[1].strip()
+            for p in (
+                line.split(':', 1) for line in data[1:]
+                if line and ':' in line
+            )
+        }
+
+        self.legacy_handlers[data[0]](headers, addr)
+
+    def legacy_notify(self, data, addr):
+        max_age = parse_max_age(data.get('cache-control'))
+        device = SSDPDevice(data.get('usn'), data.get('location'), max_age)
+        if not self.filter or device.matches_target(self.filter):
+            if data.get('nts') == 'ssdp:alive':
+                self.device_callback(device)
+
+
+def make_traffic(n):
+    traffic = []
+    for i in range(n):
+        if i % 5 == 4:
+            traffic.append(SEARCH.encode('utf-8'))
+        else:
+            nt = TARGETS[i % len(TARGETS)]
+            traffic.append(NOTIFY.format(i=i % 250, nt=nt).encode('utf-8'))
+    return traffic
+
+
+def measure(protocol, traffic, rounds):
+    addr = ('10.0.0.1', 1900)
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for data in traffic:
+            protocol.datagram_received(data, addr)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(traffic) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the bytes SSDP parser against the legacy str parser.')
+    parser.add_argument('--datagrams', type=int, default=50000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    traffic = make_traffic(args.datagrams)
+    for filter in (None, 'urn:schemas-upnp-org:service:AVTransport:1'):
+        print(f"filter: {filter or 'off'}")
+        results = {}
+        for name, cls in (('legacy', LegacyProtocol),
+                          ('bytes', SimpleServiceDiscoveryProtocol)):
+            found = []
+            protocol = cls(device_callback=found.append, filter=filter)
+            results[name] = measure(protocol, traffic, args.rounds)
+            print(f"  {name:8} {results[name]:12,.0f} datagrams/s")
+        print(f"  speedup  {results['bytes'] / results['legacy']:12.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from listener import FRAME_HEADER, DEVICE, decode_strings
+from interfaces import list_interfaces
+from ssdp import MULTICAST_ADDRESS, MULTICAST_PORT, usn_shard
+
+UPNPY = os.path.join(ROOT, 'upnpy.py')
+
+NOTIFY = (
+    "NOTIFY * HTTP/1.1\r\n"
+    "HOST: 239.255.255.250:1900\r\n"
+    "CACHE-CONTROL: max-age=1800\r\n"
+    "NT: upnp:rootdevice\r\n"
+    "NTS: ssdp:alive\r\n"
+    "SERVER: bench UPnP/1.0\r\n"
+    "USN: uuid:{}::upnp:rootdevice\r\n"
+    "\r\n"
+)
+
+
+def ssdp_drops():
+    # datagrams the kernel dropped on all port 1900 sockets
+    drops = 0
+    try:
+        with open('/proc/net/udp') as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if fields[1].endswith(':076C'):
+                    drops += int(fields[-1])
+    except OSError:
+        return None
+    return drops
+
+
+async def dispatch_drops(sock_path):
+    # datagrams the coordinator dropped because a worker fell behind
+    reader, writer = await asyncio.open_unix_connection(sock_path)
+    writer.write(b'METRICS\n')
+    metrics = await reader.read()
+    writer.close()
+    for line in metrics.decode('utf-8').splitlines():
+        if line.startswith('upnpy_worker_datagrams_dropped_total'):
+            return int(float(line.split()[-1]))
+    return 0
+
+
+class Listener():
+
+    def __init__(self):
+        self.usns = set()
+        self.changed = asyncio.Event()
+
+    async def run(self, sock):
+        reader, writer = await asyncio.open_unix_connection(sock)
+        writer.write(b'UPNPY 1\n')
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                length, type, _ = FRAME_HEADER.unpack(header)
+                payload = await reader.readexactly(length)
+                if type == DEVICE:
+                    self.usns.add(decode_strings(payload)[0])
+                    self.changed.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def wait_for(self, usns, timeout):
+        deadline = time.perf_counter() + timeout
+        while not usns <= self.usns:
+            self.changed.clear()
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+
+def sender_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                    socket.inet_aton(list_interfaces()[0].address))
+    return sock
+
+
+async def send(sock, datagrams, rate):
+    # paced in slices of a millisecond
+    addr = (MULTICAST_ADDRESS, MULTICAST_PORT)
+    per_slice = max(1, rate // 1000)
+    start = time.perf_counter()
+    for i in range(0, len(datagrams), per_slice):
+        for data in datagrams[i:i + per_slice]:
+            try:
+                sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                pass
+        delay = start + (i + per_slice) / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)
+
+
+def root_usn(device_uuid):
+    # listeners are told about a device by the usn of its root record
+    return f'uuid:{device_uuid}'
+
+
+def sentinels(count):
+    # a new device for every shard, its arrival means the shard's worker
+    # has handled everything sent before
+    found = {}
+    while len(found) < count:
+        device_uuid = str(uuid.uuid4())
+        found.setdefault(usn_shard(root_usn(device_uuid), count), device_uuid)
+    return list(found.values())
+
+
+async def measure(args, workers):
+    sock_path = os.path.join(tempfile.mkdtemp(prefix='upnpy-workers-'), 'upnpy.sock')
+    command = [sys.executable, UPNPY, 'discover', '--sock', sock_path,
+               '--rounds', '0', '--quiet', '0']
+    if workers:
+        command += ['--workers', str(workers)]
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL)
+    listener = Listener()
+    sender = sender_socket()
+    try:
+        while not os.path.exists(sock_path):
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(1.0)  # workers join the group
+        task = asyncio.get_running_loop().create_task(listener.run(sock_path))
+
+        # devices that are known, then refreshed over and over
+        known = [str(uuid.uuid4()) for _ in range(args.devices)]
+        await send(sender, [NOTIFY.format(u).encode() for u in known], 2000)
+        await listener.wait_for({root_usn(u) for u in known}, args.timeout)
+
+        storm = [NOTIFY.format(known[i % len(known)]).encode()
+                 for i in range(args.datagrams)]
+        last = sentinels(max(workers, 1))
+        expected = {root_usn(u) for u in last}
+        drops = ssdp_drops()
+        start = time.perf_counter()
+        await send(sender, storm, args.rate)
+        for _ in range(3):  # the sentinels may be dropped too
+            await send(sender, [NOTIFY.format(u).encode() for u in last],
+                       args.rate)
+            if await listener.wait_for(expected, 0.2):
+                break
+        done = await listener.wait_for(expected, args.timeout)
+        elapsed = time.perf_counter() - start
+        dropped = ssdp_drops() - drops if drops is not None else None
+        dispatched = await dispatch_drops(sock_path)
+        task.cancel()
+    finally:
+        sender.close()
+        process.send_signal(signal.SIGINT)
+        await process.wait()
+    return done, elapsed, dropped, dispatched
+
+
+async def run(args):
+    print(f"{args.datagrams:,} NOTIFY refreshes of {args.devices:,} devices "
+          f"offered at {args.rate:,}/s, {os.cpu_count()} cpus")
+    print(f"{'workers':>8}{'datagrams/s':>14}{'kernel drops':>14}"
+          f"{'worker drops':>14}")
+    for workers in args.workers:
+        done, elapsed, dropped, dispatched = await measure(args, workers)
+        rate = f'{args.datagrams / elapsed:14,.0f}' if done else f'{"timeout":>14}'
+        drops = f'{dropped:14,}' if dropped is not None else f'{"-":>14}'
+        print(f'{workers or "none":>8}{rate}{drops}{dispatched:14,}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Loopback NOTIFY storm against discover with a number of '
+                    'SSDP workers; "none" is a single process.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--datagrams', type=int, default=100000)
+    parser.add_argument('--rate', type=int, default=50000,
+                        help='Datagrams per second offered.')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from listener import FRAME_HEADER, DEVICE, META, decode_strings
+
+UPNPY = os.path.join(ROOT, 'upnpy.py')
+
+
+async def described(sock, devices, deadline):
+    # connects as a binary listener and returns when the first device and
+    # when all announced devices together with their descriptions arrived
+    start = time.perf_counter()
+    while True:
+        try:
+            reader, writer = await asyncio.open_unix_connection(sock)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.perf_counter() - start > deadline:
+                raise TimeoutError("discover did not open its socket")
+            await asyncio.sleep(0.005)
+    writer.write(b'UPNPY 1\n')
+
+    first = None
+    roots = set()
+    described = set()
+    try:
+        while len(described & roots) < devices:
+            header = await asyncio.wait_for(
+                reader.readexactly(FRAME_HEADER.size), deadline)
+            length, type, _ = FRAME_HEADER.unpack(header)
+            payload = await reader.readexactly(length)
+            if type == DEVICE:
+                roots.add(decode_strings(payload)[0])
+                if first is None:
+                    first = time.perf_counter()
+            elif type == META:
+                described.add(decode_strings(payload)[0])
+    finally:
+        writer.close()
+    return first, time.perf_counter()
+
+
+async def run_discover(args, snapshot, sock):
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, UPNPY, 'discover', '--sock', sock,
+        '--snapshot', snapshot, '--wait', str(args.wait),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        first, complete = await described(sock, args.devices, args.timeout)
+        # let the descriptions be fetched, so the snapshot holds them
+        await asyncio.sleep(args.settle)
+    finally:
+        process.send_signal(signal.SIGINT)
+        await process.wait()
+    return first - start, complete - start
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='upnpy-warm-')
+    snapshot = os.path.join(workdir, 'snapshot')
+    sock = os.path.join(workdir, 'upnpy.sock')
+
+    announcer = await asyncio.create_subprocess_exec(
+        sys.executable, UPNPY, 'announce', '--count', str(args.devices),
+        '--port', str(args.port),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    await asyncio.sleep(1.0)
+    try:
+        cold = await run_discover(args, snapshot, sock)
+        size = os.path.getsize(snapshot) if os.path.exists(snapshot) else 0
+        warm = await run_discover(args, snapshot, sock)
+    finally:
+        announcer.send_signal(signal.SIGINT)
+        await announcer.wait()
+
+    print(f"announced devices: {args.devices}, snapshot: {size:,} bytes")
+    print(f"{'':12}{'first device':>14}{'all described':>16}")
+    for name, (first, complete) in (('cold start', cold), ('warm start', warm)):
+        print(f"{name:12}{first * 1000:11.1f} ms{complete * 1000:13.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the time from starting discover until a listener '
+                    'knows the first and all announced devices with their '
+                    'descriptions, without and with a snapshot.')
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--port', type=int, default=18991)
+    parser.add_argument('--wait', type=int, default=2)
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='Seconds each run keeps going before it is stopped.')
+    parser.add_argument('--timeout', type=float, default=20.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
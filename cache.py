@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('cache')
+
+MISSING = object()
+
+
+def sizeof_metadata(value):
+    # rough byte estimate of a (desc, icon, validators) entry, dominated by
+    # the icon
+    if value is None:
+        return 64
+    desc, icon = value[:2]
+    if isinstance(icon, IconRef):
+        icon = None  # stored on disk
+    size = 256
+    if desc:
+        for k, v in desc.items():
+            size += 8
+            if isinstance(v, str):
+                size += len(v)
+            elif isinstance(v, tuple):
+                # a record, or a tuple of icon and service records
+                items = v if v and isinstance(v[0], tuple) else (v,)
+                for item in items:
+                    size += 56 + sum(len(x) for x in item if isinstance(x, str))
+    if icon:
+        size += len(icon)
+    return size
+
+
+class CacheEntry():
+
+    __slots__ = ('value', 'size', 'expires')
+
+    def __init__(self, value, size, expires):
+        self.value = value
+        self.size = size
+        self.expires = expires
+
+
+class IconRef():
+    # an icon stored in an IconStore, mapped into memory only while used
+
+    __slots__ = ('path', 'size', 'digest')
+
+    def __init__(self, path, size, digest):
+        self.path = path
+        self.size = size
+        self.digest = digest
+
+    def __len__(self):
+        return self.size
+
+    def map(self):
+        # usable as a context manager, the mapping supports the buffer
+        # protocol like bytes
+        with open(self.path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class IconStore():
+    # Keeps icons in files named by their content hash, so icons shared by
+    # many devices are stored once and none of them stay in the heap.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.refs = {}  # digest -> reference count
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, data):
+        if not data:
+            return None
+        digest = hashlib.sha1(data).hexdigest()
+        path = os.path.join(self.directory, digest)
+        if digest not in self.refs:
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self.refs[digest] = 0
+        self.refs[digest] += 1
+        return IconRef(path, len(data), digest)
+
+    def retain(self, ref):
+        self.refs[ref.digest] = self.refs.get(ref.digest, 0) + 1
+
+    def release(self, ref):
+        count = self.refs.get(ref.digest, 0) - 1
+        if count > 0:
+            self.refs[ref.digest] = count
+            return
+        self.refs.pop(ref.digest, None)
+        try:
+            os.remove(ref.path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        for digest in list(self.refs):
+            try:
+                os.remove(os.path.join(self.directory, digest))
+            except FileNotFoundError:
+                pass
+        self.refs.clear()
+
+
+class MetadataCache():
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_entries=4096,
+                 default_ttl=1800, negative_ttl=60, sizeof=sizeof_metadata,
+                 on_evict=None):
+        self.on_evict = on_evict or (lambda key, value: None)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.sizeof = sizeof
+
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.lookup(key, count=False) is not MISSING
+
+    def lookup(self, key, count=True):
+        entry = self.entries.get(key)
+        if entry is None:
+            if count:
+                self.misses += 1
+            return MISSING
+        if entry.expires <= time.monotonic():
+            if count:
+                self.misses += 1
+                self.expirations += 1
+            return MISSING
+        self.entries.move_to_end(key)
+        if count:
+            self.hits += 1
+        return entry.value
+
+    def get(self, key, default=None):
+        value = self.lookup(key)
+        return default if value is MISSING else value
+
+    def peek(self, key, default=None):
+        # returns the entry even if expired, e.g. for revalidation
+        entry = self.entries.get(key)
+        return default if entry is None else entry.value
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.default_ttl
+        size = self.sizeof(value)
+
+        self.discard(key)
+        if size > self.max_bytes:
+            logger.debug("Not caching %s, %d bytes exceed limit", key, size)
+            self.on_evict(key, value)
+            return
+
+        self.entries[key] = CacheEntry(value, size, time.monotonic() + ttl)
+        self.size += size
+        self.evict()
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+            self.on_evict(key, entry.value)
+
+    def evict(self):
+        while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+            key, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+            self.on_evict(key, entry.value)
+
+    def clear(self):
+        for key, entry in self.entries.items():
+            self.on_evict(key, entry.value)
+        self.entries.clear()
+        self.size = 0
+
+    async def get_or_fetch(self, key, fetch, ttl=None):
+        # Concurrent misses for the same key share a single fetch. It runs
+        # in its own task, so a cancelled caller stops waiting for it without
+        # cancelling it for the others.
+        value = self.lookup(key)
+        if value is not MISSING:
+            return value
+
+        task = self.inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.get_running_loop().create_task(
+                self.fetch(key, fetch, ttl))
+            # retrieved even if every caller was cancelled
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self.inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def fetch(self, key, fetch, ttl):
+        try:
+            value = await fetch()
+        finally:
+            del self.inflight[key]
+        self.put(key, value, ttl=None if value is None else ttl)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'inflight': len(self.inflight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'coalesced': self.coalesced,
+        }
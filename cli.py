@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import contextlib
+import cProfile
+import logging
+import tempfile
+import uuid
+
+from upnpy import UPnPy, UPnPDevice, DeviceHost, use_uvloop
+from ssdp import ANY_ADDRESS
+from control import UPnPError
+from gena import EventSubscriber
+from cache import IconStore
+from listener import MAX_QUEUE, DROP_OLDEST, POLICIES
+from workers import run_workers, run_worker
+
+logger = logging.getLogger('cli')
+
+
+async def discover(upnpy, args):
+    if args.filter and ':' not in args.filter:
+        if args.filter == 'root':
+            args.filter = 'upnp:rootdevice'
+        else:
+            args.filter = f"urn:schemas-upnp-org:device:{args.filter}:1"
+
+    if args.icon_store:
+        upnpy.icon_store = IconStore(args.icon_store)
+    upnpy.interface_names = args.interface
+    upnpy.filter = args.filter
+    upnpy.wait = args.wait
+    upnpy.rounds = args.rounds
+    upnpy.quiet = args.quiet
+    upnpy.listener_queue = args.listener_queue
+    upnpy.listener_policy = args.slow_listener
+    if args.events:
+        upnpy.event_services = args.events
+        upnpy.subscriber = EventSubscriber(upnpy.on_properties, upnpy.pool,
+                                           port=args.event_port)
+
+    coros = []
+    if args.snapshot:
+        upnpy.load_snapshot(args.snapshot)
+        coros.append(upnpy.run_snapshot(args.snapshot, args.checkpoint_interval))
+    if args.sock:
+        coros.append(upnpy.run_unix_socket(args.sock))
+    else:
+        coros.append(upnpy.discover())
+    if args.workers:
+        argv = ['--filter', args.filter] if args.filter else []
+        coros.append(run_workers(upnpy, args.workers, argv))
+    elif not args.no_deamon:
+        coros.append(upnpy.run_ssdp_deamon(discover=True))
+    try:
+        await asyncio.gather(*coros)
+    finally:
+        if upnpy.icon_store is not None:
+            upnpy.icon_store.close()
+
+
+async def worker(upnpy, args):
+    upnpy.filter = args.filter
+    await run_worker(upnpy, args.fd)
+
+
+async def announce(upnpy, args):
+    # on the unspecified address each interface announces its own
+    host = args.host
+    upnpy.interface_names = args.interface
+    device_host = DeviceHost(upnpy, host, args.port,
+                             metrics=upnpy.metrics if args.metrics else None)
+
+    if args.icon:
+        args.icon.close()
+
+    for i in range(args.count):
+        name = args.name if args.count == 1 else f"{args.name} {i + 1}"
+        device = UPnPDevice(
+            host, args.port,
+            uuid.uuid4(),
+            f"urn:schemas-upnp-org:device:{args.type}:1",
+            name,
+        )
+        if args.icon:
+            device.icon_path = args.icon.name
+        device_host.add_device(device)
+
+    upnpy.filter = not args.ignore_filter
+
+    await device_host.serve_forever()
+
+
+async def invoke(upnpy, args):
+    # searches for the device by its uuid, then invokes the action
+    upnpy.interface_names = args.interface
+    root = args.usn.split('::', 1)[0]
+    if not root.startswith('uuid:'):
+        root = 'uuid:' + root
+    try:
+        async with contextlib.aclosing(
+                upnpy.search(root, timeout=args.wait)) as devices:
+            async for device in devices:
+                upnpy.add_remote_device(device)
+                break
+            else:
+                logger.error("Device %s not found", root)
+                return
+
+        values = dict(arg.split('=', 1) for arg in args.args)
+        result = await upnpy.invoke(root, args.service, args.action, values)
+    except (UPnPError, ValueError, OSError, asyncio.IncompleteReadError,
+            asyncio.TimeoutError) as e:
+        logger.error("%s failed: %s", args.action, e)
+        return
+    finally:
+        await upnpy.close()
+    for name, value in result.items():
+        print(f'{name}={value}')
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='UPnPy')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--profile', default=None,
+                        help='Write cProfile statistics of the run to this file.')
+    parser.add_argument('--debug', action='store_true',
+                        help='Run the event loop in asyncio debug mode.')
+    parser.add_argument('--uvloop', action='store_true',
+                        help='Use uvloop as event loop, if it is installed.')
+    subparsers = parser.add_subparsers()
+
+    parser_discover = subparsers.add_parser(
+        'discover', help='Control point mode.')
+    parser_discover.add_argument('--filter', default=None,
+                                 help='If not specified, "ssdp:all" will be used as search target.')
+    parser_discover.add_argument('--wait', type=int, default=6,
+                                 help='Maximum seconds to wait for responses after search.')
+    parser_discover.add_argument('--rounds', type=int, default=3,
+                                 help='Number of search rounds, sent with increasing intervals.')
+    parser_discover.add_argument('--quiet', type=float, default=2.0,
+                                 help='Stop searching once no new device responded for this many seconds.')
+    parser_discover.add_argument('--sock', nargs='?', const=tempfile.gettempdir() + '/upnpy.sock',
+                                 help='If specified, creates a unix socket at the given path, to which listeners can connect.')
+    parser_discover.add_argument('--no-deamon', action='store_true',
+                                 help='Disables listening for NOTIFY messages. Thus only a foreground search will be performed.')
+    parser_discover.add_argument('--listener-queue', type=int, default=MAX_QUEUE,
+                                 help='Number of events queued for each listener.')
+    parser_discover.add_argument('--slow-listener', choices=POLICIES, default=DROP_OLDEST,
+                                 help='What to do when a listener falls behind by more than --listener-queue events.')
+    parser_discover.add_argument('--snapshot', default=None,
+                                 help='File in which known devices and descriptions are kept between runs.')
+    parser_discover.add_argument('--checkpoint-interval', type=float, default=60,
+                                 help='Seconds between writes of the snapshot.')
+    parser_discover.add_argument('--icon-store', default=None,
+                                 help='Directory in which fetched icons are kept as memory-mapped files instead of in memory.')
+    parser_discover.add_argument('--interface', action='append', default=None,
+                                 help='Network interface to use, may be repeated. All usable interfaces by default.')
+    parser_discover.add_argument('--workers', type=int, default=0,
+                                 help='Number of processes that parse the SSDP traffic received here and fetch and parse descriptions, instead of doing it in this one.')
+    parser_discover.add_argument('--events', action='append', default=None,
+                                 help='Service type, id or name to subscribe to the events of on every device, may be repeated. Changes are sent to listeners.')
+    parser_discover.add_argument('--event-port', type=int, default=0,
+                                 help='Port on which events are received, any free port by default.')
+    parser_discover.set_defaults(func=discover)
+
+    parser_worker = subparsers.add_parser(
+        'worker', help='SSDP worker process, started by discover --workers.')
+    parser_worker.add_argument('--fd', type=int, required=True,
+                               help='Descriptor of the connection to the coordinator.')
+    parser_worker.add_argument('--filter', default=None)
+    parser_worker.set_defaults(func=worker)
+
+    parser_announce = subparsers.add_parser('announce', help='Device mode.')
+    parser_announce.add_argument('--name', default='Basic Device',
+                                 help='Friendly name of the device.')
+    parser_announce.add_argument('--type', default='Basic',
+                                 help='Device type')
+    parser_announce.add_argument('--icon', type=argparse.FileType('rb'),
+                                 help='Path to a PNG image to use as icon.')
+    parser_announce.add_argument('--port', type=int, default=1999,
+                                 help='Port on which the metadata server listens.')
+    parser_announce.add_argument('--host', default=ANY_ADDRESS,
+                                 help='Address of the metadata server. On the default, devices are announced with the address of each interface.')
+    parser_announce.add_argument('--interface', action='append', default=None,
+                                 help='Network interface to announce on, may be repeated. All usable interfaces by default.')
+    parser_announce.add_argument('--count', type=int, default=1,
+                                 help='Number of virtual devices to host on the same socket and server.')
+    parser_announce.add_argument('--metrics', action='store_true',
+                                 help='Serve metrics in Prometheus text format at /metrics.')
+    parser_announce.add_argument('--ignore-filter', action='store_true',
+                                 help='Reply to all searches (ignore search target).')
+    parser_announce.set_defaults(func=announce)
+
+    parser_invoke = subparsers.add_parser(
+        'invoke', help='Invoke an action of a service of a device.')
+    parser_invoke.add_argument('usn', help='Uuid or usn of the device.')
+    parser_invoke.add_argument('service',
+                               help='Service type or id, the type may omit the version.')
+    parser_invoke.add_argument('action')
+    parser_invoke.add_argument('args', nargs='*', metavar='name=value',
+                               help='Input arguments of the action.')
+    parser_invoke.add_argument('--wait', type=int, default=6,
+                               help='Maximum seconds to search for the device.')
+    parser_invoke.add_argument('--interface', action='append', default=None,
+                               help='Network interface to search on, may be repeated.')
+    parser_invoke.set_defaults(func=invoke)
+
+    return parser
+
+
+async def main(args):
+    upnpy = UPnPy()
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        await args.func(upnpy, args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+
+def run(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if args.uvloop and not use_uvloop():
+        logger.warning("uvloop is not installed, using asyncio's event loop")
+    try:
+        asyncio.run(main(args), debug=args.debug)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    run()
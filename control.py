@@ -0,0 +1,593 @@
+import asyncio
+import base64
+import logging
+import sys
+import urllib.parse
+
+from cache import MetadataCache
+from scpd import MetadataClient, StaticResponse, ConnectionPool
+from gena import EventPublisher
+
+logger = logging.getLogger('control')
+
+MAX_SCPD_SIZE = 256 * 1024
+MAX_CONTROL_SIZE = 64 * 1024
+PER_HOST = 4  # concurrent actions per device endpoint
+
+SOAP_ENVELOPE = 'http://schemas.xmlsoap.org/soap/envelope/'
+CONTROL_NS = 'urn:schemas-upnp-org:control-1-0'
+SERVICE_NS = 'urn:schemas-upnp-org:service-1-0'
+ENVELOPE_START = (
+    '<?xml version="1.0" encoding="utf-8"?>\r\n'
+    '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+).encode('utf-8')
+ENVELOPE_END = b'</s:Body></s:Envelope>'
+CONTENT_TYPE = 'text/xml; charset="utf-8"'
+
+# UPnP error codes of the device architecture
+INVALID_ACTION = 401
+INVALID_ARGS = 402
+ACTION_FAILED = 501
+ARGUMENT_VALUE_INVALID = 600
+ARGUMENT_VALUE_OUT_OF_RANGE = 601
+
+SCPD_TEMPLATE = """
+<?xml version="1.0" encoding="utf-8"?>
+<scpd xmlns="urn:schemas-upnp-org:service-1-0">
+    <specVersion>
+        <major>1</major>
+        <minor>0</minor>
+    </specVersion>
+    <actionList>{actions}
+    </actionList>
+    <serviceStateTable>{variables}
+    </serviceStateTable>
+</scpd>
+"""
+
+
+class UPnPError(Exception):
+    # a SOAP fault, raised by action handlers and by invoke
+
+    def __init__(self, code, description=''):
+        super().__init__(code, description)
+        self.code = code
+        self.description = description
+
+    def __str__(self):
+        return f'UPnP error {self.code}: {self.description}'
+
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def parse_boolean(text):
+    return text.strip().lower() in ('1', 'true', 'yes')
+
+
+def format_boolean(value):
+    if isinstance(value, str):
+        value = parse_boolean(value)
+    return '1' if value else '0'
+
+
+def format_float(value):
+    return repr(float(value))
+
+
+def format_bytes_hex(value):
+    return bytes(value).hex()
+
+
+def format_bytes_base64(value):
+    return base64.b64encode(bytes(value)).decode('ascii')
+
+
+# data type -> (to text, from text, integer range)
+INTEGER_TYPES = {
+    'ui1': (0, 0xff), 'ui2': (0, 0xffff), 'ui4': (0, 0xffffffff),
+    'ui8': (0, 0xffffffffffffffff),
+    'i1': (-0x80, 0x7f), 'i2': (-0x8000, 0x7fff),
+    'i4': (-0x80000000, 0x7fffffff), 'int': (-0x80000000, 0x7fffffff),
+    'i8': (-0x8000000000000000, 0x7fffffffffffffff),
+}
+FLOAT_TYPES = ('r4', 'r8', 'number', 'fixed.14.4', 'float')
+DATA_TYPES = {
+    'boolean': (format_boolean, parse_boolean),
+    'bin.hex': (format_bytes_hex, bytes.fromhex),
+    'bin.base64': (format_bytes_base64, base64.b64decode),
+}
+DATA_TYPES.update((name, (lambda v: str(int(v)), int)) for name in INTEGER_TYPES)
+DATA_TYPES.update((name, (format_float, float)) for name in FLOAT_TYPES)
+TEXT = (str, str)  # string, char, uri, uuid, dates and unknown types
+
+
+class StateVariable():
+    # A state variable with converters from and to text compiled once,
+    # checking allowed values and ranges.
+
+    __slots__ = ('name', 'data_type', 'default', 'allowed', 'minimum',
+                 'maximum', 'step', 'send_events', 'to_text', 'from_text')
+
+    def __init__(self, name, data_type='string', default=None, allowed=None,
+                 minimum=None, maximum=None, step=None, send_events=False):
+        self.name = sys.intern(name)
+        self.data_type = sys.intern(data_type)
+        self.default = default
+        self.allowed = tuple(allowed) if allowed else None
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.send_events = send_events
+        self.to_text, self.from_text = self.compile()
+
+    def compile(self):
+        format, parse = DATA_TYPES.get(self.data_type, TEXT)
+        limits = INTEGER_TYPES.get(self.data_type)
+        low, high = limits if limits else (None, None)
+        if self.minimum is not None:
+            low = parse(str(self.minimum))
+        if self.maximum is not None:
+            high = parse(str(self.maximum))
+        allowed = frozenset(self.allowed) if self.allowed else None
+        name = self.name
+
+        if low is None and high is None and allowed is None:
+            return format, parse
+
+        def to_text(value):
+            text = format(value)
+            check(parse(text))
+            return text
+
+        def from_text(text):
+            return check(parse(text))
+
+        def check(value):
+            if allowed is not None and value not in allowed:
+                raise UPnPError(ARGUMENT_VALUE_INVALID,
+                                f'{value!r} is not allowed for {name}')
+            if low is not None and value < low or high is not None and value > high:
+                raise UPnPError(ARGUMENT_VALUE_OUT_OF_RANGE,
+                                f'{value!r} is out of range for {name}')
+            return value
+
+        return to_text, from_text
+
+    def to_xml(self):
+        parts = [f'\n        <stateVariable sendEvents="{"yes" if self.send_events else "no"}">',
+                 f'\n            <name>{escape(self.name)}</name>',
+                 f'\n            <dataType>{escape(self.data_type)}</dataType>']
+        if self.default is not None:
+            parts.append(f'\n            <defaultValue>{escape(self.to_text(self.default))}</defaultValue>')
+        if self.allowed:
+            parts.append('\n            <allowedValueList>')
+            parts.extend(f'\n                <allowedValue>{escape(str(v))}</allowedValue>'
+                         for v in self.allowed)
+            parts.append('\n            </allowedValueList>')
+        if self.minimum is not None or self.maximum is not None:
+            parts.append('\n            <allowedValueRange>')
+            for tag, value in (('minimum', self.minimum), ('maximum', self.maximum),
+                               ('step', self.step)):
+                if value is not None:
+                    parts.append(f'\n                <{tag}>{value}</{tag}>')
+            parts.append('\n            </allowedValueRange>')
+        parts.append('\n        </stateVariable>')
+        return ''.join(parts)
+
+
+class Action():
+    # The argument schema of an action of one service type, compiled into
+    # the fixed parts of its SOAP messages and a converter per argument.
+
+    __slots__ = ('name', 'service_type', 'inputs', 'outputs', 'soap_action',
+                 'request_start', 'request_end', 'response_start',
+                 'response_end', 'input_tags', 'output_tags', 'parsers')
+
+    def __init__(self, name, service_type, inputs=(), outputs=()):
+        # inputs and outputs are (argument name, StateVariable) in order
+        self.name = name
+        self.service_type = service_type
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.soap_action = f'"{service_type}#{name}"'
+
+        self.request_start = f'<u:{name} xmlns:u="{escape(service_type)}">'.encode('utf-8')
+        self.request_end = f'</u:{name}>'.encode('utf-8')
+        self.response_start = f'<u:{name}Response xmlns:u="{escape(service_type)}">'.encode('utf-8')
+        self.response_end = f'</u:{name}Response>'.encode('utf-8')
+        self.input_tags = tuple(
+            (arg, f'<{arg}>'.encode('utf-8'), f'</{arg}>'.encode('utf-8'),
+             var.to_text, var.default)
+            for arg, var in self.inputs)
+        self.output_tags = tuple(
+            (arg, f'<{arg}>'.encode('utf-8'), f'</{arg}>'.encode('utf-8'),
+             var.to_text, var.default)
+            for arg, var in self.outputs)
+        self.parsers = {arg: var.from_text
+                        for arg, var in self.inputs + self.outputs}
+
+    def encode(self, start, end, tags, values):
+        parts = [ENVELOPE_START, start]
+        for arg, open_tag, close_tag, to_text, default in tags:
+            value = values.get(arg, default)
+            if value is None:
+                raise UPnPError(INVALID_ARGS, f'Missing argument {arg}')
+            parts.append(open_tag)
+            parts.append(escape(to_text(value)).encode('utf-8'))
+            parts.append(close_tag)
+        parts.append(end)
+        parts.append(ENVELOPE_END)
+        return b''.join(parts)
+
+    def encode_request(self, values):
+        return self.encode(self.request_start, self.request_end,
+                           self.input_tags, values)
+
+    def encode_response(self, values):
+        return self.encode(self.response_start, self.response_end,
+                           self.output_tags, values or {})
+
+    def decode(self, body, expected):
+        # returns the converted arguments of a request or response body
+        element = soap_body_element(body)
+        if local_name(element.tag) == 'Fault':
+            raise fault_error(element)
+        if local_name(element.tag) != expected:
+            raise UPnPError(INVALID_ACTION, f'Expected {expected}')
+        values = {}
+        for child in element:
+            arg = local_name(child.tag)
+            parse = self.parsers.get(arg)
+            if parse is None:
+                continue
+            try:
+                values[arg] = parse(child.text or '')
+            except ValueError as e:
+                raise UPnPError(ARGUMENT_VALUE_INVALID, f'{arg}: {e}') from None
+        return values
+
+    def decode_request(self, body):
+        values = self.decode(body, self.name)
+        for arg, _ in self.inputs:
+            if arg not in values:
+                raise UPnPError(INVALID_ARGS, f'Missing argument {arg}')
+        return values
+
+    def decode_response(self, body):
+        return self.decode(body, self.name + 'Response')
+
+    def to_xml(self):
+        parts = ['\n        <action>',
+                 f'\n            <name>{escape(self.name)}</name>']
+        if self.inputs or self.outputs:
+            parts.append('\n            <argumentList>')
+            for direction, args in (('in', self.inputs), ('out', self.outputs)):
+                for arg, var in args:
+                    parts.append(
+                        '\n                <argument>'
+                        f'\n                    <name>{escape(arg)}</name>'
+                        f'\n                    <direction>{direction}</direction>'
+                        f'\n                    <relatedStateVariable>{escape(var.name)}</relatedStateVariable>'
+                        '\n                </argument>')
+            parts.append('\n            </argumentList>')
+        parts.append('\n        </action>')
+        return ''.join(parts)
+
+
+def soap_body_element(body):
+    from xml.etree import ElementTree
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError as e:
+        raise UPnPError(INVALID_ACTION, f'Malformed SOAP message: {e}') from None
+    soap_body = root.find(f'{{{SOAP_ENVELOPE}}}Body')
+    if soap_body is None or len(soap_body) == 0:
+        raise UPnPError(INVALID_ACTION, 'No SOAP body')
+    return soap_body[0]
+
+
+def fault_error(fault):
+    code, description = ACTION_FAILED, ''
+    for elem in fault.iter():
+        tag = local_name(elem.tag)
+        if tag == 'errorCode':
+            try:
+                code = int(elem.text)
+            except (TypeError, ValueError):
+                pass
+        elif tag == 'errorDescription':
+            description = elem.text or ''
+    return UPnPError(code, description)
+
+
+def fault_body(error):
+    return (
+        ENVELOPE_START
+        + ('<s:Fault><faultcode>s:Client</faultcode>'
+           '<faultstring>UPnPError</faultstring><detail>'
+           f'<UPnPError xmlns="{CONTROL_NS}">'
+           f'<errorCode>{error.code}</errorCode>'
+           f'<errorDescription>{escape(error.description)}</errorDescription>'
+           '</UPnPError></detail></s:Fault>').encode('utf-8')
+        + ENVELOPE_END)
+
+
+class ServiceDescription():
+    # the actions and state variables of a service, from its SCPD
+
+    __slots__ = ('service_type', 'actions', 'variables')
+
+    def __init__(self, service_type, actions, variables):
+        self.service_type = service_type
+        self.actions = actions  # name -> Action
+        self.variables = variables  # name -> StateVariable
+
+
+def parse_scpd(body, service_type):
+    # returns the ServiceDescription of an SCPD document, or None
+    from xml.etree import ElementTree
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        return None
+    ns = f'{{{SERVICE_NS}}}'
+
+    def text(elem, tag):
+        child = elem.find(ns + tag)
+        return child.text.strip() if child is not None and child.text else None
+
+    variables = {}
+    for elem in root.iterfind(f'{ns}serviceStateTable/{ns}stateVariable'):
+        name = text(elem, 'name')
+        if not name:
+            continue
+        allowed = [value.text for value in
+                   elem.iterfind(f'{ns}allowedValueList/{ns}allowedValue')]
+        value_range = elem.find(ns + 'allowedValueRange')
+        minimum = maximum = step = None
+        if value_range is not None:
+            minimum = text(value_range, 'minimum')
+            maximum = text(value_range, 'maximum')
+            step = text(value_range, 'step')
+        data_type = text(elem, 'dataType') or 'string'
+        send_events = elem.get('sendEvents', 'yes').lower() == 'yes'
+        try:
+            variable = StateVariable(
+                name, data_type, text(elem, 'defaultValue'),
+                allowed=allowed, minimum=minimum, maximum=maximum, step=step,
+                send_events=send_events)
+        except ValueError:
+            # a range that does not parse is ignored, not the service
+            variable = StateVariable(
+                name, data_type, text(elem, 'defaultValue'),
+                allowed=allowed, send_events=send_events)
+        try:
+            if variable.default is not None:
+                variable.default = variable.from_text(variable.default)
+        except (ValueError, UPnPError):
+            variable.default = None
+        variables[name] = variable
+
+    actions = {}
+    for elem in root.iterfind(f'{ns}actionList/{ns}action'):
+        name = text(elem, 'name')
+        if not name:
+            continue
+        inputs, outputs = [], []
+        for arg in elem.iterfind(f'{ns}argumentList/{ns}argument'):
+            arg_name = text(arg, 'name')
+            if not arg_name:
+                continue
+            related = text(arg, 'relatedStateVariable')
+            variable = variables.get(related) or StateVariable(related or arg_name)
+            if (text(arg, 'direction') or 'in').lower() == 'out':
+                outputs.append((arg_name, variable))
+            else:
+                inputs.append((arg_name, variable))
+        actions[name] = Action(name, service_type, inputs, outputs)
+    return ServiceDescription(service_type, actions, variables)
+
+
+def sizeof_scpd(value):
+    if value is None:
+        return 64
+    return 512 + 256 * (len(value.actions) + len(value.variables))
+
+
+def find_service(description, service):
+    # the Service record of a description by its type or id, a type without
+    # version matches any version and a bare name the id's last part
+    for record in (description.get('services') or ()) if description else ():
+        if service in (record['serviceType'], record['serviceId']):
+            return record
+        service_type = record['serviceType'] or ''
+        service_id = record['serviceId'] or ''
+        if service in (service_type.rpartition(':')[0],
+                       service_id.rpartition(':')[2]):
+            return record
+    return None
+
+
+class ControlClient():
+    # Invokes actions of remote services. Service descriptions are fetched
+    # once per SCPD url and kept with their compiled actions; requests go
+    # over the pooled keep-alive connections, at most per_host at a time to
+    # each device endpoint.
+
+    def __init__(self, pool=None, per_host=PER_HOST, scpd_cache=None):
+        self.pool = pool
+        self.per_host = per_host
+        self.scpds = scpd_cache or MetadataCache(
+            max_bytes=4 * 1024 * 1024, sizeof=sizeof_scpd)
+        self.limits = {}  # (host, port) -> [Semaphore, users]
+
+    async def service_description(self, location, service):
+        url = urllib.parse.urljoin(location, service['SCPDURL'] or '')
+
+        async def fetch():
+            client = MetadataClient(url, pool=self.pool)
+            line, body, _ = await client.request(max_size=MAX_SCPD_SIZE)
+            if line != "HTTP/1.1 200 OK":
+                logger.debug("Unexpected response for %s: %s", url, line)
+                return None
+            return parse_scpd(body, service['serviceType'])
+
+        return await self.scpds.get_or_fetch(url, fetch)
+
+    async def action(self, location, service, name):
+        description = await self.service_description(location, service)
+        if description is None:
+            raise UPnPError(ACTION_FAILED, 'No service description')
+        action = description.actions.get(name)
+        if action is None:
+            raise UPnPError(INVALID_ACTION, f'No action {name}')
+        return action
+
+    async def invoke(self, location, service, name, args=None):
+        # returns the output arguments of the action, raises UPnPError for
+        # faults and OSError for unreachable devices
+        action = await self.action(location, service, name)
+        url = urllib.parse.urljoin(location, service['controlURL'] or '')
+        body = action.encode_request(args or {})
+
+        client = MetadataClient(url, pool=self.pool)
+        key = (client.host, client.port)
+        limit = self.limits.get(key)
+        if limit is None:
+            limit = self.limits[key] = [asyncio.Semaphore(self.per_host), 0]
+        limit[1] += 1
+        try:
+            async with limit[0]:
+                line, response, _ = await client.request(
+                    method='POST', body=body, max_size=MAX_CONTROL_SIZE,
+                    headers=(('Content-Type', CONTENT_TYPE),
+                             ('SOAPACTION', action.soap_action)))
+        finally:
+            limit[1] -= 1
+            if not limit[1]:
+                del self.limits[key]
+
+        if line is None:
+            raise UPnPError(ACTION_FAILED, 'No response')
+        if line.split(' ', 2)[1:2] not in (['200'], ['500']):
+            raise UPnPError(ACTION_FAILED, line)
+        return action.decode_response(response)
+
+    def batch(self, calls):
+        # (location, service, action name, args) calls run concurrently
+        return gather_calls(self.invoke, calls)
+
+
+async def gather_calls(invoke, calls):
+    # returns the results of invoke(*call), or their exceptions, in order
+    async def call(*args):
+        try:
+            return await invoke(*args)
+        except (UPnPError, ValueError, OSError,
+                asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            return e
+
+    return await asyncio.gather(*(call(*c) for c in calls))
+
+
+class UPnPService():
+    # A service of a served device. Actions are registered with a handler
+    # that is called with the converted input arguments and returns a dict
+    # of output arguments, or an awaitable of one. Changes of variables with
+    # send_events are sent to subscribers with set_values.
+
+    def __init__(self, service_type, service_id=None):
+        self.service_type = service_type
+        name = service_type.split(':')[-2]
+        self.service_id = service_id or f'urn:upnp-org:serviceId:{name}'
+        self.name = self.service_id.rpartition(':')[2]
+        self.variables = {}  # name -> StateVariable
+        self.actions = {}  # name -> (Action, handler)
+        self.scpd = None
+        self.values = {}  # name -> text of evented variables
+        # keep-alive connections to the callbacks of the subscribers
+        self.pool = ConnectionPool(max_idle=4)
+        self.events = EventPublisher(self.evented_values, self.pool)
+
+    def add_variable(self, name, data_type='string', default=None, **kwargs):
+        variable = StateVariable(name, data_type, default, **kwargs)
+        self.variables[name] = variable
+        self.scpd = None
+        return variable
+
+    def add_action(self, name, handler, inputs=(), outputs=()):
+        # inputs and outputs are (argument name, state variable name)
+        action = Action(
+            name, self.service_type,
+            [(arg, self.variables[var]) for arg, var in inputs],
+            [(arg, self.variables[var]) for arg, var in outputs])
+        self.actions[name] = (action, handler)
+        self.scpd = None
+        return action
+
+    def set_values(self, values):
+        changes = {}
+        for name, value in values.items():
+            variable = self.variables[name]
+            if not variable.send_events:
+                continue
+            text = variable.to_text(value)
+            current = self.values.get(name)
+            if current is None and variable.default is not None:
+                current = variable.to_text(variable.default)
+            if text != current:
+                changes[name] = self.values[name] = text
+        if changes:
+            self.events.notify(changes)
+
+    def evented_values(self):
+        values = {name: variable.to_text(variable.default)
+                  for name, variable in self.variables.items()
+                  if variable.send_events and variable.default is not None}
+        values.update(self.values)
+        return values
+
+    def scpd_response(self):
+        if self.scpd is None:
+            body = SCPD_TEMPLATE.format(
+                actions=''.join(a.to_xml() for a, _ in self.actions.values()),
+                variables=''.join(v.to_xml() for v in self.variables.values()),
+            ).lstrip().encode('utf-8')
+            self.scpd = StaticResponse(body, 'text/xml; charset="utf-8"')
+        return self.scpd
+
+    def send_scpd(self, writer, request):
+        return self.scpd_response().write(writer, request)
+
+    async def control(self, writer, request):
+        # answers a SOAP request, faults are sent with status 500
+        soap_action = request.headers.get('soapaction', '').strip('"')
+        name = soap_action.rpartition('#')[2]
+        try:
+            entry = self.actions.get(name)
+            if entry is None:
+                raise UPnPError(INVALID_ACTION, f'No action {name}')
+            action, handler = entry
+            result = handler(**action.decode_request(request.body))
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                result = await result
+            body, status = action.encode_response(result), '200 OK'
+        except UPnPError as e:
+            body, status = fault_body(e), '500 Internal Server Error'
+        except (TypeError, ValueError) as e:
+            logger.info("Action %s failed: %s", name, e)
+            body = fault_body(UPnPError(ACTION_FAILED, str(e)))
+            status = '500 Internal Server Error'
+        StaticResponse(body, CONTENT_TYPE, status,
+                       validators=False).write(writer, request)
+
+    def close(self):
+        self.events.close()
+        self.pool.close()
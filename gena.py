@@ -0,0 +1,454 @@
+import asyncio
+import collections
+import itertools
+import logging
+import urllib.parse
+import uuid
+
+from scpd import MetadataServer, MetadataClient, StaticResponse
+from interfaces import default_address
+from ssdp import ANY_ADDRESS
+from metrics import METRICS
+
+logger = logging.getLogger('gena')
+
+EVENTS_RECEIVED = METRICS.counter(
+    'upnpy_gena_events_total',
+    'Events received from subscribed services, by result.', ('result',))
+EVENTS_SENT = METRICS.counter(
+    'upnpy_gena_notifications_total',
+    'Events sent to subscribers of served services, by result.', ('result',))
+
+EVENT_NS = 'urn:schemas-upnp-org:event-1-0'
+CONTENT_TYPE = 'text/xml; charset="utf-8"'
+CALLBACK_PATH = '/gena/'
+
+DEFAULT_TIMEOUT = 1800
+MIN_TIMEOUT = 60
+MAX_TIMEOUT = 1800  # also granted for infinite
+RENEW_FRACTION = 0.5  # of the granted timeout, renewals are sent after
+RETRY_DELAY = 30.0  # between failed renewals
+REQUEST_TIMEOUT = 10.0
+MODERATION = 0.02  # changes within this many seconds are sent as one event
+MAX_QUEUED = 8  # events per subscriber, then replaced by the full state
+MAX_SEQ = 0xffffffff
+
+
+def next_seq(seq):
+    # SEQ wraps to 1, 0 is only used for the initial event
+    return seq + 1 if seq < MAX_SEQ else 1
+
+
+def parse_timeout(value, default=DEFAULT_TIMEOUT):
+    value = (value or '').strip().lower()
+    if value.startswith('second-'):
+        try:
+            return max(MIN_TIMEOUT, min(int(value[7:]), MAX_TIMEOUT))
+        except ValueError:
+            return default
+    if value == 'infinite':
+        return MAX_TIMEOUT
+    return default
+
+
+def parse_callbacks(value):
+    # the http urls of a CALLBACK header: <url1><url2>...
+    urls = []
+    for part in (value or '').split('<')[1:]:
+        url = part.partition('>')[0].strip()
+        split = urllib.parse.urlsplit(url)
+        if split.scheme == 'http' and split.hostname:
+            urls.append(f'http://{split.hostname}:{split.port or 80}'
+                        f'{split.path or "/"}')
+    return urls
+
+
+def encode_propertyset(values):
+    # values are text already converted by their state variables
+    parts = [f'<?xml version="1.0" encoding="utf-8"?>\r\n'
+             f'<e:propertyset xmlns:e="{EVENT_NS}">']
+    for name, text in values.items():
+        text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        parts.append(f'<e:property><{name}>{text}</{name}></e:property>')
+    parts.append('</e:propertyset>')
+    return ''.join(parts).encode('utf-8')
+
+
+def decode_propertyset(body):
+    # returns {variable name: text}, None for malformed bodies
+    from xml.etree import ElementTree
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        return None
+    values = {}
+    for prop in root.iterfind(f'{{{EVENT_NS}}}property'):
+        for child in prop:
+            values[child.tag.rpartition('}')[2]] = child.text or ''
+    return values
+
+
+def empty_response(status='200 OK', headers=()):
+    return StaticResponse(b'', None, status, validators=False, headers=headers)
+
+
+BAD_REQUEST = empty_response('400 Bad Request')
+PRECONDITION_FAILED = empty_response('412 Precondition Failed')
+OK = empty_response()
+
+class Subscriber():
+
+    __slots__ = ('sid', 'callbacks', 'expires', 'seq', 'queue', 'task')
+
+    def __init__(self, sid, callbacks, expires):
+        self.sid = sid
+        self.callbacks = callbacks
+        self.expires = expires
+        self.seq = 0
+        self.queue = collections.deque()
+        self.task = None
+
+
+class EventPublisher():
+    # Device side of the eventing of one service. Handles SUBSCRIBE and
+    # UNSUBSCRIBE requests, and sends changes of evented variables to all
+    # subscribers. Changes made within MODERATION are merged into one event,
+    # whose body is encoded once for every subscriber. Events are sent to a
+    # subscriber in order over a pooled connection; a slow one has its
+    # queued events replaced by one with the full state.
+
+    def __init__(self, values, pool):
+        self.values = values  # returns the text of every evented variable
+        self.pool = pool  # keep-alive connections to the callbacks
+        self.subscribers = {}  # sid -> Subscriber
+        self.changes = {}
+        self.flush_handle = None
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def subscribe(self, writer, request):
+        headers = request.headers
+        loop = asyncio.get_running_loop()
+        sid = headers.get('sid')
+        if sid is not None:
+            # renewal, which must not carry a callback
+            subscriber = self.subscribers.get(sid)
+            if 'callback' in headers or 'nt' in headers:
+                return BAD_REQUEST.write(writer, request)
+            if subscriber is None or subscriber.expires < loop.time():
+                return PRECONDITION_FAILED.write(writer, request)
+        else:
+            callbacks = parse_callbacks(headers.get('callback'))
+            if headers.get('nt') != 'upnp:event' or not callbacks:
+                return PRECONDITION_FAILED.write(writer, request)
+            self.expire(loop.time())
+            subscriber = Subscriber(f'uuid:{uuid.uuid4()}', callbacks, 0)
+            self.subscribers[subscriber.sid] = subscriber
+
+        timeout = parse_timeout(headers.get('timeout'))
+        subscriber.expires = loop.time() + timeout
+        empty_response(headers=(('SID', subscriber.sid),
+                                ('TIMEOUT', f'Second-{timeout}'))
+                       ).write(writer, request)
+        if sid is None:
+            # after the response, with every evented variable
+            logger.info("New subscriber %s at %s", subscriber.sid,
+                        subscriber.callbacks[0])
+            self.send(subscriber, encode_propertyset(self.values()))
+        return None
+
+    def unsubscribe(self, writer, request):
+        headers = request.headers
+        if 'callback' in headers or 'nt' in headers:
+            return BAD_REQUEST.write(writer, request)
+        subscriber = self.subscribers.pop(headers.get('sid'), None)
+        if subscriber is None:
+            return PRECONDITION_FAILED.write(writer, request)
+        subscriber.queue.clear()
+        return OK.write(writer, request)
+
+    def notify(self, changes):
+        # changes are {name: text} of evented variables
+        if not self.subscribers:
+            return
+        self.changes.update(changes)
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                MODERATION, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        changes, self.changes = self.changes, {}
+        self.expire(asyncio.get_running_loop().time())
+        if not changes or not self.subscribers:
+            return
+        body = encode_propertyset(changes)
+        for subscriber in list(self.subscribers.values()):
+            self.send(subscriber, body)
+
+    def expire(self, now):
+        for sid, subscriber in list(self.subscribers.items()):
+            if subscriber.expires < now:
+                logger.info("Subscription %s expired", sid)
+                del self.subscribers[sid]
+                subscriber.queue.clear()
+
+    def send(self, subscriber, body):
+        if len(subscriber.queue) >= MAX_QUEUED:
+            subscriber.queue.clear()
+            body = encode_propertyset(self.values())
+        subscriber.queue.append(body)
+        if subscriber.task is None:
+            subscriber.task = asyncio.get_running_loop().create_task(
+                self.send_events(subscriber))
+
+    async def send_events(self, subscriber):
+        # A failed event is skipped, its SEQ is not reused, so the
+        # subscriber sees the gap and subscribes again.
+        try:
+            while subscriber.queue and subscriber.sid in self.subscribers:
+                body = subscriber.queue.popleft()
+                seq = subscriber.seq
+                subscriber.seq = next_seq(seq)
+                status = await self.send_event(subscriber, body, seq)
+                EVENTS_SENT.inc(('ok',) if status == '200' else ('failed',))
+                if status == '412':
+                    self.subscribers.pop(subscriber.sid, None)
+        finally:
+            subscriber.task = None
+
+    async def send_event(self, subscriber, body, seq):
+        # returns the status code of the first callback that answered
+        for url in subscriber.callbacks:
+            client = MetadataClient(url, pool=self.pool)
+            try:
+                line, _, _ = await asyncio.wait_for(client.request(
+                    method='NOTIFY', body=body, max_size=64 * 1024,
+                    headers=(('Content-Type', CONTENT_TYPE),
+                             ('NT', 'upnp:event'), ('NTS', 'upnp:propchange'),
+                             ('SID', subscriber.sid), ('SEQ', seq))),
+                    REQUEST_TIMEOUT)
+            except (ValueError, OSError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError) as e:
+                logger.debug("Event to %s failed: %s", url, e)
+                continue
+            if line is not None:
+                return line.split(' ', 2)[1]
+        return None
+
+    def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        for subscriber in self.subscribers.values():
+            subscriber.queue.clear()
+            if subscriber.task is not None:
+                subscriber.task.cancel()
+        self.subscribers.clear()
+
+
+class Subscription():
+
+    __slots__ = ('usn', 'service_id', 'url', 'path', 'callback', 'sid',
+                 'timeout', 'seq', 'renewal', 'closed')
+
+    def __init__(self, usn, service_id, url, path, callback=None):
+        self.usn = usn  # of the root device
+        self.service_id = service_id
+        self.url = url  # eventSubURL
+        self.path = path  # of the callback, unique to the subscription
+        self.callback = callback
+        self.sid = None
+        self.timeout = None
+        self.seq = None  # of the last event, None until the initial one
+        self.renewal = None
+        self.closed = False
+
+    def __repr__(self):
+        return f'Subscription({self.usn}, {self.service_id}, {self.sid})'
+
+
+class EventSubscriber():
+    # Control point side of eventing: a callback server for NOTIFY requests
+    # and the subscriptions it receives events for. Subscriptions renew
+    # themselves halfway through their timeout. A missed SEQ means lost
+    # changes, so the service is subscribed to again for its full state.
+
+    def __init__(self, on_event, pool=None, host=ANY_ADDRESS, port=0):
+        self.on_event = on_event  # called with the Subscription and values
+        self.pool = pool
+        self.server = MetadataServer(host=host, port=port)
+        self.subscriptions = {}  # callback path -> Subscription
+        self.services = {}  # (usn, eventSubURL) -> Subscription
+        self.ids = itertools.count(1)
+        self.starting = None
+        self.port = None
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    async def start(self):
+        if self.starting is None:
+            self.starting = asyncio.get_running_loop().create_task(
+                self.server.start())
+        server = await self.starting
+        self.port = server.sockets[0].getsockname()[1]
+        return server
+
+    async def subscribe(self, usn, url, service_id, callback=None,
+                        timeout=DEFAULT_TIMEOUT):
+        # returns the subscription to the service at eventSubURL url, an
+        # existing one if there is
+        subscription = self.services.get((usn, url))
+        if subscription is not None:
+            return subscription
+        path = f'{CALLBACK_PATH}{next(self.ids)}'
+        subscription = Subscription(usn, service_id, url, path, callback)
+        subscription.timeout = timeout
+        self.subscriptions[path] = subscription
+        self.services[usn, url] = subscription
+        self.server.add_handler('NOTIFY', path, self.on_notify)
+        try:
+            await self.start()
+            await self.send_subscribe(subscription)
+        except BaseException:
+            self.remove(subscription)
+            raise
+        return subscription
+
+    async def send_subscribe(self, subscription, renew=False):
+        # raises OSError if the service refused or cannot be reached
+        client = MetadataClient(subscription.url, pool=self.pool)
+        headers = [('TIMEOUT', f'Second-{subscription.timeout}')]
+        if renew:
+            headers.append(('SID', subscription.sid))
+        else:
+            address = default_address(client.host)
+            headers.append(('CALLBACK',
+                            f'<http://{address}:{self.port}{subscription.path}>'))
+            headers.append(('NT', 'upnp:event'))
+        line, _, _ = await asyncio.wait_for(client.request(
+            method='SUBSCRIBE', headers=headers, max_size=64 * 1024),
+            REQUEST_TIMEOUT)
+        if line is None or line.split(' ', 2)[1:2] != ['200']:
+            raise ConnectionRefusedError(f'SUBSCRIBE {subscription.url}: {line}')
+
+        response = client.response_headers
+        sid = response.get('sid')
+        if renew and sid != subscription.sid or not sid:
+            raise ConnectionRefusedError(f'SUBSCRIBE {subscription.url}: no SID')
+        if not renew:
+            subscription.sid = sid
+        timeout = parse_timeout(response.get('timeout'), subscription.timeout)
+        self.schedule_renewal(subscription, timeout * RENEW_FRACTION)
+        logger.info("%s %s for %d s",
+                    'Renewed' if renew else 'Subscribed to', subscription, timeout)
+
+    def schedule_renewal(self, subscription, delay):
+        if subscription.renewal is not None:
+            subscription.renewal.cancel()
+        if not subscription.closed:
+            subscription.renewal = asyncio.get_running_loop().call_later(
+                delay, lambda: self.loop_task(self.renew(subscription)))
+
+    async def renew(self, subscription, resubscribe=False):
+        if subscription.closed:
+            return
+        try:
+            if not resubscribe:
+                try:
+                    await self.send_subscribe(subscription, renew=True)
+                    return
+                except ConnectionRefusedError as e:
+                    # the device forgot us, e.g. after a restart
+                    logger.info("Renewal refused, subscribing again: %s", e)
+            old = subscription.sid
+            subscription.sid = None
+            subscription.seq = None
+            if old is not None:
+                self.loop_task(self.send_unsubscribe(subscription.url, old))
+            await self.send_subscribe(subscription)
+        except (ValueError, OSError, asyncio.TimeoutError,
+                asyncio.IncompleteReadError) as e:
+            logger.info("Renewing %s failed: %s", subscription, e)
+            self.schedule_renewal(subscription, RETRY_DELAY)
+
+    def loop_task(self, coro):
+        return asyncio.get_running_loop().create_task(coro)
+
+    async def send_unsubscribe(self, url, sid):
+        try:
+            client = MetadataClient(url, pool=self.pool)
+            await asyncio.wait_for(client.request(
+                method='UNSUBSCRIBE', headers=(('SID', sid),),
+                max_size=64 * 1024), REQUEST_TIMEOUT)
+        except (ValueError, OSError, asyncio.TimeoutError,
+                asyncio.IncompleteReadError) as e:
+            logger.debug("Unsubscribing %s failed: %s", sid, e)
+
+    async def unsubscribe(self, subscription):
+        self.remove(subscription)
+        if subscription.sid is not None:
+            await self.send_unsubscribe(subscription.url, subscription.sid)
+
+    def remove(self, subscription):
+        # forgets a subscription without telling the device
+        subscription.closed = True
+        if subscription.renewal is not None:
+            subscription.renewal.cancel()
+            subscription.renewal = None
+        if self.subscriptions.get(subscription.path) is subscription:
+            del self.subscriptions[subscription.path]
+            del self.services[subscription.usn, subscription.url]
+            self.server.remove_handler('NOTIFY', subscription.path)
+
+    def drop(self, usn):
+        # forgets the subscriptions of a device that is gone
+        for subscription in list(self.subscriptions.values()):
+            if subscription.usn == usn:
+                self.remove(subscription)
+
+    def on_notify(self, writer, request):
+        subscription = self.subscriptions.get(request.path)
+        headers = request.headers
+        sid = headers.get('sid')
+        # the initial event may arrive before the SUBSCRIBE response
+        if (subscription is None or headers.get('nt') != 'upnp:event'
+                or sid is None or subscription.sid not in (None, sid)):
+            EVENTS_RECEIVED.inc(('unknown',))
+            return PRECONDITION_FAILED.write(writer, request)
+        try:
+            seq = int(headers.get('seq', ''))
+        except ValueError:
+            return BAD_REQUEST.write(writer, request)
+        values = decode_propertyset(request.body)
+        if values is None:
+            return BAD_REQUEST.write(writer, request)
+        OK.write(writer, request)
+        if subscription.sid is None and seq != 0:
+            return None  # late event of the subscription being replaced
+
+        expected = 0 if subscription.seq is None else next_seq(subscription.seq)
+        subscription.seq = seq
+        if seq != expected:
+            EVENTS_RECEIVED.inc(('gap',))
+            logger.info("%s missed events %d to %d, subscribing again",
+                        subscription, expected, seq - 1)
+            self.loop_task(self.renew(subscription, resubscribe=True))
+        else:
+            EVENTS_RECEIVED.inc(('ok',))
+        if subscription.callback is not None:
+            subscription.callback(subscription, values)
+        self.on_event(subscription, values)
+        return None
+
+    async def close(self):
+        subscriptions = list(self.subscriptions.values())
+        await asyncio.gather(*(self.unsubscribe(s) for s in subscriptions))
+        if self.starting is not None:
+            if self.starting.done() and not self.starting.cancelled():
+                self.starting.result().close()
+            else:
+                self.starting.cancel()
+        self.server.close()
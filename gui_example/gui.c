@@ -57,6 +57,33 @@ GdkPixbuf *read_image(gchar *base64_data) {
     return pixbuf;
 }
 
+struct find_device {
+    const gchar *usn;
+    GtkTreeIter iter;
+    gboolean found;
+};
+
+static gboolean find_device_func(GtkTreeModel *model, GtkTreePath *path, GtkTreeIter *iter, gpointer data) {
+    struct find_device *find = data;
+    gchar *usn;
+
+    gtk_tree_model_get(model, iter, 0, &usn, -1);
+    if (g_strcmp0(usn, find->usn) == 0) {
+        find->iter = *iter;
+        find->found = TRUE;
+    }
+    g_free(usn);
+    return find->found;
+}
+
+void remove_device(const gchar *usn) {
+    struct find_device find = { usn, { 0 }, FALSE };
+
+    gtk_tree_model_foreach(GTK_TREE_MODEL(device_store), find_device_func, &find);
+    if (find.found)
+        gtk_tree_store_remove(device_store, &find.iter);
+}
+
 gboolean network_read(GIOChannel *source, GIOCondition cond, gpointer data) {
     GString *line = g_string_new(NULL);
     GError *error = NULL;
@@ -88,6 +115,9 @@ gboolean network_read(GIOChannel *source, GIOCondition cond, gpointer data) {
         details_store = gtk_list_store_new(2, G_TYPE_STRING, G_TYPE_STRING);
         gtk_tree_store_append(device_store, &device_iter, &parent_iter);
         gtk_tree_store_set(device_store, &device_iter, 0, line->str + 10, 1, details_store, 2, NULL, -1);
+    } else if (strncmp(line->str, "GONE ", 5) == 0) {
+        remove_device(line->str + 5);
+        state = READ_DEVICE;
     } else if (strncmp(line->str, "META ", 5) == 0) {
         state = READ_META;
     } else if (strncmp(line->str, "ICON ", 5) == 0) {
@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import socket
+import struct
+import sys
+
+from ssdp import MULTICAST_ADDRESS, MULTICAST_PORT
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, a single default interface is used
+    fcntl = None
+
+logger = logging.getLogger('interfaces')
+
+# Linux ioctls and flags for reading interface addresses
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_MULTICAST = 0x1000
+IFREQ = struct.Struct('16sH2s4s8s')  # name, family, port, address, padding
+IFREQ_FLAGS = struct.Struct('16sH')
+
+# Without it Linux delivers a group's datagrams to every socket bound to
+# the port, whichever interface joined the group. Missing from socket
+# before Python 3.12.
+IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49)
+
+# netlink groups of link and IPv4 address changes
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+
+MULTICAST_TTL = 2
+REFRESH_DELAY = 0.5  # netlink sends several messages per change
+
+
+class Interface():
+
+    __slots__ = ('name', 'index', 'address', 'netmask', 'loopback')
+
+    def __init__(self, name, index, address, netmask=None, loopback=False):
+        self.name = name
+        self.index = index
+        self.address = address
+        self.netmask = netmask
+        self.loopback = loopback
+
+    def __eq__(self, other):
+        return (isinstance(other, Interface)
+                and (self.name, self.index, self.address)
+                == (other.name, other.index, other.address))
+
+    def __hash__(self):
+        return hash((self.name, self.index, self.address))
+
+    def __repr__(self):
+        return f'Interface({self.name}, {self.address})'
+
+
+def ioctl_address(sock, request, name):
+    data = fcntl.ioctl(sock.fileno(), request, IFREQ.pack(name, 0, b'', b'', b''))
+    return socket.inet_ntoa(IFREQ.unpack(data)[3])
+
+
+def default_address(host=MULTICAST_ADDRESS):
+    # the address the route to host, by default the multicast group, leaves
+    # from; nothing is sent by connecting a udp socket
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.connect((host, MULTICAST_PORT))
+            return sock.getsockname()[0]
+        except OSError:
+            return '127.0.0.1'
+
+
+def list_interfaces(names=None):
+    # IPv4 interfaces that are up and can multicast, optionally only those
+    # named. Loopback interfaces are only used when there is nothing else.
+    if fcntl is None or not hasattr(socket, 'if_nameindex'):
+        address = default_address()
+        return [Interface('default', 0, address,
+                          loopback=address.startswith('127.'))]
+
+    interfaces = []
+    loopbacks = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for index, name in socket.if_nameindex():
+            if names and name not in names:
+                continue
+            raw = name.encode('utf-8')
+            try:
+                data = fcntl.ioctl(sock.fileno(), SIOCGIFFLAGS,
+                                   IFREQ_FLAGS.pack(raw, 0) + bytes(22))
+                flags = IFREQ_FLAGS.unpack_from(data)[1]
+                if not flags & IFF_UP:
+                    continue
+                address = ioctl_address(sock, SIOCGIFADDR, raw)
+                netmask = ioctl_address(sock, SIOCGIFNETMASK, raw)
+            except OSError:
+                continue  # no IPv4 address
+            interface = Interface(name, index, address, netmask,
+                                  bool(flags & IFF_LOOPBACK))
+            if interface.loopback:
+                loopbacks.append(interface)
+            elif flags & IFF_MULTICAST:
+                interfaces.append(interface)
+    return interfaces or loopbacks
+
+
+def multicast_socket(interface):
+    # receives the SSDP multicast arriving on one interface, and sends from it
+    address = socket.inet_aton(interface.address)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, address)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        mreq = struct.pack('4s4s', socket.inet_aton(MULTICAST_ADDRESS), address)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        if sys.platform.startswith('linux'):
+            sock.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+            # only the group's datagrams, several interfaces share the port
+            sock.bind((MULTICAST_ADDRESS, MULTICAST_PORT))
+        else:
+            sock.bind(('', MULTICAST_PORT))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def search_socket(interface=None):
+    # sends searches from an ephemeral port, responses arrive unicast
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interface is not None:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                            socket.inet_aton(interface.address))
+            sock.bind((interface.address, 0))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def netlink_socket():
+    # a socket that becomes readable whenever links or addresses change,
+    # None where there is no netlink
+    if not hasattr(socket, 'AF_NETLINK'):
+        return None
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                             socket.NETLINK_ROUTE)
+    except OSError:
+        return None
+    try:
+        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+class InterfaceManager():
+    # Keeps a multicast socket and protocol for every usable interface and
+    # opens and closes them as interfaces come and go. Devices announced
+    # through the manager are announced on every interface, each with its
+    # own address in LOCATION.
+
+    def __init__(self, loop, protocol_factory, names=None, interval=30.0):
+        self.loop = loop
+        self.protocol_factory = protocol_factory  # called with the Interface
+        self.names = names
+        self.interval = interval  # polled even with netlink, in case it drops
+
+        self.endpoints = {}  # name -> (Interface, transport, protocol)
+        self.devices = {}  # usn -> SSDPDevice announced on all interfaces
+        self.netlink = None
+        self.refresh_handle = None
+        self.refreshing = None
+        self.closed = False
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def interfaces(self):
+        return [interface for interface, _, _ in self.endpoints.values()]
+
+    def protocols(self):
+        return [protocol for _, _, protocol in self.endpoints.values()]
+
+    async def start(self):
+        await self.refresh()
+        if not self.endpoints:
+            logger.warning("No usable network interface found")
+        self.netlink = netlink_socket()
+        if self.netlink is not None:
+            self.loop.add_reader(self.netlink.fileno(), self.on_netlink)
+        return self
+
+    async def run(self):
+        # polls for changes until closed, netlink changes are handled as
+        # they come
+        if not self.endpoints and self.netlink is None:
+            await self.start()
+        while not self.closed:
+            await asyncio.sleep(self.interval)
+            await self.refresh()
+
+    def on_netlink(self):
+        try:
+            while self.netlink.recv(65536):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            logger.warning("Netlink failed, polling interfaces: %s", e)
+            self.loop.remove_reader(self.netlink.fileno())
+            self.netlink.close()
+            self.netlink = None
+        if self.refresh_handle is None:
+            self.refresh_handle = self.loop.call_later(
+                REFRESH_DELAY, self.schedule_refresh)
+
+    def schedule_refresh(self):
+        self.refresh_handle = None
+        if self.refreshing is None or self.refreshing.done():
+            self.refreshing = self.loop.create_task(self.refresh())
+
+    async def refresh(self):
+        if self.closed:
+            return
+        current = {interface.name: interface
+                   for interface in list_interfaces(self.names)}
+
+        for name, (interface, _, protocol) in list(self.endpoints.items()):
+            if current.get(name) != interface:
+                logger.info("Interface %s (%s) gone", name, interface.address)
+                del self.endpoints[name]
+                protocol.close()
+
+        for name, interface in current.items():
+            if name in self.endpoints:
+                continue
+            try:
+                transport, protocol = await self.loop.create_datagram_endpoint(
+                    lambda: self.protocol_factory(interface),
+                    sock=multicast_socket(interface))
+            except OSError as e:
+                # retried with the next refresh
+                logger.warning("Cannot use interface %s (%s): %s",
+                               name, interface.address, e)
+                continue
+            logger.info("Using interface %s (%s)", name, interface.address)
+            self.endpoints[name] = (interface, transport, protocol)
+            for device in self.devices.values():
+                protocol.announce_device(device)
+
+    def announce_device(self, device):
+        self.devices[device.usn] = device
+        for protocol in self.protocols():
+            protocol.announce_device(device)
+
+    def remove_device(self, device):
+        if self.devices.get(device.usn) is not device:
+            return
+        del self.devices[device.usn]
+        for protocol in self.protocols():
+            protocol.remove_device(device)
+
+    def search_devices(self):
+        for protocol in self.protocols():
+            protocol.search_devices()
+
+    def close(self):
+        self.closed = True
+        if self.refresh_handle is not None:
+            self.refresh_handle.cancel()
+            self.refresh_handle = None
+        if self.netlink is not None:
+            self.loop.remove_reader(self.netlink.fileno())
+            self.netlink.close()
+            self.netlink = None
+        for _, _, protocol in self.endpoints.values():
+            protocol.close()
+        self.endpoints.clear()
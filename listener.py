@@ -0,0 +1,399 @@
+import asyncio
+import base64
+import collections
+import logging
+import struct
+
+from cache import IconRef
+
+logger = logging.getLogger('listener')
+
+PROTOCOL_VERSION = 1
+HELLO_TIMEOUT = 0.5
+MAX_REQUEST_SIZE = 4096
+MAX_QUEUE = 256
+
+# what happens to a new event when a listener's queue is full
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'  # replace a queued event of the same device if any
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+# A listener selects the binary protocol by sending a hello line right after
+# connecting:
+#
+#   UPNPY <version> [since=<cursor>] [filter=<target>] [icons=raw|ref]
+#
+# Listeners that send nothing get the line based text protocol. Binary
+# frames are a header of payload length, frame type and the sequence number
+# of the event, followed by the payload. Strings in payloads are prefixed
+# with their length.
+FRAME_HEADER = struct.Struct('!IBQ')
+STRING_LENGTH = struct.Struct('!H')
+ICON_SIZE = struct.Struct('!I')
+
+HELLO = 0  # version, epoch
+DEVICE = 1  # usn
+SUBDEVICE = 2  # usn
+META = 3  # usn, then key and value pairs
+ICON = 4  # usn, then the raw icon
+ICON_REF = 5  # usn, then the icon size
+GONE = 6  # usn
+SYNC = 7  # cursor to resume from
+PROPERTIES = 8  # usn, service id, then variable name and value pairs
+GET_ICON = 16  # sent by listeners: usn
+
+
+def encode_strings(*strings):
+    parts = []
+    for string in strings:
+        data = string.encode('utf-8')
+        if len(data) > 0xffff:
+            data = data[:0xffff].decode('utf-8', 'ignore').encode()
+        parts.append(STRING_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def decode_strings(payload):
+    strings = []
+    offset = 0
+    while offset + STRING_LENGTH.size <= len(payload):
+        length, = STRING_LENGTH.unpack_from(payload, offset)
+        offset += STRING_LENGTH.size
+        strings.append(payload[offset:offset + length].decode('utf-8', 'replace'))
+        offset += length
+    return strings
+
+
+def encode_frame(type, seq, payload=b''):
+    return FRAME_HEADER.pack(len(payload), type, seq) + payload
+
+
+def parse_hello(line):
+    parts = line.decode('utf-8', 'replace').split()
+    if len(parts) < 2 or parts[0] != 'UPNPY':
+        return None
+    try:
+        version = int(parts[1])
+    except ValueError:
+        return None
+    options = {}
+    for part in parts[2:]:
+        key, _, value = part.partition('=')
+        options[key] = value
+    return version, options
+
+
+def make_cursor(epoch, seq):
+    return f'{epoch}:{seq}'
+
+
+def parse_cursor(cursor):
+    epoch, _, seq = (cursor or '').partition(':')
+    try:
+        return epoch, int(seq)
+    except ValueError:
+        return None, None
+
+
+async def accept_listener(reader, writer, epoch, timeout=HELLO_TIMEOUT,
+                          max_queue=MAX_QUEUE, policy=DROP_OLDEST, metrics=None):
+    # Returns the listener and its resume cursor, or None for a bad hello.
+    # A "METRICS" line instead of a hello is answered with the metrics in
+    # Prometheus text format.
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+    except asyncio.TimeoutError:
+        return TextListener(writer, max_queue=max_queue, policy=policy), None
+    except (ValueError, ConnectionError):
+        return None, None
+    if not line:
+        return None, None
+    if line.strip() == b'METRICS' and metrics is not None:
+        writer.write(metrics.render().encode('utf-8'))
+        return None, None
+
+    hello = parse_hello(line)
+    if hello is None or hello[0] != PROTOCOL_VERSION:
+        logger.info("Unsupported listener hello %r", line)
+        return None, None
+
+    options = hello[1]
+    listener = BinaryListener(writer, epoch, filter=options.get('filter') or None,
+                              icon_refs=options.get('icons') == 'ref',
+                              max_queue=max_queue, policy=policy)
+    listener.hello()
+    return listener, options.get('since')
+
+
+def read_icon(icon):
+    if isinstance(icon, IconRef):
+        try:
+            with icon.map() as data:
+                return bytes(data)
+        except (OSError, ValueError):
+            return None  # evicted in the meantime
+    return icon
+
+
+class Event():
+    # A found or gone device with everything listeners are sent about it,
+    # or changed state variables of one of its services. It is serialized
+    # at most once per protocol format and the bytes are shared by the
+    # queues of all listeners.
+
+    __slots__ = ('seq', 'device', 'gone', 'items', 'properties', 'encoded',
+                 'created')
+
+    def __init__(self, seq, device=None, gone=False, items=(), data=None,
+                 properties=None):
+        self.seq = seq
+        self.device = device
+        self.gone = gone
+        self.items = items  # (device, sub, desc, icon) of device and subdevices
+        self.properties = properties  # (service id, {name: value})
+        self.encoded = {} if data is None else data
+        self.created = asyncio.get_running_loop().time()
+
+    def encode(self, listener):
+        if isinstance(self.encoded, bytes):
+            return self.encoded  # made for a single listener
+        data = self.encoded.get(listener.format)
+        if data is None:
+            data = self.encoded[listener.format] = listener.encode(self)
+        return data
+
+    def key(self):
+        # state changes are not coalesced, each carries only some variables
+        if self.device is None or self.properties is not None:
+            return None
+        return self.device.usn.split('::', 1)[0]
+
+
+class TextListener():
+    # One line per item, icons are base64 encoded on a single line.
+    # Events are queued and written by the listener's own task, so a slow
+    # listener never holds up the others; a full queue is handled by policy.
+
+    binary = False
+    format = 'text'
+    # the text format has no lines for changed state variables, which the
+    # GUI would take for details of the previous device
+    properties = False
+
+    def __init__(self, writer, filter=None, max_queue=MAX_QUEUE,
+                 policy=DROP_OLDEST):
+        self.writer = writer
+        self.filter = filter
+        self.max_queue = max_queue
+        self.policy = policy
+
+        self.queue = collections.deque()
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.task = None
+        self.closed = False
+
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.last_seq = 0
+
+    def matches(self, device):
+        if self.filter is None or device.matches_target(self.filter):
+            return True
+        return any(sub.matches_target(self.filter)
+                   for sub in device.subdevices.values())
+
+    def is_closing(self):
+        return self.closed or self.writer.is_closing()
+
+    def start(self, on_close):
+        self.task = asyncio.get_running_loop().create_task(self.run(on_close))
+
+    def close(self, abort=False):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.ready.set()  # wakes the task, which then returns
+        self.space.set()
+        if abort:
+            # does not wait for buffered data a stuck listener never reads
+            self.writer.transport.abort()
+        else:
+            self.writer.close()
+
+    def offer(self, event):
+        # queues an event without waiting, returns False once disconnected
+        if self.closed:
+            return False
+        if len(self.queue) >= self.max_queue:
+            if self.policy == DISCONNECT:
+                logger.info("Disconnecting listener, %d events behind",
+                            len(self.queue))
+                self.close(abort=True)
+                return False
+            self.make_room(event)
+        self.queue.append(event)
+        self.ready.set()
+        return True
+
+    def make_room(self, event):
+        if self.policy == COALESCE:
+            key = event.key()
+            for i, queued in enumerate(self.queue):
+                if key is not None and queued.key() == key:
+                    del self.queue[i]
+                    self.coalesced += 1
+                    return
+        self.queue.popleft()
+        self.dropped += 1
+        if self.dropped == 1:
+            logger.info("Listener too slow, dropping events")
+
+    async def put(self, event):
+        # queues an event once there is room, for replays to a single listener
+        while len(self.queue) >= self.max_queue and not self.closed:
+            self.space.clear()
+            await self.space.wait()
+        if not self.closed:
+            self.queue.append(event)
+            self.ready.set()
+
+    async def run(self, on_close):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                while self.queue:
+                    event = self.queue.popleft()
+                    self.space.set()
+                    data = event.encode(self)
+                    self.writer.write(data)
+                    self.sent += 1
+                    self.sent_bytes += len(data)
+                    self.last_seq = max(self.last_seq, event.seq)
+                    await self.writer.drain()
+                self.ready.clear()
+        except ConnectionError:
+            pass
+        finally:
+            self.close()
+            on_close(self)
+
+    def stats(self, seq=None):
+        queue = self.queue
+        lag = (asyncio.get_running_loop().time() - queue[0].created
+               if queue else 0.0)
+        return {
+            'format': self.format,
+            'queued': len(queue),
+            'sent': self.sent,
+            'sent_bytes': self.sent_bytes,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'last_seq': self.last_seq,
+            'seq_lag': max(0, seq - self.last_seq) if seq is not None else None,
+            'lag_seconds': lag,
+        }
+
+    def encode(self, event):
+        if event.gone:
+            return f'GONE {event.device.usn}\n'.encode('utf-8')
+        parts = []
+        for device, sub, desc, icon in event.items:
+            kind = 'SUBDEVICE' if sub else 'DEVICE'
+            parts.append(f'{kind} {device.usn}\n'.encode('utf-8'))
+            if desc is None:
+                continue
+            parts.append(f'META {device.usn}\n'.encode('utf-8'))
+            parts.extend(
+                f'{k}:{v}\n'.encode('utf-8')
+                for k, v in desc.items()
+                if isinstance(v, str)
+            )
+            icon = read_icon(icon)
+            if icon:
+                parts.append(f'ICON {device.usn}\n'.encode('utf-8'))
+                # b64 so we can terminate line with \n
+                parts.append(base64.b64encode(icon) + b'\n')
+        return b''.join(parts)
+
+    def encode_sync(self, seq):
+        return b''
+
+
+class BinaryListener(TextListener):
+    # length-prefixed frames, icons are sent raw or as a reference that
+    # the listener fetches with GET_ICON
+
+    binary = True
+    properties = True
+
+    def __init__(self, writer, epoch, filter=None, icon_refs=False, **kwargs):
+        super().__init__(writer, filter, **kwargs)
+        self.epoch = epoch
+        self.icon_refs = icon_refs
+        self.format = 'binary-ref' if icon_refs else 'binary'
+
+    def hello(self):
+        self.writer.write(encode_frame(
+            HELLO, 0, STRING_LENGTH.pack(PROTOCOL_VERSION) + encode_strings(self.epoch)))
+
+    def encode(self, event):
+        seq = event.seq
+        if event.gone:
+            return encode_frame(GONE, seq, encode_strings(event.device.usn))
+        if event.properties is not None:
+            service_id, values = event.properties
+            strings = [event.device.usn, service_id]
+            for k, v in values.items():
+                strings.append(k)
+                strings.append(v)
+            return encode_frame(PROPERTIES, seq, encode_strings(*strings))
+
+        frames = []
+        for device, sub, desc, icon in event.items:
+            frames.append(encode_frame(
+                SUBDEVICE if sub else DEVICE, seq, encode_strings(device.usn)))
+            if desc is None:
+                continue
+            strings = [device.usn]
+            for k, v in desc.items():
+                if isinstance(v, str):
+                    strings.append(k)
+                    strings.append(v)
+            frames.append(encode_frame(META, seq, encode_strings(*strings)))
+            if icon:
+                frames.append(self.encode_icon(seq, device.usn, icon))
+        return b''.join(frames)
+
+    def encode_icon(self, seq, usn, icon, requested=False):
+        prefix = encode_strings(usn)
+        if self.icon_refs and not requested:
+            return encode_frame(ICON_REF, seq, prefix + ICON_SIZE.pack(len(icon)))
+        icon = read_icon(icon)
+        if not icon:
+            return b''
+        return encode_frame(ICON, seq, prefix + icon)
+
+    def encode_sync(self, seq):
+        return encode_frame(SYNC, seq, encode_strings(make_cursor(self.epoch, seq)))
+
+    async def read_request(self, reader):
+        # returns (type, strings) of the next request, None at the end
+        try:
+            header = await reader.readexactly(FRAME_HEADER.size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        length, type, _ = FRAME_HEADER.unpack(header)
+        if length > MAX_REQUEST_SIZE:
+            return None
+        try:
+            payload = await reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        return type, decode_strings(payload)
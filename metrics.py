@@ -0,0 +1,157 @@
+import bisect
+import time
+
+# Seconds, from a fraction of a millisecond for parsing a datagram up to
+# several seconds for fetching a description.
+DEFAULT_BUCKETS = (0.00001, 0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                   5.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)) + '}'
+
+
+class Counter():
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # label values -> [count]
+
+    def cell(self, labels=()):
+        # the one element list holding the count, hot paths increment it
+        # directly with cell[0] += 1
+        cell = self.values.get(labels)
+        if cell is None:
+            cell = self.values[labels] = [0]
+        return cell
+
+    def inc(self, labels=(), amount=1):
+        self.cell(labels)[0] += amount
+
+    def get(self, labels=()):
+        cell = self.values.get(labels)
+        return cell[0] if cell is not None else 0
+
+    def samples(self):
+        for labels, cell in self.values.items():
+            yield self.name, format_labels(self.labels, labels), cell[0]
+
+
+class Gauge():
+    # reads its values when collected, fn returns a number or a list of
+    # (label values, number)
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = labels
+
+    def samples(self):
+        values = self.fn()
+        if not self.labels:
+            values = [((), values)]
+        for labels, value in values:
+            yield self.name, format_labels(self.labels, labels), value
+
+
+class Histogram():
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, metrics=None):
+        self.name = name
+        self.help = help
+        self.metrics = metrics
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def observe_since(self, start):
+        # observes the time since start, a perf_counter value, and passes
+        # it to the profile hook
+        elapsed = time.perf_counter() - start
+        self.observe(elapsed)
+        hook = self.metrics.profile_hook if self.metrics is not None else None
+        if hook is not None:
+            hook(self.name, elapsed)
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield self.name + '_bucket', '{{le="{}"}}'.format(bound), cumulative
+        yield self.name + '_sum', '', self.sum
+        yield self.name + '_count', '', self.count
+
+
+class Timer():
+    # context manager observing the time spent in its block
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe_since(self.start)
+
+
+class Metrics():
+    # Collects counters, gauges and histograms and renders them in the
+    # Prometheus text format. A profile hook, if set, is called with the
+    # name and duration of each instrumented hot path.
+
+    def __init__(self):
+        self.metrics = {}
+        self.profile_hook = None
+
+    def add(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, fn, labels=()):
+        # gauges read live objects, a newer one replaces an older one
+        self.metrics[name] = Gauge(name, help, fn, labels)
+        return self.metrics[name]
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, buckets, metrics=self))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        lines.append('')
+        return '\n'.join(lines)
+
+
+METRICS = Metrics()
@@ -0,0 +1,133 @@
+import heapq
+import logging
+
+from ssdp import SSDPDevice
+
+logger = logging.getLogger('registry')
+
+DEFAULT_MAX_AGE = 1800
+
+
+class DeviceRegistry():
+
+    def __init__(self, loop, on_gone=None, default_max_age=DEFAULT_MAX_AGE):
+        self.loop = loop
+        self.on_gone = on_gone or (lambda _: None)
+        self.default_max_age = default_max_age
+
+        self.devices = {}  # root usn (uuid:...) -> SSDPDevice
+        self.usns = {}  # every known usn -> root usn
+        self.deadlines = {}  # root usn -> loop time of expiry
+        self.heap = []  # (deadline, root usn), may contain outdated entries
+        self.timer = None
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __contains__(self, usn):
+        return usn in self.usns
+
+    def __iter__(self):
+        return iter(list(self.devices.values()))
+
+    def get(self, usn):
+        return self.devices.get(usn.split('::', 1)[0])
+
+    def touch(self, usn, max_age=None):
+        # refreshes a known usn without allocating anything
+        root = self.usns.get(usn)
+        if root is None:
+            return False
+        self.refresh(root, max_age)
+        return True
+
+    def add(self, device):
+        if self.touch(device.usn, device.max_age):
+            return False
+
+        unique = False
+        parts = device.usn.split('::', 1)
+        root = self.devices.get(parts[0])
+        if root is None:
+            root = SSDPDevice(parts[0], device.location, device.max_age)
+            self.devices[parts[0]] = root
+            self.usns[parts[0]] = parts[0]
+            unique = True
+        if len(parts) == 2:
+            if device.location == root.location:
+                device.location = root.location  # one copy per device
+            root.subdevices[device.usn] = device
+            self.usns[device.usn] = root.usn
+        self.refresh(parts[0], device.max_age)
+        return unique
+
+    def refresh(self, root, max_age=None):
+        deadline = self.loop.time() + (max_age or self.default_max_age)
+        previous = self.deadlines.get(root)
+        self.deadlines[root] = deadline
+        # a later deadline is picked up when the earlier heap entry pops
+        if previous is not None and previous <= deadline:
+            return
+
+        heapq.heappush(self.heap, (deadline, root))
+        # outdated heap entries are skipped lazily, compact if they pile up
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(d, r) for r, d in self.deadlines.items()]
+            heapq.heapify(self.heap)
+        self.schedule()
+
+    def remove(self, usn):
+        # removing a root usn drops the whole device, otherwise only the
+        # matching subdevice is dropped
+        parts = usn.split('::', 1)
+        root = self.devices.get(parts[0])
+        if root is None:
+            return None
+
+        if len(parts) == 1 or parts[1] == 'upnp:rootdevice':
+            self.drop(parts[0])
+            return root
+
+        sub = root.subdevices.pop(usn, None)
+        if sub is not None:
+            del self.usns[usn]
+        return sub
+
+    def drop(self, root):
+        device = self.devices.pop(root)
+        del self.deadlines[root]
+        del self.usns[root]
+        for usn in device.subdevices:
+            del self.usns[usn]
+        return device
+
+    def schedule(self):
+        if not self.heap:
+            return
+        deadline = self.heap[0][0]
+        if self.timer is not None:
+            if self.timer.when() <= deadline:
+                return
+            self.timer.cancel()
+        self.timer = self.loop.call_at(deadline, self.sweep)
+
+    def sweep(self):
+        self.timer = None
+        now = self.loop.time()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, root = heapq.heappop(self.heap)
+            current = self.deadlines.get(root)
+            if current is None or current < deadline:
+                continue  # removed, or superseded by an earlier entry
+            if current > deadline:
+                heapq.heappush(self.heap, (current, root))  # refreshed
+                continue
+
+            logger.info("Device %s expired", root)
+            self.on_gone(self.drop(root))
+        self.schedule()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
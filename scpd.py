@@ -1,12 +1,33 @@
 import asyncio
-import base64
+import hashlib
 import logging
-import pprint
+import mmap
+import os
+import sys
+import time
 import urllib.parse
-from xml.etree import ElementTree
+
+from metrics import METRICS
 
 ROOT_DESC_PATH = "/root_desc.xml"
 ICON_PATH = "/icon.png"
+SCPD_PATH = "/scpd.xml"
+CONTROL_PATH = "/control"
+EVENT_PATH = "/event"
+
+DEVICE_TAG = '{urn:schemas-upnp-org:device-1-0}device'
+MAX_DESC_SIZE = 1024 * 1024
+MAX_ICON_SIZE = 1024 * 1024
+MAX_REQUEST_BODY = 64 * 1024
+READ_SIZE = 64 * 1024
+REQUEST_TIMEOUT = 10  # seconds for connecting and for each response
+SERVER = 'Linux UPnP/1.0 upnpy/0.1'
+METRICS_PATH = "/metrics"
+
+HTTP_REQUESTS = METRICS.counter(
+    'upnpy_http_requests_total',
+    'Requests answered by the metadata server, by method.', ('method',))
+HTTP_METHODS = ('GET', 'HEAD', 'POST', 'NOTIFY', 'SUBSCRIBE', 'UNSUBSCRIBE')
 
 ROOT_DESC_TEMPLATE = """
 <?xml version="1.0" encoding="utf-8"?>
@@ -14,8 +35,7 @@ ROOT_DESC_TEMPLATE = """
     <specVersion>
         <major>1</major>
         <minor>0</minor>
-    </specVersion>
-    <URLBase>http://{host}:{port}</URLBase>
+    </specVersion>{url_base}
     <device>
         <deviceType>{device_type}</deviceType>
         <friendlyName>{friendly_name}</friendlyName>
@@ -27,98 +47,673 @@ ROOT_DESC_TEMPLATE = """
                 <width>32</width>
                 <height>32</height>
                 <depth>24</depth>
-                <url>http://{host}:{port}{icon_path}</url>
+                <url>{base}{icon_path}</url>
             </icon>
         </iconList>
-        <serviceList>
+        <serviceList>{services}
         </serviceList>
     </device>
 </root>
 """
 
+SERVICE_TEMPLATE = """
+            <service>
+                <serviceType>{service_type}</serviceType>
+                <serviceId>{service_id}</serviceId>
+                <SCPDURL>{base}{path}{scpd_path}</SCPDURL>
+                <controlURL>{base}{path}{control_path}</controlURL>
+                <eventSubURL>{base}{path}{event_path}</eventSubURL>
+            </service>"""
+
 logger = logging.getLogger('scpd')
 
 
+class StaticResponse():
+    # header and body assembled once, for keep-alive and closing connections.
+    # Successful responses carry an ETag and Last-Modified and answer
+    # matching conditional requests with 304.
+
+    def __init__(self, body, content_type, status='200 OK', last_modified=None,
+                 length=None, etag=None, validators=True, headers=()):
+        self.body = body
+        self.conditional = validators and status.startswith('200')
+        header = (
+            "HTTP/1.1 {status}\r\n"
+            "Server: {server}\r\n"
+        ).format(status=status, server=SERVER)
+        if content_type:
+            header += "Content-Type: {}\r\n".format(content_type)
+        header += "Content-Length: {}\r\n".format(
+            len(body) if length is None else length)
+        for key, value in headers:
+            header += "{}: {}\r\n".format(key, value)
+
+        not_modified = None
+        if self.conditional:
+            import email.utils
+            self.etag = etag or '"{}"'.format(hashlib.sha1(body).hexdigest()[:20])
+            self.last_modified = int(time.time() if last_modified is None
+                                     else last_modified)
+            validators = (
+                "ETag: {etag}\r\n"
+                "Last-Modified: {date}\r\n"
+            ).format(etag=self.etag,
+                     date=email.utils.formatdate(self.last_modified, usegmt=True))
+            header += validators
+            not_modified = (
+                "HTTP/1.1 304 Not Modified\r\n"
+                "Server: {server}\r\n"
+            ).format(server=SERVER) + validators
+
+        self.head = {}
+        self.not_modified = {}
+        for keep_alive in (True, False):
+            connection = "Connection: {}\r\n\r\n".format(
+                'keep-alive' if keep_alive else 'close')
+            self.head[keep_alive] = (header + connection).encode('latin1')
+            if not_modified is not None:
+                self.not_modified[keep_alive] = (
+                    not_modified + connection).encode('latin1')
+        self.full = {k: head + body for k, head in self.head.items()}
+
+    def is_not_modified(self, request):
+        if not self.conditional:
+            return False
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return True
+            tags = (tag.strip() for tag in if_none_match.split(','))
+            return any(tag.lstrip('W/') == self.etag for tag in tags)
+
+        if_modified_since = request.headers.get('if-modified-since')
+        if if_modified_since is not None:
+            import email.utils
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return since.timestamp() >= self.last_modified
+        return False
+
+    def write(self, writer, request):
+        if self.is_not_modified(request):
+            writer.write(self.not_modified[request.keep_alive])
+        elif request.method == 'HEAD':
+            writer.write(self.head[request.keep_alive])
+        else:
+            writer.write(self.full[request.keep_alive])
+
+
+class FileResponse(StaticResponse):
+    # Serves a file with loop.sendfile, falling back to writing chunks of a
+    # memory map where sendfile is not available. Only the headers are kept
+    # in memory.
+
+    def __init__(self, path, content_type):
+        self.path = path
+        self.file = open(path, 'rb')
+        stat = os.fstat(self.file.fileno())
+        self.size = stat.st_size
+        etag = '"{:x}-{:x}"'.format(self.size, stat.st_mtime_ns)
+        super().__init__(b'', content_type, length=self.size, etag=etag,
+                         last_modified=stat.st_mtime)
+        self.full = self.head
+        self.map = None
+
+    def write(self, writer, request):
+        if self.is_not_modified(request):
+            writer.write(self.not_modified[request.keep_alive])
+            return None
+        writer.write(self.head[request.keep_alive])
+        if request.method == 'HEAD' or self.size == 0:
+            return None
+        return self.send_body(writer)
+
+    async def send_body(self, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.sendfile(writer.transport, self.file, 0, self.size,
+                                fallback=False)
+            return
+        except (asyncio.SendfileNotAvailableError, NotImplementedError):
+            pass
+
+        if self.map is None:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        for offset in range(0, self.size, READ_SIZE):
+            writer.write(view[offset:offset + READ_SIZE])
+            await writer.drain()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class HTTPRequest():
+
+    __slots__ = ('method', 'path', 'query', 'version', 'headers', 'keep_alive',
+                 'body')
+
+    def __init__(self, method, target, version, headers, body=b''):
+        self.method = method
+        self.body = body
+        url = urllib.parse.urlsplit(target)
+        self.path = url.path
+        self.query = url.query
+        self.version = version
+        self.headers = headers
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+
+
+NOT_FOUND = StaticResponse(
+    b'<html><body>Not found.</body></html>', 'text/html; charset=utf8',
+    '404 Not Found')
+METHOD_NOT_ALLOWED = StaticResponse(
+    b'<html><body>Method not allowed.</body></html>', 'text/html; charset=utf8',
+    '405 Method Not Allowed')
+BAD_REQUEST = StaticResponse(
+    b'<html><body>Bad request.</body></html>', 'text/html; charset=utf8',
+    '400 Bad Request')
+SERVICE_UNAVAILABLE = StaticResponse(
+    b'<html><body>Service unavailable.</body></html>', 'text/html; charset=utf8',
+    '503 Service Unavailable')
+
+
 class MetadataServer():
 
-    def __init__(self, device):
-        self.host = device.host
-        self.port = device.port
+    def __init__(self, device=None, max_connections=256, idle_timeout=15,
+                 header_timeout=10, host=None, port=None, metrics=None):
+        self.host = device.host if device is not None else host
+        self.port = device.port if device is not None else port
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.header_timeout = header_timeout
+        self.connections = 0
+
+        self.router = {}
+        self.handlers = {}  # (method, path) -> handler of other methods
+        self.routes = {}  # uuid -> {path: response} of each served device
+        self.files = {}  # icon path -> [FileResponse, number of devices]
+
+        if metrics is not None:
+            # rendered per request, the values change all the time
+            self.metrics = metrics
+            self.router[METRICS_PATH] = self.send_metrics
+            metrics.gauge('upnpy_http_connections',
+                          'Open connections to the metadata server.',
+                          lambda: self.connections)
+
+        if device is not None:
+            self.add_device(device)
 
-        self.root_desc = ROOT_DESC_TEMPLATE.format(
-            host=device.host,
-            port=device.port,
+    def add_device(self, device, prefix=''):
+        # Serves the description and icon of a device under prefix, so any
+        # number of devices can share one server.
+        self.remove_device(device)
+
+        # served on every interface, urls are relative to the location
+        base = ('' if self.host in (None, '', '0.0.0.0')
+                else f'http://{self.host}:{self.port}')
+        services = getattr(device, 'services', ())
+        root_desc = ROOT_DESC_TEMPLATE.format(
+            url_base=f'\n    <URLBase>{base}</URLBase>' if base else '',
+            base=base,
             device_type=device.type,
             friendly_name=device.name,
             uuid=device.uuid,
-            icon_path=ICON_PATH,
+            icon_path=prefix + ICON_PATH,
+            services=''.join(SERVICE_TEMPLATE.format(
+                service_type=service.service_type,
+                service_id=service.service_id,
+                base=base,
+                path=f'{prefix}/{service.name}',
+                scpd_path=SCPD_PATH,
+                control_path=CONTROL_PATH,
+                event_path=EVENT_PATH,
+            ) for service in services),
         ).lstrip().encode('utf-8')
+        responses = {
+            prefix + ROOT_DESC_PATH: StaticResponse(
+                root_desc, 'application/xml; charset=utf8'),
+        }
+        handlers = {}
+        for service in services:
+            path = f'{prefix}/{service.name}'
+            responses[path + SCPD_PATH] = service.scpd_response()
+            handlers['POST', path + CONTROL_PATH] = service.control
+            handlers['SUBSCRIBE', path + EVENT_PATH] = service.events.subscribe
+            handlers['UNSUBSCRIBE', path + EVENT_PATH] = service.events.unsubscribe
 
-        self.icon = device.icon
+        icon_path = getattr(device, 'icon_path', None)
+        if icon_path:
+            shared = self.files.get(icon_path)
+            if shared is None:
+                shared = self.files[icon_path] = [
+                    FileResponse(icon_path, 'image/png'), 0]
+            shared[1] += 1
+            responses[prefix + ICON_PATH] = shared[0]
+        elif device.icon:
+            responses[prefix + ICON_PATH] = StaticResponse(device.icon, 'image/png')
 
-        self.router = {
-            f'GET {ROOT_DESC_PATH} HTTP/1.1': self.send_root_desc,
-        }
+        for path, response in responses.items():
+            self.router[path] = response.write
+        self.handlers.update(handlers)
+        self.routes[str(device.uuid)] = {**responses, **handlers}
+
+    def remove_device(self, device):
+        responses = self.routes.pop(str(device.uuid), None)
+        if responses is None:
+            return False
+
+        for path, response in responses.items():
+            self.router.pop(path, None)
+            self.handlers.pop(path, None)
+            if isinstance(response, FileResponse):
+                shared = self.files[response.path]
+                shared[1] -= 1
+                if not shared[1]:
+                    del self.files[response.path]
+                    response.close()
+        return True
+
+    def add_handler(self, method, path, handler):
+        # handler(writer, request) of requests other than GET and HEAD
+        self.handlers[method, path] = handler
 
-        if self.icon:
-            self.router[f'GET {ICON_PATH} HTTP/1.1'] = self.send_icon
+    def remove_handler(self, method, path):
+        self.handlers.pop((method, path), None)
+
+    def close(self):
+        for response, _ in self.files.values():
+            response.close()
+        self.files.clear()
 
     async def start(self):
         server = await asyncio.start_server(self.client_connected,
                                             port=self.port, host=self.host)
 
         addr = server.sockets[0].getsockname()
-        logger.info(f'Serving on %s', addr)
+        logger.info('Serving on %s', addr)
         return server
 
     async def client_connected(self, reader, writer):
-        line = await reader.readline()
-        line = line.decode('latin1').rstrip()
-        logger.info(line)
-        if line in self.router.keys():
-            self.router[line](writer)
-        else:
-            self.send_not_found(writer)
-        await writer.drain()
-        writer.close()
+        if self.connections >= self.max_connections:
+            logger.info("Too many connections, rejecting client")
+            SERVICE_UNAVAILABLE.write(writer, HTTPRequest('GET', '/', 'HTTP/1.0', {}))
+            writer.close()
+            return
 
-    # TODO add Date, Server, Connection: close
+        self.connections += 1
+        loop = asyncio.get_running_loop()
+        # a single timer closes the connection when a timeout elapses, which
+        # is cheaper than wrapping every read in wait_for
+        timer = loop.call_later(self.idle_timeout, writer.close)
+        try:
+            # requests are answered in order, so pipelined requests that
+            # are already buffered in the reader are served one by one
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line in (b'\r\n', b'\n'):
+                    continue  # tolerate empty lines between requests
 
-    def send_root_desc(self, writer):
-        header = (
-            "HTTP/1.1 200 OK\r\n"
-            "Content-Type: application/xml; charset=utf8\r\n"
-            "Content-Length: {len}\r\n"
-            "\r\n"
-        ).format(len=len(self.root_desc))
-        writer.write(header.encode('latin1'))
-        writer.write(self.root_desc)
-
-    def send_icon(self, writer):
-        header = (
-            "HTTP/1.1 200 OK\r\n"
-            "Content-Type: image/png\r\n"
-            "Content-Length: {len}\r\n"
-            "\r\n"
-        ).format(len=len(self.icon))
-        writer.write(header.encode('latin1'))
-        writer.write(self.icon)
-
-    def send_not_found(self, writer):
-        body = "<html><body>Not found.</body></html>".encode('utf-8')
-        header = (
-            "HTTP/1.1 400 Not Found\r\n"
-            "Content-Type: text/html; charset=utf8\r\n"
-            "Content-Length: {len}\r\n"
-            "\r\n"
-        ).format(len=len(body))
-        writer.write(header.encode('latin1'))
-        writer.write(body)
+                timer.cancel()
+                timer = loop.call_later(self.header_timeout, writer.close)
+                request = await self.read_request(line, reader)
+                # not armed while a response is written, a large file sent
+                # to a slow client may take longer than the idle timeout
+                timer.cancel()
+
+                if request is None:
+                    BAD_REQUEST.write(writer, HTTPRequest('GET', '/', 'HTTP/1.0', {}))
+                    await writer.drain()
+                    break
+
+                sending = self.handle_request(writer, request)
+                if sending is not None:
+                    await sending
+                await writer.drain()
+                timer = loop.call_later(self.idle_timeout, writer.close)
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            timer.cancel()
+            self.connections -= 1
+            writer.close()
+
+    async def read_request(self, line, reader):
+        parts = line.decode('latin1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            return None
+
+        headers = {}
+        while True:
+            header = await reader.readline()
+            if header in (b'\r\n', b'\n'):
+                break
+            if not header:
+                raise asyncio.IncompleteReadError(b'', None)
+            header = header.decode('latin1')
+            if ':' not in header:
+                return None
+            key, value = header.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+        method, target, version = parts
+        body = b''
+        if method in ('POST', 'NOTIFY'):
+            # only control requests and events have a body, chunked ones
+            # are refused
+            try:
+                length = int(headers.get('content-length', ''))
+            except ValueError:
+                return None
+            if (not 0 <= length <= MAX_REQUEST_BODY
+                    or 'transfer-encoding' in headers):
+                return None
+            body = await reader.readexactly(length)
+        return HTTPRequest(method, target, version, headers, body)
+
+    def handle_request(self, writer, request):
+        logger.debug("%s %s", request.method, request.path)
+        HTTP_REQUESTS.inc((request.method,) if request.method in HTTP_METHODS
+                          else ('OTHER',))
+        if request.method in ('POST', 'NOTIFY', 'SUBSCRIBE', 'UNSUBSCRIBE'):
+            handler = self.handlers.get((request.method, request.path))
+            if handler is None:
+                return self.send_not_found(writer, request)
+            return handler(writer, request)
+        if request.method not in ('GET', 'HEAD'):
+            request.keep_alive = False  # the request body is not read
+            METHOD_NOT_ALLOWED.write(writer, request)
+            return None
+
+        # handlers return an awaitable if the body is sent asynchronously
+        handler = self.router.get(request.path)
+        if handler is None:
+            return self.send_not_found(writer, request)
+        return handler(writer, request)
+
+    # TODO add Date
+
+    def send_metrics(self, writer, request):
+        body = self.metrics.render().encode('utf-8')
+        response = StaticResponse(body, 'text/plain; version=0.0.4; charset=utf-8',
+                                  validators=False)
+        return response.write(writer, request)
+
+    def send_not_found(self, writer, request):
+        return NOT_FOUND.write(writer, request)
+
+
+class PooledConnection():
+
+    def __init__(self, host, port, reader, writer):
+        self.host = host
+        self.port = port
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+        self.expiry_handle = None
+
+    def is_usable(self):
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self):
+        if self.expiry_handle is not None:
+            self.expiry_handle.cancel()
+            self.expiry_handle = None
+        self.writer.close()
+
+
+class ConnectionPool():
+
+    def __init__(self, max_connections=64, max_idle=2, idle_timeout=15):
+        self.max_idle = max_idle  # per (host, port)
+        self.idle_timeout = idle_timeout
+        self.limit = asyncio.Semaphore(max_connections)
+        self.idle = {}
+
+    async def acquire(self, host, port, timeout=None):
+        # a peer that never accepts keeps its slot at most for timeout
+        await self.limit.acquire()
+        try:
+            conns = self.idle.get((host, port))
+            while conns:
+                conn = conns.pop()
+                conn.expiry_handle.cancel()
+                conn.expiry_handle = None
+                if conn.is_usable():
+                    conn.reused = True
+                    return conn
+                conn.close()
+
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), timeout)
+            return PooledConnection(host, port, reader, writer)
+        except BaseException:
+            self.limit.release()
+            raise
+
+    def release(self, conn, reuse=True):
+        self.limit.release()
+        key = (conn.host, conn.port)
+        conns = self.idle.setdefault(key, [])
+        if not reuse or not conn.is_usable() or len(conns) >= self.max_idle:
+            conn.close()
+            if not conns:
+                del self.idle[key]
+            return
+
+        loop = asyncio.get_running_loop()
+        conn.expiry_handle = loop.call_later(
+            self.idle_timeout, self.expire, key, conn)
+        conns.append(conn)
+
+    def expire(self, key, conn):
+        conns = self.idle.get(key, [])
+        try:
+            conns.remove(conn)
+        except ValueError:
+            return
+        conn.expiry_handle = None
+        conn.close()
+        if not conns:
+            del self.idle[key]
+
+    def close(self):
+        for conns in self.idle.values():
+            for conn in conns:
+                conn.close()
+        self.idle.clear()
+
+
+class Record(tuple):
+    # A tuple with named fields that reads like the dicts it replaces:
+    # record['field'], .get() and .items(). Values of the shared fields
+    # repeat across devices of a model and are interned.
+
+    __slots__ = ()
+    fields = ()
+    shared = frozenset()
+    index = {}
+
+    def __new__(cls, values):
+        return tuple.__new__(cls, (
+            sys.intern(values[key])
+            if key in cls.shared and values.get(key) else values.get(key)
+            for key in cls.fields
+        ))
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                key = self.index[key]
+            except KeyError:
+                raise KeyError(key) from None
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def items(self):
+        return ((k, v) for k, v in zip(self.fields, self) if v is not None)
+
+    def keys(self):
+        return (k for k, _ in self.items())
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, dict(self.items()))
+
+
+class Icon(Record):
+    __slots__ = ()
+    fields = ('mimetype', 'width', 'height', 'depth', 'url')
+    shared = frozenset(fields)
+    index = {field: i for i, field in enumerate(fields)}
+
+
+class Service(Record):
+    __slots__ = ()
+    fields = ('serviceType', 'serviceId', 'SCPDURL', 'controlURL', 'eventSubURL')
+    shared = frozenset(fields)
+    index = {field: i for i, field in enumerate(fields)}
+
+
+class DeviceDescription(Record):
+    # properties outside the standard ones are kept as (tag, text) pairs in
+    # extra and read like the others
+
+    __slots__ = ()
+    fields = (
+        'deviceType', 'friendlyName', 'manufacturer', 'manufacturerURL',
+        'modelDescription', 'modelName', 'modelNumber', 'modelURL',
+        'serialNumber', 'UDN', 'UPC', 'presentationURL',
+        'extra', 'icon', 'icons', 'services',
+    )
+    shared = frozenset((
+        'deviceType', 'manufacturer', 'manufacturerURL', 'modelDescription',
+        'modelName', 'modelNumber', 'modelURL', 'presentationURL', 'UPC',
+    ))
+    index = {field: i for i, field in enumerate(fields)}
+
+    def __getitem__(self, key):
+        try:
+            return super().__getitem__(key)
+        except KeyError:
+            for tag, text in super().__getitem__('extra') or ():
+                if tag == key:
+                    return text
+            raise
+
+    def items(self):
+        for k, v in super().items():
+            if k != 'extra':
+                yield k, v
+        yield from super().__getitem__('extra') or ()
+
+
+class DescriptionParser():
+    # Incrementally parses a root description as its bytes arrive. Only the
+    # properties of the root device are kept, elements are cleared once
+    # read so large descriptions do not build up a tree.
+
+    def __init__(self):
+        # imported when the first description is parsed
+        from xml.etree import ElementTree
+        self.parse_error = ElementTree.ParseError
+        self.parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        self.path = []
+        self.device = None
+        self.icons = []
+        self.services = []
+        self.item = None
+        self.done = False
+        self.error = False
+
+    def feed(self, data):
+        # returns True once the root element has been closed
+        if self.done or self.error:
+            return True
+        try:
+            self.parser.feed(data)
+            for event, elem in self.parser.read_events():
+                if event == 'start':
+                    self.start(elem)
+                else:
+                    self.end(elem)
+                    if self.done:
+                        break
+        except self.parse_error:
+            self.error = True
+        return self.done or self.error
+
+    def start(self, elem):
+        self.path.append(elem.tag.rpartition('}')[2])
+        depth = len(self.path)
+        if depth == 2 and elem.tag == DEVICE_TAG:
+            self.device = {}
+        elif depth == 4 and self.path[1:3] in (['device', 'iconList'],
+                                               ['device', 'serviceList']):
+            self.item = {}
+
+    def end(self, elem):
+        depth = len(self.path)
+        tag = self.path.pop()
+        if depth == 1:
+            self.done = True
+        elif depth == 2 or self.device is None or self.path[1] != 'device':
+            pass
+        elif depth == 3 and len(elem) == 0 and tag not in ('iconList', 'serviceList', 'deviceList'):
+            self.device[tag] = elem.text
+        elif depth == 4 and self.item is not None:
+            if self.path[2] == 'iconList':
+                self.icons.append(self.item)
+            else:
+                self.services.append(self.item)
+            self.item = None
+        elif depth == 5 and self.item is not None:
+            self.item[tag] = elem.text
+
+        if depth >= 3:
+            elem.clear()
+
+    def close(self):
+        if self.error or not self.done or self.device is None:
+            return None
+        device = self.device
+        device['extra'] = tuple(
+            (sys.intern(tag), text) for tag, text in device.items()
+            if tag not in DeviceDescription.index) or None
+        icons = tuple(Icon(icon) for icon in self.icons)
+        if icons:
+            device['icon'] = icons[0]
+        device['icons'] = icons
+        device['services'] = tuple(Service(service) for service in self.services)
+        return DeviceDescription(device)
 
 
 class MetadataClient():
 
-    def __init__(self, location):
+    def __init__(self, location, pool=None, max_desc_size=MAX_DESC_SIZE,
+                 max_icon_size=MAX_ICON_SIZE, timeout=REQUEST_TIMEOUT):
         url = urllib.parse.urlparse(location)
         if not url.hostname or not url.port or not url.path:
             raise ValueError
@@ -126,97 +721,342 @@ class MetadataClient():
         self.host = url.hostname
         self.port = url.port
         self.path = url.path
+        self.pool = pool
+        self.max_desc_size = max_desc_size
+        self.max_icon_size = max_icon_size
+        # a peer that does not answer in time has its connection closed,
+        # which gives its slot in the pool back
+        self.timeout = timeout
 
+        self.conn = None
         self.reader = None
         self.writer = None
+        self.response_headers = None  # of the last response
 
     async def connect(self):
-        reader, writer = await asyncio.open_connection(self.host, self.port)
-        self.reader = reader
-        self.writer = writer
+        if self.writer is not None:
+            return self
+        if self.pool is not None:
+            self.conn = await self.pool.acquire(self.host, self.port,
+                                               self.timeout)
+            self.reader = self.conn.reader
+            self.writer = self.conn.writer
+        else:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+            self.reader = reader
+            self.writer = writer
         return self
 
-    async def write_http_request(self):
-        logger.info("Fetching %s", self.path)
+    def close(self, reuse=False):
+        if self.conn is not None:
+            self.pool.release(self.conn, reuse=reuse)
+            self.conn = None
+        elif self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    def same_origin(self, location):
+        url = urllib.parse.urlparse(location)
+        return url.hostname == self.host and url.port == self.port
+
+    def write_http_request(self, path=None, validator=None, method='GET',
+                           body=None, headers=()):
+        path = path or self.path
+        logger.info("Fetching %s", path)
         header = (
-            "GET {path} HTTP/1.1\r\n"
+            "{method} {path} HTTP/1.1\r\n"
             "HOST: {host}:{port}\r\n"
-            "\r\n"
-        ).format(host=self.host, port=self.port, path=self.path)
-        self.writer.write(header.encode('latin1'))
-        await self.writer.drain()
-
-    async def fetch_metadata(self):
-        await self.write_http_request()
+            "Connection: {connection}\r\n"
+        ).format(method=method, host=self.host, port=self.port, path=path,
+            connection='keep-alive' if self.pool else 'close')
+        for key, value in headers:
+            header += "{}: {}\r\n".format(key, value)
+        if body is not None:
+            header += "Content-Length: {}\r\n".format(len(body))
+        if validator is not None:
+            etag, last_modified = validator
+            if etag:
+                header += "If-None-Match: {}\r\n".format(etag)
+            if last_modified:
+                header += "If-Modified-Since: {}\r\n".format(last_modified)
+        header += "\r\n"
+        if body:
+            self.writer.writelines((header.encode('latin1'), body))
+        else:
+            self.writer.write(header.encode('latin1'))
 
+    async def read_response_head(self):
         line = await self.reader.readline()
+        if not line:
+            raise ConnectionResetError("Connection closed by peer")
         line = line.decode('latin1').rstrip()
-        if line != "HTTP/1.1 200 OK":
+        if not line.startswith('HTTP/1.'):
             logger.debug("Unexpected response: %s", line)
-            return None
-        await self.reader.readuntil(b'\r\n\r\n')  # read header
+            return None, None, False
 
-        root_desc = await self.reader.readuntil(b'</root>')  # uppercase??
-        root_desc = root_desc.decode("utf-8")  # assumption: encoding is utf-8
-        root_desc = root_desc + '\n'
+        headers = {}
+        while True:
+            header = await self.reader.readline()
+            if header in (b'\r\n', b'\n', b''):
+                break
+            header = header.decode('latin1').rstrip()
+            if ':' not in header:
+                logger.error("Unexpected header: %s", header)
+                return None, None, False
+            key, value = header.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
 
-        self.writer.close()
-        return self.parse_metadata(root_desc)
+        keep_alive = (line.startswith('HTTP/1.1')
+            and headers.get('connection', '').lower() != 'close')
+        self.response_headers = headers
+        return line, headers, keep_alive
 
-    async def fetch_icon(self):
-        await self.write_http_request()
+    async def read_body(self, headers, sink, max_size):
+        # Streams the body into sink. Honors chunked transfer encoding and
+        # Content-Length; without either, reads until EOF or until the sink
+        # returns True. Returns whether the connection can be reused.
+        total = 0
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                size = await self.reader.readline()
+                if not size:
+                    raise asyncio.IncompleteReadError(b'', None)
+                size = int(size.split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    while await self.reader.readline() not in (b'\r\n', b'\n', b''):
+                        pass  # trailers
+                    return True
+                total += size
+                if total > max_size:
+                    raise ValueError("Response exceeds %d bytes" % max_size)
+                await self.read_exactly_into(size, sink)
+                await self.reader.readline()
 
-        line = await self.reader.readline()
-        line = line.decode('latin1').rstrip()
-        if line != "HTTP/1.1 200 OK":
-            logger.error("Unexpected response: %s", line)
-            return None
+        try:
+            length = int(headers['content-length'])
+        except (KeyError, ValueError):
+            length = None
+
+        if length is not None:
+            if length > max_size:
+                raise ValueError("Response exceeds %d bytes" % max_size)
+            await self.read_exactly_into(length, sink)
+            return True
 
-        headers = {}
         while True:
-            line = await self.reader.readline()
-            if line == b'\r\n':
-                break
-            line = line.decode('latin1').rstrip()
-            if not line or ':' not in line:
-                logger.error("Unexpected header: %s", line)
-                return None
-            line = line.split(':', 1)
-            headers[line[0].strip().lower()] = line[1].strip()
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                return False
+            total += len(data)
+            if total > max_size:
+                raise ValueError("Response exceeds %d bytes" % max_size)
+            if sink(data):
+                return False
 
-        if 'content-length' not in headers:
-            logger.error("Missing content length header")
-            return None
+    async def read_exactly_into(self, n, sink):
+        while n > 0:
+            data = await self.reader.read(min(n, READ_SIZE))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', n)
+            n -= len(data)
+            sink(data)
+
+    async def read_response(self, parser=None, max_size=None):
+        # returns (status line, body, reusable, validator), the body is the
+        # parser's result if a parser was given and None for 304
+        line, headers, keep_alive = await self.read_response_head()
+        if line is None:
+            return None, None, False, None
+
+        validator = None
+        if 'etag' in headers or 'last-modified' in headers:
+            validator = (headers.get('etag'), headers.get('last-modified'))
+
+        if line.split(' ', 2)[1:2] == ['304']:
+            return line, None, keep_alive, validator
+
+        if parser is not None:
+            sink = parser.feed
+        else:
+            body = bytearray()
+            sink = body.extend
+
+        reusable = await self.read_body(
+            headers, sink, max_size or self.max_icon_size)
+        keep_alive = keep_alive and reusable
+
+        if parser is not None:
+            return line, parser.close(), keep_alive, validator
+        return line, bytes(body), keep_alive, validator
+
+    async def drain_and_read(self, parser=None, max_size=None):
+        await self.writer.drain()
+        return await self.read_response(parser, max_size)
+
+    async def request(self, path=None, parser=None, max_size=None,
+                      validator=None, method='GET', body=None, headers=()):
+        await self.connect()
+        reused = self.conn is not None and self.conn.reused
+        written = False
         try:
-            length = int(headers['content-length'])
-        except ValueError:
+            if reused and not self.conn.is_usable():
+                raise ConnectionResetError("Idle connection closed")
+            written = True
+            self.write_http_request(path, validator, method, body, headers)
+            line, data, keep_alive, validator = await asyncio.wait_for(
+                self.drain_and_read(parser, max_size), self.timeout)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.close()
+            # an action or event may already have been received, only
+            # requests without side effects are sent again
+            if not reused or (written and method not in ('GET', 'HEAD')):
+                raise
+            # idle connection was closed by the server, retry on a fresh one
+            parser = type(parser)() if parser is not None else None
+            return await self.request(path, parser, max_size, validator,
+                                      method, body, headers)
+        except BaseException:
+            self.close()
+            raise
+
+        self.close(reuse=keep_alive)
+        return line, data, validator
+
+    async def fetch_metadata(self):
+        line, metadata, _ = await self.request(
+            parser=DescriptionParser(), max_size=self.max_desc_size)
+        if line != "HTTP/1.1 200 OK":
+            logger.debug("Unexpected response: %s", line)
             return None
+        return metadata
 
-        data = await self.reader.readexactly(length)
-        self.writer.close()
+    async def fetch_icon(self, path=None):
+        line, data, _ = await self.request(path, max_size=self.max_icon_size)
+        if line != "HTTP/1.1 200 OK":
+            logger.error("Unexpected response: %s", line)
+            return None
         return data
 
-    def parse_metadata(self, root_desc):
-        logger.debug("Parsing metadata")
+    async def fetch_metadata_and_icon(self, icon_url=None, cached=None):
+        # Returns (metadata, icon, validators). With `cached`, a previous
+        # result, the requests are conditional and unchanged resources are
+        # taken from it. With a known icon url on the same host, both
+        # requests are pipelined on one connection. Otherwise the icon is
+        # fetched after the description, reusing the pooled connection.
+        cached_metadata, cached_icon, (desc_validator, icon_validator) = (
+            cached or (None, None, (None, None)))
+        if cached_metadata is None:
+            desc_validator = None
+
+        if icon_url is None or not self.same_origin(icon_url):
+            line, metadata, validator = await self.request(
+                parser=DescriptionParser(), max_size=self.max_desc_size,
+                validator=desc_validator)
+            metadata, validator = self.revalidated(
+                line, metadata, validator, cached_metadata, desc_validator)
+            if metadata is None:
+                return None, None, (None, None)
+            icon, icon_validator = await self.fetch_related_icon(
+                metadata, cached)
+            return metadata, icon, (validator, icon_validator)
+
+        if cached_icon is None or self.icon_url(cached_metadata) != icon_url:
+            icon_validator = None
+
+        icon_path = urllib.parse.urlparse(icon_url).path
+        await self.connect()
+        reused = self.conn is not None and self.conn.reused
         try:
-            root = ElementTree.fromstring(root_desc)
-            root = root.find('{urn:schemas-upnp-org:device-1-0}device')
-        except (AttributeError, ElementTree.ParseError):
+            self.write_http_request(validator=desc_validator)
+            self.write_http_request(icon_path, icon_validator)
+            line, metadata, keep_alive, validator = await asyncio.wait_for(
+                self.drain_and_read(DescriptionParser(), self.max_desc_size),
+                self.timeout)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.close()
+            if not reused:
+                raise
+            return await self.fetch_metadata_and_icon(icon_url, cached)
+        except BaseException:
+            self.close()
+            raise
+
+        icon_line, icon, new_icon_validator = None, None, None
+        if keep_alive:
+            try:
+                icon_line, icon, keep_alive, new_icon_validator = (
+                    await asyncio.wait_for(self.read_response(
+                        max_size=self.max_icon_size), self.timeout))
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError,
+                    asyncio.TimeoutError):
+                # server does not support pipelining, fetch icon separately
+                keep_alive = False
+            except BaseException:
+                self.close()
+                raise
+        self.close(reuse=keep_alive)
+
+        metadata, validator = self.revalidated(
+            line, metadata, validator, cached_metadata, desc_validator)
+        if metadata is None:
+            return None, None, (None, None)
+
+        if icon_line is not None and self.icon_url(metadata) == icon_url:
+            icon, new_icon_validator = self.revalidated(
+                icon_line, icon, new_icon_validator, cached_icon, icon_validator)
+            if icon is not None:
+                return metadata, icon, (validator, new_icon_validator)
+        icon, icon_validator = await self.fetch_related_icon(metadata, cached)
+        return metadata, icon, (validator, icon_validator)
+
+    def revalidated(self, line, body, validator, cached_body, cached_validator):
+        if line == "HTTP/1.1 304 Not Modified" and cached_body is not None:
+            return cached_body, validator or cached_validator
+        if line != "HTTP/1.1 200 OK":
+            logger.debug("Unexpected response: %s", line)
+            return None, None
+        return body, validator
+
+    def icon_url(self, metadata):
+        try:
+            url = metadata['icon']['url']
+        except (KeyError, TypeError):
             return None
-        if root is None:
+        if not url:
             return None
+        base = f'http://{self.host}:{self.port}{self.path}'
+        return urllib.parse.urljoin(base, url)
 
-        device = {}
-        for prop in root:
-            if len(prop) > 0:
-                if prop.tag.endswith('iconList'):
-                    icon = {}
-                    for icon_prop in prop[0]:
-                        key = icon_prop.tag.split('}')[1]
-                        icon[key] = icon_prop.text
-                    device['icon'] = icon
+    async def fetch_related_icon(self, metadata, cached=None):
+        # returns (icon, validator), revalidating the cached icon if its url
+        # did not change
+        icon_url = self.icon_url(metadata)
+        if icon_url is None:
+            return None, None
+
+        cached_icon, validator = None, None
+        if cached is not None and cached[1] is not None:
+            if self.icon_url(cached[0]) == icon_url:
+                cached_icon, validator = cached[1], cached[2][1]
+
+        try:
+            if self.same_origin(icon_url):
+                client = self
             else:
-                key = prop.tag.split('}')[1]
-                device[key] = prop.text
+                client = MetadataClient(icon_url, pool=self.pool,
+                                        max_icon_size=self.max_icon_size)
+            line, icon, new_validator = await client.request(
+                urllib.parse.urlparse(icon_url).path,
+                max_size=self.max_icon_size, validator=validator)
+        except (ValueError, OSError, asyncio.IncompleteReadError,
+                asyncio.TimeoutError):
+            return None, None
+        return self.revalidated(line, icon, new_validator, cached_icon, validator)
 
-        return device
+    def parse_metadata(self, root_desc):
+        logger.debug("Parsing metadata")
+        parser = DescriptionParser()
+        parser.feed(root_desc)
+        return parser.close()
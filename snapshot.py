@@ -0,0 +1,280 @@
+import logging
+import mmap
+import os
+import struct
+import time
+
+from ssdp import SSDPDevice
+from scpd import DeviceDescription, Icon, Service
+
+logger = logging.getLogger('snapshot')
+
+# A snapshot is a header followed by records of a type and a payload
+# length. Device records are read when a snapshot is loaded, description
+# records are located then but only decoded when first asked for.
+MAGIC = b'UPNPYSN1'
+HEADER = struct.Struct('!8sQ')  # magic, event sequence number, then epoch
+RECORD = struct.Struct('!BI')  # type, payload length
+STRING = struct.Struct('!H')
+BLOB = struct.Struct('!I')
+EXPIRES = struct.Struct('!d')
+
+NONE_STRING = 0xffff
+NONE_BLOB = 0xffffffff
+
+DEVICE = 1  # root usn, location, expiry, then subdevice usns and locations
+METADATA = 2  # location, description, validators and icon
+
+DESCRIPTION_FIELDS = tuple(
+    field for field in DeviceDescription.fields
+    if field not in ('extra', 'icon', 'icons', 'services'))
+
+
+class Encoder():
+
+    def __init__(self):
+        self.parts = []
+
+    def string(self, value):
+        if value is None:
+            self.parts.append(STRING.pack(NONE_STRING))
+            return
+        data = value.encode('utf-8')
+        if len(data) >= NONE_STRING:
+            # cut on a character, a split one would fail the whole decode
+            data = data[:NONE_STRING - 1].decode('utf-8', 'ignore').encode()
+        self.parts.append(STRING.pack(len(data)))
+        self.parts.append(data)
+
+    def blob(self, value):
+        if value is None:
+            self.parts.append(BLOB.pack(NONE_BLOB))
+            return
+        self.parts.append(BLOB.pack(len(value)))
+        self.parts.append(value)
+
+    def count(self, value):
+        self.parts.append(STRING.pack(value))
+
+    def number(self, value):
+        if value is None:
+            value = NONE_BLOB
+        elif not 0 <= value < NONE_BLOB:
+            raise ValueError(f"Number out of range: {value}")
+        self.parts.append(BLOB.pack(value))
+
+    def record(self, type):
+        payload = b''.join(self.parts)
+        self.parts = []
+        return RECORD.pack(type, len(payload)) + payload
+
+
+class Decoder():
+
+    def __init__(self, buffer, offset, end):
+        self.buffer = buffer
+        self.offset = offset
+        self.end = end
+
+    def unpack(self, fmt):
+        if self.offset + fmt.size > self.end:
+            raise ValueError("Truncated snapshot record")
+        value, = fmt.unpack_from(self.buffer, self.offset)
+        self.offset += fmt.size
+        return value
+
+    def take(self, length):
+        if self.offset + length > self.end:
+            raise ValueError("Truncated snapshot record")
+        data = self.buffer[self.offset:self.offset + length]
+        self.offset += length
+        return data
+
+    def string(self):
+        length = self.unpack(STRING)
+        if length == NONE_STRING:
+            return None
+        return self.take(length).decode('utf-8')
+
+    def blob(self):
+        length = self.unpack(BLOB)
+        if length == NONE_BLOB:
+            return None
+        return self.take(length)
+
+    def count(self):
+        return self.unpack(STRING)
+
+    def number(self):
+        value = self.unpack(BLOB)
+        return None if value == NONE_BLOB else value
+
+
+def encode_device(encoder, root, expires):
+    encoder.string(root.usn)
+    encoder.string(root.location)
+    encoder.parts.append(EXPIRES.pack(expires))
+    subdevices = list(root.subdevices.values())[:NONE_STRING - 1]
+    encoder.count(len(subdevices))
+    for sub in subdevices:
+        encoder.string(sub.usn)
+        # most subdevices share the description of their root
+        encoder.string(None if sub.location == root.location else sub.location)
+    return encoder.record(DEVICE)
+
+
+def decode_device(decoder, now):
+    # returns the root device with its subdevices and its remaining max-age
+    usn = decoder.string()
+    location = decoder.string()
+    max_age = int(decoder.unpack(EXPIRES) - now)
+    root = SSDPDevice(usn, location, max_age)
+    for _ in range(decoder.count()):
+        sub_usn = decoder.string()
+        sub_location = decoder.string()
+        root.subdevices[sub_usn] = SSDPDevice(
+            sub_usn, location if sub_location is None else sub_location, max_age)
+    return root
+
+
+def encode_metadata(encoder, location, value):
+    desc, icon, validators = value
+    encoder.string(location)
+    for field in DESCRIPTION_FIELDS:
+        encoder.string(desc.get(field))
+    extra = desc['extra'] or ()
+    encoder.count(len(extra))
+    for tag, text in extra:
+        encoder.string(tag)
+        encoder.string(text)
+    for records in (desc['icons'], desc['services']):
+        encoder.count(len(records))
+        for record in records:
+            for item in record:
+                encoder.string(item)
+    for validator in validators or (None, None):
+        etag, last_modified = validator or (None, None)
+        encoder.string(etag)
+        encoder.string(last_modified)
+    encoder.blob(icon)
+    return encoder.record(METADATA)
+
+
+def decode_metadata(decoder):
+    # returns (description, icon, validators) like a metadata cache entry
+    values = {field: decoder.string() for field in DESCRIPTION_FIELDS}
+    values['extra'] = tuple(
+        (decoder.string(), decoder.string())
+        for _ in range(decoder.count())) or None
+    records = []
+    for cls in (Icon, Service):
+        records.append(tuple(
+            cls(dict(zip(cls.fields, (decoder.string() for _ in cls.fields))))
+            for _ in range(decoder.count())))
+    values['icons'], values['services'] = records
+    if values['icons']:
+        values['icon'] = values['icons'][0]
+
+    validators = []
+    for _ in range(2):
+        etag, last_modified = decoder.string(), decoder.string()
+        validators.append(
+            None if etag is None and last_modified is None
+            else (etag, last_modified))
+    icon = decoder.blob()
+    return DeviceDescription(values), icon, tuple(validators)
+
+
+class Snapshot():
+
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.epoch = None
+        self.seq = 0
+        self.devices = []  # root SSDPDevices with their remaining max-age
+        self.expired = []  # root SSDPDevices that expired while not running
+        self.offsets = {}  # location -> (start, end) of its metadata record
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < HEADER.size:
+                    return False
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError as e:
+            logger.info("No snapshot loaded from %s: %s", self.path, e)
+            return False
+
+        try:
+            magic, self.seq = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                raise ValueError("Not a snapshot")
+            decoder = Decoder(self.map, HEADER.size, len(self.map))
+            self.epoch = decoder.string()
+
+            now = time.time()
+            offset = decoder.offset
+            while offset + RECORD.size <= len(self.map):
+                type, length = RECORD.unpack_from(self.map, offset)
+                start = offset + RECORD.size
+                end = start + length
+                if end > len(self.map):
+                    break  # cut off while written, keep what is complete
+                decoder = Decoder(self.map, start, end)
+                if type == DEVICE:
+                    device = decode_device(decoder, now)
+                    if device.max_age > 0:
+                        self.devices.append(device)
+                    else:
+                        self.expired.append(device)
+                elif type == METADATA:
+                    location = decoder.string()
+                    self.offsets[location] = (decoder.offset, end)
+                offset = end
+        except (ValueError, UnicodeDecodeError) as e:
+            logger.warning("Ignoring snapshot %s: %s", self.path, e)
+            self.close()
+            self.devices = []
+            self.expired = []
+            self.offsets = {}
+            return False
+        return True
+
+    def locations(self):
+        return list(self.offsets)
+
+    def metadata(self, location):
+        offsets = self.offsets.get(location)
+        if offsets is None or self.map is None:
+            return None
+        try:
+            return decode_metadata(Decoder(self.map, *offsets))
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+def write_snapshot(path, epoch, seq, devices, metadata):
+    # devices are (root, expiry as wall clock time), metadata (location,
+    # value). Written to a temporary file first, so a crash never leaves a
+    # half written snapshot behind.
+    encoder = Encoder()
+    encoder.string(epoch)
+    header = HEADER.pack(MAGIC, seq) + b''.join(encoder.parts)
+    encoder.parts = []
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        for root, expires in devices:
+            f.write(encode_device(encoder, root, expires))
+        for location, value in metadata:
+            f.write(encode_metadata(encoder, location, value))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
@@ -5,57 +5,500 @@ import struct
 import asyncio
 import logging
 import errno
+import random
+import sys
+import time
+import types
+import urllib.parse
+from uuid import UUID
+import zlib
+
+from metrics import METRICS
 
 logger = logging.getLogger('ssdp')
 
+DATAGRAMS_RECEIVED = METRICS.counter(
+    'upnpy_ssdp_datagrams_received_total',
+    'SSDP datagrams received, by method.', ('method',))
+DATAGRAMS_SENT = METRICS.counter(
+    'upnpy_ssdp_datagrams_sent_total',
+    'SSDP datagrams sent, by method.', ('method',))
+HANDLE_SECONDS = METRICS.histogram(
+    'upnpy_ssdp_handle_seconds',
+    'Time spent parsing and handling a received SSDP datagram, '
+    'sampled every HANDLE_SAMPLE datagrams of a method.')
+HANDLE_SAMPLE = 64  # a power of two
+
+RECEIVED_NOTIFY = DATAGRAMS_RECEIVED.cell(('NOTIFY',))
+RECEIVED_SEARCH = DATAGRAMS_RECEIVED.cell(('M-SEARCH',))
+RECEIVED_RESPONSE = DATAGRAMS_RECEIVED.cell(('RESPONSE',))
+RECEIVED_OTHER = DATAGRAMS_RECEIVED.cell(('OTHER',))
+
+# counter of a sent datagram by its first byte
+SENT_METHODS = {
+    ord('N'): DATAGRAMS_SENT.cell(('NOTIFY',)),
+    ord('M'): DATAGRAMS_SENT.cell(('M-SEARCH',)),
+    ord('H'): DATAGRAMS_SENT.cell(('RESPONSE',)),
+}
+SENT_OTHER = DATAGRAMS_SENT.cell(('OTHER',))
+
 MULTICAST_ADDRESS = '239.255.255.250'
 MULTICAST_PORT = 1900
 
+MAX_MX = 5  # UPnP 1.1: larger MX values are treated as 5
+ANNOUNCE_MAX_AGE = 3600
+MAX_MAX_AGE = 86400  # longer max-ages received are cut to a day
+ANY_ADDRESS = '0.0.0.0'
+
+
+def parse_max_age(cache_control):
+    if not cache_control:
+        return None
+    for directive in cache_control.split(','):
+        key, _, value = directive.partition('=')
+        if key.strip().lower() == 'max-age':
+            try:
+                max_age = int(value.strip().strip('"'))
+            except ValueError:
+                return None
+            # negative ages are ignored, huge ones would overflow records
+            return min(max_age, MAX_MAX_AGE) if max_age >= 0 else None
+    return None
+
+
+def usn_target(usn):
+    _, sep, target = usn.partition('::')
+    return target if sep else usn
+
+
+def target_matches(target, search_target):
+    return search_target == 'ssdp:all' or search_target == target
+
+
+def usn_shard(usn, count):
+    # the same for every usn of a device and in every process
+    return zlib.crc32(usn.partition('::')[0].encode('utf-8')) % count
+
+
+def interface_location(location, address):
+    # a location on the unspecified address, served on every interface,
+    # with the address of the interface it is announced on
+    if not location or not address:
+        return location
+    url = urllib.parse.urlsplit(location)
+    if url.hostname != ANY_ADDRESS:
+        return location
+    netloc = address if url.port is None else f'{address}:{url.port}'
+    return urllib.parse.urlunsplit(url._replace(netloc=netloc))
+
+
+def pack_uuid(value):
+    # 16 bytes for canonical uuids, anything else is kept as it is
+    try:
+        packed = UUID(value)
+    except ValueError:
+        return value
+    return packed.bytes if str(packed) == value else value
+
+
+def unpack_uuid(value):
+    return str(UUID(bytes=value)) if isinstance(value, bytes) else value
+
+
+def header_key(name):
+    return (b'\n' + name.upper() + b':', b'\n' + name.lower() + b':')
+
+
+USN = header_key(b'usn')
+LOCATION = header_key(b'location')
+NT = header_key(b'nt')
+NTS = header_key(b'nts')
+ST = header_key(b'st')
+MX = header_key(b'mx')
+CACHE_CONTROL = header_key(b'cache-control')
+
+
+class SSDPMessage():
+
+    __slots__ = ('data', 'lower', 'headers')
+
+    def __init__(self, data):
+        self.data = data
+        self.lower = None
+        self.headers = None
+
+    def header(self, key):
+        data = self.data
+        upper, lower = key
+        start = data.find(upper)
+        if start < 0:
+            # header names are case-insensitive, but usually uppercase
+            if self.lower is None:
+                self.lower = data.lower()
+            start = self.lower.find(lower)
+            if start < 0:
+                return self.parse_headers().get(lower[1:-1])
+        start += len(upper)
+        end = data.find(b'\n', start)
+        if end < 0:
+            end = len(data)
+        return data[start:end].strip().decode('utf-8', 'replace')
+
+    def parse_headers(self):
+        # line by line, for the rare names with blanks before the colon
+        if self.headers is None:
+            self.headers = {}
+            for line in self.data.split(b'\n')[1:]:
+                name, sep, value = line.partition(b':')
+                if sep:
+                    self.headers[name.strip().lower()] = (
+                        value.strip().decode('utf-8', 'replace'))
+        return self.headers
+
 
 class SSDPDevice():
+    # Compact record of one usn: the uuid is packed into 16 bytes and the
+    # target, usually a type urn shared by many devices, is interned. Only
+    # root usns get their own subdevices dict.
 
-    def __init__(self, usn, location):
+    __slots__ = ('usn', 'location', 'max_age', 'subdevices', '_uuid', '_target')
+
+    def __init__(self, usn, location, max_age=None):
         self.usn = usn
         self.location = location
+        self.max_age = max_age
 
-        self.subdevices = []
+        root, sep, target = usn.partition('::')
+        self.subdevices = NO_SUBDEVICES if sep else {}  # usn -> SSDPDevice
+        self._target = sys.intern(target) if sep else usn
+        parts = root.split(':', 2)
+        self._uuid = pack_uuid(parts[1]) if len(parts) > 1 else usn
 
     def uuid(self):
-        try:
-            return self.usn.split(':')[1]
-        except IndexError:
-            return self.usn
+        return unpack_uuid(self._uuid)
 
     def target(self):
-        try:
-            return self.usn.split('::')[1]
-        except IndexError:
-            return self.usn
+        return self._target
 
     def matches_target(self, search_target):
-        return search_target == 'ssdp:all' or search_target == self.target()
+        return target_matches(self._target, search_target)
+
+
+NO_SUBDEVICES = types.MappingProxyType({})
+
+
+def notify_message(device, notify_type, max_age=ANNOUNCE_MAX_AGE, location=None):
+    return (
+        "NOTIFY * HTTP/1.1\r\n"
+        "HOST: 239.255.255.250:1900\r\n"
+        "CACHE-CONTROL: max-age={max_age}\r\n"
+        "LOCATION: {loc}\r\n"
+        "NT: {nt}\r\n"
+        "NTS: {nts}\r\n"
+        "SERVER: 'Linux UPnP/1.0 upnpy/0.1'\r\n"
+        "USN: {usn}\r\n"
+        "\r\n"
+    ).format(loc=location or device.location, nt=device.target(), nts=notify_type,
+        usn=device.usn, max_age=max_age).encode('utf-8')
+
+
+def search_message(search_target, max_delay):
+    return (
+        "M-SEARCH * HTTP/1.1\r\n"
+        "HOST: 239.255.255.250:1900\r\n"
+        'MAN: "ssdp:discover"\r\n'
+        "ST: {st}\r\n"
+        "MX: {mx}\r\n"
+        "\r\n"
+    ).format(st=search_target, mx=max_delay).encode('utf-8')
+
+
+def search_response_message(device, search_target, max_age=ANNOUNCE_MAX_AGE,
+                            location=None):
+    return (
+        "HTTP/1.1 200 OK\r\n"
+        "CACHE-CONTROL: max-age={max_age}\r\n"
+        "LOCATION: {loc}\r\n"
+        "SERVER: 'Linux UPnP/1.0 upnpy/0.1'\r\n"
+        "ST: {st}\r\n"
+        "USN: {usn}\r\n"
+        "\r\n"
+    ).format(loc=location or device.location, st=search_target,
+        usn=device.usn, max_age=max_age).encode('utf-8')
+
+
+class DeviceTemplates():
+    # pre-encoded messages of an announced device, built once per interface
+
+    __slots__ = ('device', 'max_age', 'notify', 'responses')
+
+    def __init__(self, device, max_age=ANNOUNCE_MAX_AGE, address=None):
+        self.device = device
+        self.max_age = max_age
+        location = interface_location(device.location, address)
+        self.notify = {
+            nts: notify_message(device, nts, max_age, location)
+            for nts in ('ssdp:alive', 'ssdp:byebye')
+        }
+        self.responses = {
+            st: search_response_message(device, st, max_age, location)
+            for st in ('ssdp:all', device.target())
+        }
+
+
+class AliveAnnouncer():
+    # Re-sends ssdp:alive for every announced device at a fraction of its
+    # max-age. First announcements are paced at max_rate devices per second
+    # and the periodic ones are spread randomly over the interval, so many
+    # devices never cause a multicast spike. Each announcement is a burst
+    # of `repeat` copies, `spacing` seconds apart.
+
+    def __init__(self, protocol, fraction=0.4, repeat=2, spacing=0.1,
+                 max_rate=50):
+        self.protocol = protocol
+        self.fraction = fraction
+        self.repeat = repeat
+        self.spacing = spacing
+        self.max_rate = max_rate
+
+        self.timers = {}  # usn -> TimerHandle of the next announcement
+        self.copies = {}  # id -> (TimerHandle, templates, notify type)
+        self.next_copy = 0
+        self.next_initial = 0
+        self.sent = 0
+
+    def add(self, templates):
+        loop = asyncio.get_running_loop()
+        self.cancel(templates.device.usn)
+
+        now = loop.time()
+        self.next_initial = max(now, self.next_initial)
+        delay = self.next_initial - now
+        self.next_initial += 1 / self.max_rate
+
+        self.timers[templates.device.usn] = loop.call_later(
+            delay, self.announce, templates, True)
+
+    def cancel(self, usn):
+        timer = self.timers.pop(usn, None)
+        if timer is not None:
+            timer.cancel()
+
+    def announce(self, templates, first=False):
+        loop = asyncio.get_running_loop()
+        interval = templates.max_age * self.fraction
+        if first:
+            delay = random.uniform(0, interval)
+        else:
+            delay = interval * random.uniform(0.95, 1.05)
+        self.timers[templates.device.usn] = loop.call_later(
+            delay, self.announce, templates)
+
+        self.send_burst(templates, 'ssdp:alive')
+
+    def send_burst(self, templates, notify_type):
+        loop = asyncio.get_running_loop()
+        self.send(templates, notify_type)
+        for i in range(1, self.repeat):
+            self.next_copy += 1
+            handle = loop.call_later(i * self.spacing, self.send_copy,
+                                     self.next_copy)
+            self.copies[self.next_copy] = (handle, templates, notify_type)
+
+    def send_copy(self, copy):
+        _, templates, notify_type = self.copies.pop(copy)
+        self.send(templates, notify_type)
+
+    def send(self, templates, notify_type):
+        # an alive copy must not follow the byebye of a removed device
+        current = self.protocol.templates.get(templates.device.usn)
+        if notify_type == 'ssdp:alive' and current is not templates:
+            return
+        self.sent += 1
+        self.protocol.send(templates.notify[notify_type],
+                           (MULTICAST_ADDRESS, MULTICAST_PORT))
+
+    def close(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        # byebye copies are sent at once while the transport is still open
+        transport = self.protocol.transport
+        flush = transport is not None and not transport.is_closing()
+        for handle, templates, notify_type in self.copies.values():
+            handle.cancel()
+            if flush and notify_type == 'ssdp:byebye':
+                self.send(templates, notify_type)
+        self.copies.clear()
+
+
+class TokenBucket():
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, n, now):
+        # returns how many of the n tokens could be taken
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        taken = min(n, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+
+class SearchResponseScheduler():
+    # Answers a search with all of its responses, sent in batches at random
+    # times in [0, MX]. Repeated searches of a requester are merged while
+    # their responses are pending, and the searches answered for each source
+    # address are rate limited, so a search is answered fully or not at all.
+
+    def __init__(self, protocol, rate=20, burst=40, max_pending=1024,
+                 max_buckets=4096, batch=16):
+        self.protocol = protocol
+        self.rate = rate  # searches per second and source address
+        self.burst = burst
+        self.max_pending = max_pending
+        self.max_buckets = max_buckets
+        self.batch = batch  # responses sent at the same time
+
+        self.pending = {}  # (addr, st) -> {batch start: TimerHandle}
+        self.buckets = {}  # host -> TokenBucket
+
+        self.scheduled = 0
+        self.merged = 0
+        self.sent = 0
+        self.dropped_overflow = 0
+        self.dropped_rate_limit = 0  # searches
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    def schedule(self, addr, st, mx):
+        key = (addr, st)
+        if key in self.pending:
+            self.merged += 1
+            return
+        if len(self.pending) >= self.max_pending:
+            self.dropped_overflow += 1
+            return
+        matching = self.protocol.search_templates(st)
+        if not matching:
+            return
+        if not self.bucket(addr[0]).take(1, time.monotonic()):
+            self.dropped_rate_limit += 1
+            return
+
+        loop = asyncio.get_running_loop()
+        handles = self.pending[key] = {}
+        for i in range(0, len(matching), self.batch):
+            delay = random.uniform(0, mx) if mx > 0 else 0
+            handles[i] = loop.call_later(delay, self.respond, key, i,
+                                         matching[i:i + self.batch])
+        self.scheduled += 1
+
+    def respond(self, key, start, matching):
+        handles = self.pending[key]
+        del handles[start]
+        if not handles:
+            del self.pending[key]
+
+        # devices removed since the search are not answered for
+        addr, st = key
+        current = self.protocol.templates
+        datagrams = [templates.responses[st] for templates in matching
+                     if current.get(templates.device.usn) is templates]
+        if datagrams:
+            self.sent += len(datagrams)
+            self.protocol.send_batch(datagrams, addr)
+
+    def bucket(self, host):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            now = time.monotonic()
+            if len(self.buckets) >= self.max_buckets:
+                # forget sources whose bucket has refilled anyway
+                self.buckets = {
+                    h: b for h, b in self.buckets.items()
+                    if b.tokens + (now - b.updated) * b.rate < b.capacity
+                }
+            bucket = TokenBucket(self.rate, self.burst, now)
+            self.buckets[host] = bucket
+        return bucket
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'scheduled': self.scheduled,
+            'merged': self.merged,
+            'sent': self.sent,
+            'dropped_overflow': self.dropped_overflow,
+            'dropped_rate_limit': self.dropped_rate_limit,
+        }
+
+    def close(self):
+        for handles in self.pending.values():
+            for handle in handles.values():
+                handle.cancel()
+        self.pending.clear()
 
 
 class SimpleServiceDiscoveryProtocol(asyncio.DatagramProtocol):
 
-    def __init__(self, device_callback=None, filter=None):
+    def __init__(self, device_callback=None, filter=None, byebye_callback=None,
+                 refresh_callback=None, schedule_responses=True,
+                 max_age=ANNOUNCE_MAX_AGE, address=None):
         self.device_callback = device_callback or (lambda _: None)
-        self.local_devices = []
+        self.byebye_callback = byebye_callback or (lambda _: None)
+        # returns True for already known usns, which are then not processed
+        self.refresh_callback = refresh_callback or (lambda usn, max_age: False)
+        self.local_devices = {}  # usn -> SSDPDevice
+        self.templates = {}  # usn -> DeviceTemplates of announced devices
+        self.targets = {}  # target -> {usn: DeviceTemplates}
+        self.search_messages = {}
         self.filter = filter  # filtering off
-
+        self.transport = None
+        self.sock = None
+        self.scheduler = (
+            SearchResponseScheduler(self) if schedule_responses else None)
+        self.max_age = max_age
+        self.address = address  # of the interface announced devices are on
+        self.announcer = AliveAnnouncer(self)
+
+        # start line -> (handler, received counter)
         self.handlers = {
-            'NOTIFY * HTTP/1.1': self.handle_notify,
-            'M-SEARCH * HTTP/1.1': self.handle_search,
-            'HTTP/1.1 200 OK': self.handle_search_response,
+            b'NOTIFY * HTTP/1.1': (self.handle_notify, RECEIVED_NOTIFY),
+            b'M-SEARCH * HTTP/1.1': (self.handle_search, RECEIVED_SEARCH),
+            b'HTTP/1.1 200 OK': (self.handle_search_response, RECEIVED_RESPONSE),
         }
 
     def announce_device(self, device):
-        self.local_devices.append(device)
-        self.send_notify(device, notify_type='ssdp:alive')
+        self.local_devices[device.usn] = device
+        templates = DeviceTemplates(device, self.max_age, self.address)
+        self.templates[device.usn] = templates
+        self.targets.setdefault(device.target(), {})[device.usn] = templates
+        self.announcer.add(templates)
 
     def remove_device(self, device):
-        self.local_devices.remove(device)
-        self.send_notify(device, notify_type='ssdp:byebye')
+        if self.local_devices.get(device.usn) is not device:
+            return
+        del self.local_devices[device.usn]
+        templates = self.templates.pop(device.usn)
+        self.announcer.cancel(device.usn)
+
+        target = device.target()
+        indexed = self.targets[target]
+        del indexed[device.usn]
+        if not indexed:
+            del self.targets[target]
+
+        self.announcer.send_burst(templates, 'ssdp:byebye')
 
     def search_devices(self):
         if self.filter is None:
@@ -65,104 +508,176 @@ class SimpleServiceDiscoveryProtocol(asyncio.DatagramProtocol):
 
     def connection_made(self, transport):
         self.transport = transport
+        sock = transport.get_extra_info('socket')
+        # a duplicate of the transport's socket for sending batches directly
+        self.sock = sock.dup() if sock is not None else None
+
+    def close(self):
+        # closes the announcer first, so that it can still say byebye
+        self.announcer.close()
+        if self.transport is not None:
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.announcer.close()
+        if self.scheduler is not None:
+            self.scheduler.close()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
 
     def send(self, data, addr):
-        logger.debug("%s:%s < \"%s\"", *(addr + (data,)))
-        self.transport.sendto(data.encode('utf-8'), addr)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s:%s < \"%s\"", *(addr + (data.decode('utf-8', 'replace'),)))
+        SENT_METHODS.get(data[0], SENT_OTHER)[0] += 1
+        self.transport.sendto(data, addr)
+
+    def send_batch(self, datagrams, addr):
+        # Sends straight on the socket while the transport has nothing
+        # buffered, and hands the rest to the transport once it would block.
+        if logger.isEnabledFor(logging.DEBUG):
+            for data in datagrams:
+                logger.debug("%s:%s < \"%s\"", *(addr + (data.decode('utf-8', 'replace'),)))
+        SENT_METHODS[ord('H')][0] += len(datagrams)
+
+        sock = self.sock
+        if sock is None or self.transport.get_write_buffer_size():
+            for data in datagrams:
+                self.transport.sendto(data, addr)
+            return
+
+        for i, data in enumerate(datagrams):
+            try:
+                sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                for data in datagrams[i:]:
+                    self.transport.sendto(data, addr)
+                return
+            except OSError as exc:
+                # also called from timers, where raising would only be logged
+                logger.warning("Cannot send to %s:%s: %s", *addr, exc)
+                return
 
     def send_notify(self, device, notify_type='ssdp:alive'):
-        data = (
-            "NOTIFY * HTTP/1.1\r\n"
-            "HOST: 239.255.255.250:1900\r\n"
-            "CACHE-CONTROL: max-age=3600\r\n"
-            "LOCATION: {loc}\r\n"
-            "NT: {nt}\r\n"
-            "NTS: {nts}\r\n"
-            "SERVER: 'Linux UPnP/1.0 upnpy/0.1'\r\n"
-            "USN: {usn}\r\n"
-            "\r\n"
-        ).format(loc=device.location, nt=device.target(), nts=notify_type,
-            usn=device.usn)
+        templates = self.templates.get(device.usn)
+        if templates is not None and templates.device is device:
+            data = templates.notify[notify_type]
+        else:
+            data = notify_message(device, notify_type, self.max_age,
+                                  interface_location(device.location, self.address))
 
         addr = (MULTICAST_ADDRESS, MULTICAST_PORT)
         self.send(data, addr)
 
     def send_search(self, search_target='ssdp:all', max_delay=2):
-        data = (
-            "M-SEARCH * HTTP/1.1\r\n"
-            "HOST: 239.255.255.250:1900\r\n"
-            'MAN: "ssdp:discover"\r\n'
-            "ST: {st}\r\n"
-            "MX: {mx}\r\n"
-            "\r\n"
-        ).format(st=search_target, mx=max_delay)
+        data = self.search_messages.get((search_target, max_delay))
+        if data is None:
+            data = search_message(search_target, max_delay)
+            self.search_messages[(search_target, max_delay)] = data
 
         addr = (MULTICAST_ADDRESS, MULTICAST_PORT)
         self.send(data, addr)
 
     def send_search_response(self, device, addr, search_target='ssdp:all'):
-        data = (
-            "HTTP/1.1 200 OK\r\n"
-            "CACHE-CONTROL: max-age=3600\r\n"
-            "LOCATION: {loc}\r\n"
-            "SERVER: 'Linux UPnP/1.0 upnpy/0.1'\r\n"
-            "ST: {st}\r\n"
-            "USN: {usn}\r\n"
-            "\r\n"
-        ).format(loc=device.location, st=search_target, usn=device.usn)
+        templates = self.templates.get(device.usn)
+        if templates is not None and search_target in templates.responses:
+            data = templates.responses[search_target]
+        else:
+            data = search_response_message(
+                device, search_target,
+                location=interface_location(device.location, self.address))
 
         self.send(data, addr)
 
     def datagram_received(self, data, addr):
-        data = data.decode()
-        logger.debug("%s:%s > \"%s\"", *(addr + (data,)))
-        data = data.splitlines()
+        # Works on the raw datagram: the start line is checked first and
+        # only the headers a handler asks for are sliced out and decoded.
+        end = data.find(b'\n')
+        entry = self.handlers.get(data[:end].rstrip() if end >= 0 else data)
+        if entry is None:
+            RECEIVED_OTHER[0] += 1
+            return
+
+        handler, received = entry
+        received[0] += 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s:%s > \"%s\"", *(addr + (data.decode('utf-8', 'replace'),)))
 
-        if len(data) < 1 or data[0] not in self.handlers.keys():
+        if received[0] & (HANDLE_SAMPLE - 1):
+            handler(SSDPMessage(data), addr)
             return
+        start = time.perf_counter()
+        handler(SSDPMessage(data), addr)
+        HANDLE_SECONDS.observe_since(start)
 
-        headers = {
-            p[0].strip().lower(): p[1].strip()
-            for p in (
-                line.split(':', 1) for line in data[1:]
-                if line and ':' in line
-            )
-        }
+    def handle_notify(self, message, addr):
+        usn = message.header(USN)
+        if not usn:
+            return
+        if self.filter and not target_matches(usn_target(usn), self.filter):
+            return
 
-        method = data[0]
-        self.handlers[method](headers, addr)
-
-    def handle_notify(self, data, addr):
-        logger.debug("NOTIFY")
-        nts = data.get('nts')
-
-        usn = data.get('usn')
-        root_desc = data.get('location')
-        device = SSDPDevice(usn, root_desc)
-        
-        if not self.filter or device.matches_target(self.filter):
-            if nts == 'ssdp:alive':
-                self.device_callback(device)
-            else:
-                # TODO implement ssdp:byebye
-                logger.info("Notify byebye %s", device.usn)
-
-    def handle_search(self, data, addr):
-        logger.debug("SEARCH")
-        for device in self.local_devices:
-            if 'st' not in data or not self.filter:
-                self.send_search_response(device, addr)
-            elif device.matches_target(data['st']):
-                self.send_search_response(
-                    device, addr, search_target=data['st'])
-
-    def handle_search_response(self, data, addr):
-        logger.debug("SEARCH RESPONSE")
-        usn = data.get('usn')
-        root_desc = data.get('location')
-        device = SSDPDevice(usn, root_desc)
-        if not self.filter or device.matches_target(self.filter):
+        nts = message.header(NTS)
+        if nts == 'ssdp:alive':
+            max_age = parse_max_age(message.header(CACHE_CONTROL))
+            if self.refresh_callback(usn, max_age):
+                return
+            device = SSDPDevice(usn, message.header(LOCATION), max_age)
             self.device_callback(device)
+        elif nts == 'ssdp:byebye':
+            logger.info("Notify byebye %s", usn)
+            self.byebye_callback(SSDPDevice(usn, None))
+
+    def handle_search(self, message, addr):
+        if not self.templates:
+            return
+
+        st = message.header(ST)
+        if st is None or not self.filter:
+            st = 'ssdp:all'
+        elif st != 'ssdp:all' and st not in self.targets:
+            return
+
+        if self.scheduler is None:
+            self.send_search_responses(st, addr)
+            return
+
+        mx = message.header(MX)
+        try:
+            mx = min(int(mx), MAX_MX) if mx is not None else 0
+        except ValueError:
+            mx = 1
+        self.scheduler.schedule(addr, st, mx)
+
+    def search_templates(self, st):
+        if st == 'ssdp:all':
+            return list(self.templates.values())
+        return list(self.targets.get(st, {}).values())
+
+    def search_responses(self, st):
+        return [templates.responses[st]
+                for templates in self.search_templates(st)]
+
+    def send_search_responses(self, st, addr):
+        datagrams = self.search_responses(st)
+        if datagrams:
+            self.send_batch(datagrams, addr)
+
+    def handle_search_response(self, message, addr):
+        usn = message.header(USN)
+        if not usn:
+            return
+        if self.filter and not target_matches(usn_target(usn), self.filter):
+            return
+
+        max_age = parse_max_age(message.header(CACHE_CONTROL))
+        if self.refresh_callback(usn, max_age):
+            return
+
+        device = SSDPDevice(usn, message.header(LOCATION), max_age)
+        self.device_callback(device)
 
     def error_received(self, exc):
         if exc == errno.EAGAIN or exc == errno.EWOULDBLOCK:
@@ -0,0 +1,49 @@
+import asyncio
+import unittest
+
+from cache import MetadataCache
+
+
+class GetOrFetchTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_cancelled_caller_does_not_cancel_the_others(self):
+        cache = MetadataCache()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return {'friendlyName': 'x'}, None
+
+        callers = [asyncio.ensure_future(cache.get_or_fetch('key', fetch))
+                   for _ in range(3)]
+        await asyncio.sleep(0.01)
+        callers[0].cancel()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+
+        self.assertIsInstance(results[0], asyncio.CancelledError)
+        self.assertEqual(results[1], ({'friendlyName': 'x'}, None))
+        self.assertEqual(results[2], ({'friendlyName': 'x'}, None))
+        self.assertEqual(calls, 1)
+        self.assertEqual(cache.coalesced, 2)
+        self.assertEqual(cache.inflight, {})
+        self.assertEqual(cache.get('key'), ({'friendlyName': 'x'}, None))
+
+    async def test_failed_fetch_with_no_callers_left(self):
+        cache = MetadataCache()
+
+        async def fetch():
+            await asyncio.sleep(0.02)
+            raise OSError('unreachable')
+
+        caller = asyncio.ensure_future(cache.get_or_fetch('key', fetch))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        await asyncio.sleep(0.05)
+        self.assertEqual(cache.inflight, {})
+        self.assertNotIn('key', cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+
+from scpd import ConnectionPool, MetadataClient
+
+
+class ConnectionPoolTest(unittest.IsolatedAsyncioTestCase):
+
+    async def start_server(self, handler):
+        server = await asyncio.start_server(handler, '127.0.0.1', 0)
+        self.addAsyncCleanup(self.stop_server, server)
+        return server.sockets[0].getsockname()[1]
+
+    async def stop_server(self, server):
+        server.close()
+        await server.wait_closed()
+
+    async def test_silent_peers_do_not_hold_the_pool(self):
+        async def silent(reader, writer):
+            await reader.read()
+            writer.close()
+
+        async def ok(reader, writer):
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+            await writer.drain()
+
+        silent_port = await self.start_server(silent)
+        ok_port = await self.start_server(ok)
+        pool = ConnectionPool(max_connections=4)
+        self.addCleanup(pool.close)
+
+        stuck = [
+            asyncio.ensure_future(MetadataClient(
+                f'http://127.0.0.1:{silent_port}/desc.xml', pool=pool,
+                timeout=0.3).request())
+            for _ in range(4)
+        ]
+        await asyncio.sleep(0.05)
+        self.assertEqual(pool.limit._value, 0)
+
+        client = MetadataClient(f'http://127.0.0.1:{ok_port}/desc.xml',
+                                pool=pool, timeout=0.3)
+        data = await asyncio.wait_for(client.fetch_icon(), 2)
+        self.assertEqual(bytes(data), b'ok')
+
+        results = await asyncio.gather(*stuck, return_exceptions=True)
+        for result in results:
+            self.assertIsInstance(result, asyncio.TimeoutError)
+        self.assertEqual(pool.limit._value, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import asyncio
+import time
+import unittest
+
+from ssdp import SimpleServiceDiscoveryProtocol, SSDPDevice
+
+SEARCH = (b'M-SEARCH * HTTP/1.1\r\n'
+          b'HOST: 239.255.255.250:1900\r\n'
+          b'MAN: "ssdp:discover"\r\n'
+          b'ST: ssdp:all\r\n'
+          b'MX: 1\r\n\r\n')
+
+
+class RecordingTransport(asyncio.DatagramTransport):
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []  # (time, addr)
+
+    def sendto(self, data, addr=None):
+        self.sent.append((time.monotonic(), addr))
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class SearchResponseTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.protocol = SimpleServiceDiscoveryProtocol(address='127.0.0.1')
+        self.transport = RecordingTransport()
+        self.protocol.connection_made(self.transport)
+        for i in range(100):
+            root = f'uuid:{i:08d}-0000-0000-0000-000000000000'
+            for usn in (root + '::upnp:rootdevice', root,
+                        root + '::urn:schemas-upnp-org:device:Basic:1'):
+                self.protocol.announce_device(
+                    SSDPDevice(usn, 'http://127.0.0.1:1/desc.xml'))
+        self.protocol.announcer.close()
+        self.transport.sent.clear()
+
+    async def asyncTearDown(self):
+        self.protocol.close()
+
+    async def test_search_answered_fully_within_mx(self):
+        start = time.monotonic()
+        self.protocol.datagram_received(SEARCH, ('127.0.0.1', 5000))
+        await asyncio.sleep(1.2)
+
+        times = [t for t, _ in self.transport.sent]
+        self.assertEqual(len(times), 300)
+        self.assertLessEqual(max(times) - start, 1.1)
+        # spread over the window instead of sent in one burst
+        self.assertGreater(max(times) - min(times), 0.1)
+
+    async def test_searches_rate_limited_per_source(self):
+        scheduler = self.protocol.scheduler
+        scheduler.rate = 0.01  # no refill while the searches arrive
+        for port in range(scheduler.burst + 10):
+            self.protocol.datagram_received(SEARCH, ('127.0.0.2', 6000 + port))
+        self.protocol.datagram_received(SEARCH, ('127.0.0.3', 5000))
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['scheduled'], scheduler.burst + 1)
+        self.assertEqual(stats['dropped_rate_limit'], 10)
+
+    async def test_repeated_search_merged(self):
+        for _ in range(3):
+            self.protocol.datagram_received(SEARCH, ('127.0.0.1', 5000))
+        await asyncio.sleep(1.2)
+
+        self.assertEqual(self.protocol.scheduler.merged, 2)
+        self.assertEqual(len(self.transport.sent), 300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import asyncio
+import unittest
+
+from ssdp import SSDPDevice
+from upnpy import UPnPy
+
+
+class RecordingListener():
+
+    properties = False
+
+    def __init__(self):
+        self.events = []
+
+    def matches(self, device):
+        return True
+
+    def offer(self, event):
+        self.events.append(('GONE' if event.gone else 'DEVICE', event.seq))
+        return True
+
+    def close(self):
+        pass
+
+
+class DeviceEventTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.upnpy = UPnPy()
+        self.listener = RecordingListener()
+        self.upnpy.listeners.append(self.listener)
+
+        async def slow_fetch(location, max_age=None):
+            await asyncio.sleep(0.05)
+            return None, None
+        self.upnpy.get_desc_and_icon = slow_fetch
+
+    async def asyncTearDown(self):
+        await self.upnpy.close()
+
+    def alive(self):
+        device = SSDPDevice('uuid:aaaa::upnp:rootdevice',
+                            'http://127.0.0.1:1/desc.xml')
+        device.max_age = 1800
+        return device
+
+    async def test_byebye_during_fetch(self):
+        self.upnpy.on_new_device(self.alive())
+        self.upnpy.on_byebye(SSDPDevice('uuid:aaaa::upnp:rootdevice', None))
+        await asyncio.sleep(0.1)
+
+        self.assertEqual(self.listener.events, [('GONE', 2)])
+        self.assertEqual([(seq, gone) for seq, gone, _ in self.upnpy.events],
+                         [(1, False), (2, True)])
+
+    async def test_device_published_after_fetch(self):
+        self.upnpy.on_new_device(self.alive())
+        await asyncio.sleep(0.1)
+        self.upnpy.on_byebye(SSDPDevice('uuid:aaaa::upnp:rootdevice', None))
+
+        self.assertEqual(self.listener.events, [('DEVICE', 1), ('GONE', 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,37 +1,146 @@
-import argparse
 import asyncio
-import base64
+import collections
 import logging
 import os
-from pprint import pprint, pformat
-import socket
-import struct
 import sys
-import tempfile
+import time
 import urllib.parse
-import uuid
 
 from ssdp import SimpleServiceDiscoveryProtocol, SSDPDevice
-from ssdp import MULTICAST_ADDRESS, MULTICAST_PORT
+from ssdp import usn_target, target_matches
+from ssdp import ANY_ADDRESS
+from interfaces import InterfaceManager, list_interfaces, search_socket
 
-from scpd import MetadataServer, MetadataClient
+from scpd import MetadataServer, MetadataClient, ConnectionPool
 from scpd import ROOT_DESC_PATH
 
+from control import ControlClient, UPnPError, find_service, gather_calls
+from control import ACTION_FAILED, INVALID_ACTION
+from gena import EventSubscriber
+from cache import MetadataCache, IconStore, IconRef
+from registry import DeviceRegistry
+from listener import accept_listener, parse_cursor, Event, GET_ICON
+from listener import MAX_QUEUE, DROP_OLDEST, read_icon
+from snapshot import Snapshot, write_snapshot
+from metrics import METRICS
+
 logger = logging.getLogger('upnpy')
 
+METADATA_FETCHES = METRICS.counter(
+    'upnpy_metadata_fetches_total',
+    'Description fetches, by result.', ('result',))
+METADATA_FETCH_SECONDS = METRICS.histogram(
+    'upnpy_metadata_fetch_seconds',
+    'Time to fetch or revalidate a description and its icon.')
+
+
+def use_uvloop():
+    # installs uvloop's event loop policy, returns False if it is missing
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
 
 class UPnPy():
+    # Control point. Without a loop it attaches to the running one, so it
+    # can be created inside any asyncio application and run with start().
 
-    def __init__(self, loop):
+    def __init__(self, loop=None, icon_dir=None):
+        loop = loop or asyncio.get_running_loop()
         self.loop = loop
-        self.remote_devices = {}
-        self.desc_cache = {}
-        self.icon_cache = {}
+        self.registry = DeviceRegistry(loop, on_gone=self.on_device_gone)
+        # with an icon directory, fetched icons live in memory-mapped files
+        self.icon_store = IconStore(icon_dir) if icon_dir else None
+        self.metadata_cache = MetadataCache(on_evict=self.on_cache_evict)
         self.listeners = []
+        self.pool = ConnectionPool()
+        self.control = ControlClient(self.pool)
+
+        # found and gone devices are numbered, so listeners that reconnect
+        # with a cursor only receive what they missed while the log covers it
+        self.epoch = os.urandom(4).hex()
+        self.seq = 0
+        self.events = collections.deque(maxlen=4096)  # (seq, gone, device)
+        self.listener_queue = MAX_QUEUE
+        self.listener_policy = DROP_OLDEST
+
+        self.metrics = METRICS
+        self.add_metrics(METRICS)
+
+        self.snapshot = None  # loaded, until its descriptions are revalidated
+        self.checkpoint_seq = None
+
+        # subscriptions to the events of services, the callback server is
+        # started with the first
+        self.subscriber = EventSubscriber(self.on_properties, self.pool)
+        self.event_services = None  # subscribed to on every found device
+
+        self.interfaces = None  # InterfaceManager of the running deamon
+        self.interface_names = None  # all usable interfaces if None
+        self.tasks = []  # started by start()
 
         self.wait = 6
+        self.rounds = 3
+        self.quiet = 2.0
         self.filter = None
 
+    def add_metrics(self, metrics):
+        cache = self.metadata_cache
+        for key, help in (('entries', 'Descriptions in the metadata cache.'),
+                          ('bytes', 'Estimated size of the metadata cache.'),
+                          ('hits', 'Metadata cache hits.'),
+                          ('misses', 'Metadata cache misses.'),
+                          ('hit_rate', 'Share of metadata cache lookups that hit.')):
+            metrics.gauge(f'upnpy_metadata_cache_{key}', help,
+                          lambda key=key: cache.stats()[key])
+        metrics.gauge('upnpy_devices', 'Known root devices.',
+                      lambda: len(self.registry))
+        metrics.gauge('upnpy_listeners', 'Connected listeners.',
+                      lambda: len(self.listeners))
+        metrics.gauge('upnpy_event_subscriptions',
+                      'Subscriptions to the events of services.',
+                      lambda: len(self.subscriber))
+        metrics.gauge('upnpy_listener_queue_depth',
+                      'Events queued for each listener.',
+                      lambda: [((i,), len(listener.queue))
+                               for i, listener in enumerate(self.listeners)],
+                      labels=('listener',))
+        metrics.gauge('upnpy_listener_dropped_events',
+                      'Events dropped or coalesced for each slow listener.',
+                      lambda: [((i,), listener.dropped + listener.coalesced)
+                               for i, listener in enumerate(self.listeners)],
+                      labels=('listener',))
+
+    async def start(self, sock=None, search=True, deamon=True):
+        # Runs discovery in the background of the running loop: the SSDP
+        # deamon, a first search and, with a path, the listener socket.
+        # Found devices are in self.registry; stop with close().
+        coros = []
+        if deamon:
+            coros.append(self.run_ssdp_deamon(discover=True))
+        if search:
+            coros.append(self.discover())
+        if sock:
+            coros.append(self.run_unix_socket(sock))
+        self.tasks.extend(self.loop.create_task(coro) for coro in coros)
+        return self
+
+    async def close(self):
+        tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for listener in self.listeners[:]:
+            listener.close()
+        await self.subscriber.close()
+        self.registry.close()
+        self.pool.close()
+        if self.icon_store is not None:
+            self.icon_store.close()
+
     async def run_unix_socket(self, path):
         logger.info("Creating unix socket at %s", path)
         server = await asyncio.start_unix_server(
@@ -44,176 +153,491 @@ class UPnPy():
             os.remove(path)
 
     async def on_listener_connected(self, reader, writer):
-        logger.info("Listener connected")
-        self.listeners.append(writer)
+        listener, since = await accept_listener(
+            reader, writer, self.epoch,
+            max_queue=self.listener_queue, policy=self.listener_policy,
+            metrics=self.metrics)
+        if listener is None:
+            writer.close()
+            return
 
-        # TODO check if devices still up
-        for device in self.remote_devices.values():
-            await self.notify_listener(writer, device)
+        logger.info("Listener connected (%s)", listener.format)
+        self.listeners.append(listener)
+        listener.start(self.remove_listener)
+        if listener.binary:
+            self.loop.create_task(self.serve_listener(listener, reader))
+
+        await self.replay(listener, since)
 
         self.loop.create_task(self.discover())
 
-    def add_remote_device(self, device):
-        unique = False
-        parts = device.usn.split('::', 1)
-        if parts[0] not in self.remote_devices:
-            self.remote_devices[parts[0]] = SSDPDevice(parts[0], device.location)
-            unique = True
-        if len(parts) == 2 and not any(sub.usn == device.usn for sub in self.remote_devices[parts[0]].subdevices):
-            self.remote_devices[parts[0]].subdevices.append(device)
-        return unique
+    def add_event(self, device, gone=False):
+        self.seq += 1
+        self.events.append((self.seq, gone, device))
+        return self.seq
 
+    def events_since(self, cursor):
+        # returns the events after cursor, or None if they are not all known
+        epoch, seq = parse_cursor(cursor)
+        if epoch != self.epoch or seq > self.seq:
+            return None
+        if seq < self.seq and (not self.events or self.events[0][0] > seq + 1):
+            return None
+        return [event for event in self.events if event[0] > seq]
 
-    async def notify_listener(self, listener, device, sub=False):
-        try:
-            if not sub:
-                listener.write(f'DEVICE {device.usn}\n'.encode('utf-8'))
-            else:
-                listener.write(f'SUBDEVICE {device.usn}\n'.encode('utf-8'))
-            
-            if device.location:
-                (desc, icon) = await self.get_desc_and_icon(device.location)
+    async def replay(self, listener, since=None):
+        # waits for room in the listener's queue instead of dropping events
+        events = self.events_since(since) if since else None
+        if events is None:
+            events = [(self.seq, False, device) for device in self.registry]
 
-            if desc is None:
+        for seq, gone, device in events:
+            if listener.is_closing():
                 return
-
-            listener.write(f'META {device.usn}\n'.encode('utf-8'))
-            listener.writelines(
-                f'{k}:{v}\n'.encode('utf-8')
-                for k, v in desc.items()
-                if isinstance(v, str)
-            )
-
+            if not listener.matches(device):
+                continue
+            if gone:
+                await listener.put(Event(seq, device, gone=True))
+            else:
+                await listener.put(await self.device_event(device, seq))
+        await listener.put(Event(self.seq, data=listener.encode_sync(self.seq)))
+
+    async def serve_listener(self, listener, reader):
+        # answers icon requests of a binary listener until it disconnects
+        while True:
+            request = await listener.read_request(reader)
+            if request is None:
+                break
+            type, strings = request
+            if type != GET_ICON or not strings:
+                continue
+            device = self.registry.get(strings[0])
+            if device is None or not device.location:
+                continue
+            _, icon = await self.get_desc_and_icon(
+                device.location, device.max_age)
             if icon:
-                listener.write(f'ICON {device.usn}\n'.encode('utf-8'))
-                # b64 so we can terminate line with \n
-                listener.write(base64.b64encode(icon) + b'\n')
-
-            for subdevice in device.subdevices:
-                await self.notify_listener(listener, subdevice, sub=True)
+                listener.offer(Event(self.seq, device, data=listener.encode_icon(
+                    self.seq, strings[0], icon, requested=True)))
+        listener.close()
+
+    def remove_listener(self, listener):
+        logger.info("Listener disconnected")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Listener stats %s", listener.stats(self.seq))
+        try:
+            self.listeners.remove(listener)
+        except ValueError:
+            pass
 
-            await listener.drain()
+    def listener_stats(self):
+        return [listener.stats(self.seq) for listener in self.listeners]
 
-        except ConnectionResetError:
-            logger.info("Listener disconnected")
-            try:
-                self.listeners.remove(listener)
-            except ValueError:
-                pass
+    def add_remote_device(self, device):
+        return self.registry.add(device)
+
+    async def device_event(self, device, seq):
+        # fetches what listeners are told about a device and its subdevices
+        async def describe(device):
+            if not device.location:
+                return None, None
+            return await self.get_desc_and_icon(device.location, device.max_age)
+
+        desc, icon = await describe(device)
+        items = [(device, False, desc, icon)]
+        if desc is not None:
+            for subdevice in list(device.subdevices.values()):
+                items.append((subdevice, True) + tuple(await describe(subdevice)))
+        return Event(seq, device, items=items)
+
+    def publish(self, event):
+        # hands an event to every interested listener without waiting
+        for listener in self.listeners[:]:
+            if event.properties is not None and not listener.properties:
+                continue
+            if listener.matches(event.device):
+                listener.offer(event)
 
     def on_new_device(self, device):
         if not device.usn:
             return
 
         if not self.add_remote_device(device):
-            logger.info("Found duplicate device %s", device.usn)
+            logger.debug("Found duplicate device %s", device.usn)
             return
+        # listeners know a device by its root usn, which GONE carries too
+        device = self.registry.get(device.usn)
 
         logger.info("Found new device %s", device.usn)
-        logger.debug(pformat(device.__dict__))
+        logger.debug("%s at %s, max-age %s",
+                     device.usn, device.location, device.max_age)
+
+        # taken now, so that a GONE of the device always comes after it
+        seq = self.add_event(device)
 
         async def coro():
-            if device.location:
-                (desc, icon) = await self.get_desc_and_icon(device.location)
+            event = await self.device_event(device, seq)
+            if self.registry.get(device.usn) is not device:
+                # gone during the fetch, and GONE was already published
+                logger.debug("Device %s left before its metadata", device.usn)
+                return
+            desc, icon = event.items[0][2:]
 
             if desc is not None:
                 logger.info("Found metadata for %s", device.usn)
-                logger.debug(pformat(desc))
+                if logger.isEnabledFor(logging.DEBUG):
+                    from pprint import pformat
+                    logger.debug(pformat(dict(desc.items())))
             if icon is not None:
                 logger.info("Found icon for %s", device.usn)
 
-            for listener in self.listeners[:]:
-                await self.notify_listener(listener, device)
+            self.publish(event)
+            if desc is not None and self.event_services:
+                self.subscribe_services(device, desc)
 
         self.loop.create_task(coro())
 
-    async def get_desc_and_icon(self, location):
-        if location in self.desc_cache:
-            try:
-                await self.desc_cache[location].wait()
-            except AttributeError:
-                pass
-            return (self.desc_cache.get(location), self.icon_cache.get(location))
-        else:
-            done_event = asyncio.Event()
-            self.desc_cache[location] = done_event
-            await self.fetch_metadata(location)
-            done_event.set()
-            return (self.desc_cache.get(location), self.icon_cache.get(location))
+    def on_byebye(self, device):
+        if not device.usn:
+            return
+        removed = self.registry.remove(device.usn)
+        if removed is not None:
+            self.on_device_gone(removed)
+
+    def on_device_gone(self, device):
+        logger.info("Device gone %s", device.usn)
+        if device.location and '::' not in device.usn:
+            self.metadata_cache.discard(device.location)
+            self.subscriber.drop(device.usn)
+
+        seq = self.add_event(device, gone=True)
+        self.publish(Event(seq, device, gone=True))
+
+    async def get_desc_and_icon(self, location, max_age=None):
+        async def fetch():
+            # the last known description is served until it is revalidated
+            value = self.snapshot_metadata(location)
+            if value is not None:
+                return value
+            return await self.fetch_metadata(location)
+
+        result = await self.metadata_cache.get_or_fetch(
+            location, fetch, ttl=max_age)
+        return result[:2] if result else (None, None)
 
     async def fetch_metadata(self, location):
+        # An expired entry is revalidated with conditional requests, and its
+        # icon url lets both requests be pipelined.
+        start = time.perf_counter()
         try:
-            client = await MetadataClient(location).connect()
-            metadata = await client.fetch_metadata()
-        except ValueError:
-            metadata = None
+            client = MetadataClient(location, pool=self.pool)
+            stale = self.metadata_cache.peek(location)
+            icon_url = client.icon_url(stale[0]) if stale else None
+            metadata, icon, validators = await client.fetch_metadata_and_icon(
+                icon_url, cached=stale)
+        except (ValueError, OSError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, asyncio.TimeoutError):
+            metadata, icon, validators = None, None, None
+        METADATA_FETCH_SECONDS.observe_since(start)
+        METADATA_FETCHES.inc(('ok',) if metadata is not None else ('error',))
 
         if metadata is None:
-            self.desc_cache[location] = None  # fetch_metadata must set cache
             return None
 
-        self.desc_cache[location] = metadata
+        if self.icon_store is not None:
+            if isinstance(icon, IconRef):
+                self.icon_store.retain(icon)  # revalidated, kept by new entry
+            elif icon:
+                icon = self.icon_store.put(icon)
+
+        return (metadata, icon, validators)
+
+    async def service_of(self, usn, service):
+        # the location and Service record of a service of a known device,
+        # by its type or id
+        device = self.registry.get(usn)
+        if device is None or not device.location:
+            raise UPnPError(ACTION_FAILED, f'Unknown device {usn}')
+        desc, _ = await self.get_desc_and_icon(device.location, device.max_age)
+        record = find_service(desc, service)
+        if record is None:
+            raise UPnPError(INVALID_ACTION, f'No service {service} on {usn}')
+        return device.location, record
+
+    async def invoke(self, usn, service, action, args=None):
+        location, record = await self.service_of(usn, service)
+        return await self.control.invoke(location, record, action, args)
+
+    def invoke_many(self, calls):
+        # (usn, service, action, args) calls run concurrently, a few at a
+        # time per device, returns results or exceptions in order
+        return gather_calls(self.invoke, calls)
+
+    async def subscribe(self, usn, service, callback=None):
+        # Subscribes to the events of a service of a known device. Changed
+        # variables are sent to listeners and to callback(subscription,
+        # values), values are the text of each variable.
+        location, record = await self.service_of(usn, service)
+        url = urllib.parse.urljoin(location, record['eventSubURL'] or '')
+        return await self.subscriber.subscribe(
+            usn.split('::', 1)[0], url, record['serviceId'], callback)
+
+    def subscribe_services(self, device, desc):
+        async def subscribe(service):
+            try:
+                await self.subscribe(device.usn, service)
+            except (UPnPError, ValueError, OSError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError) as e:
+                logger.info("Cannot subscribe to %s of %s: %s",
+                            service, device.usn, e)
+
+        for service in self.event_services:
+            if find_service(desc, service) is not None:
+                self.loop.create_task(subscribe(service))
+
+    def on_properties(self, subscription, values):
+        device = self.registry.get(subscription.usn)
+        if device is None:
+            return
+        logger.debug("Event from %s: %s", subscription, values)
+        self.publish(Event(self.seq, device,
+                           properties=(subscription.service_id, values)))
+
+    def load_snapshot(self, path):
+        # Restores the devices of the last run, so listeners see them right
+        # away. Their descriptions are read from the snapshot when asked for
+        # until revalidate_snapshot has fetched them again.
+        snapshot = Snapshot(path)
+        if not snapshot.load():
+            return 0
+
+        self.epoch = snapshot.epoch or self.epoch
+        self.seq = snapshot.seq
+        self.checkpoint_seq = self.seq
+        for root in snapshot.devices:
+            self.registry.add(root)
+            for sub in root.subdevices.values():
+                self.registry.add(sub)
+        # listeners resuming from a cursor of the last run learn that these
+        # are gone
+        for root in snapshot.expired:
+            seq = self.add_event(root, gone=True)
+            self.publish(Event(seq, root, gone=True))
+        self.snapshot = snapshot
+        logger.info("Loaded %d devices from %s", len(snapshot.devices), path)
+        return len(snapshot.devices)
+
+    def snapshot_metadata(self, location):
+        if self.snapshot is None:
+            return None
+        return self.with_stored_icon(self.snapshot.metadata(location))
+
+    def with_stored_icon(self, value):
+        # a metadata entry read elsewhere, with its icon in the icon store
+        if value is not None and value[1] and self.icon_store is not None:
+            value = (value[0], self.icon_store.put(value[1]), value[2])
+        return value
+
+    async def revalidate_snapshot(self, concurrency=8):
+        # fetches every description of the snapshot again, conditionally,
+        # and drops the devices that did not answer
+        snapshot = self.snapshot
+        if snapshot is None:
+            return
+
+        roots = collections.defaultdict(list)  # location -> root devices
+        for device in self.registry:
+            roots[device.location].append(device)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def revalidate(location):
+            async with semaphore:
+                stale = self.metadata_cache.peek(location)
+                if stale is None:
+                    stale = self.snapshot_metadata(location)
+                    if stale is not None:
+                        self.metadata_cache.put(location, stale)
+                result = await self.fetch_metadata(location)
+
+            if result is None:
+                for device in roots[location]:
+                    removed = self.registry.remove(device.usn)
+                    if removed is not None:
+                        self.on_device_gone(removed)
+                return
 
-        try:
-            client = await MetadataClient(metadata['icon']['url']).connect()
-            icon = await client.fetch_icon()
-        except (KeyError, ValueError):
-            icon = None
+            max_age = max((d.max_age or 0 for d in roots[location]), default=0)
+            self.metadata_cache.put(location, result, ttl=max_age or None)
+            if stale is None or result[0] != stale[0]:
+                for device in roots[location]:
+                    if device.usn in self.registry:
+                        self.publish(await self.device_event(
+                            device, self.add_event(device)))
 
-        if icon is not None:
-            self.icon_cache[location] = icon
+        try:
+            await asyncio.gather(*(
+                revalidate(location) for location in snapshot.locations()))
+        finally:
+            if self.snapshot is snapshot:
+                self.snapshot = None
+                snapshot.close()
+
+    def checkpoint(self, path):
+        now = self.loop.time()
+        wall = time.time()
+        devices = []
+        metadata = {}
+        for root in self.registry:
+            deadline = self.registry.deadlines.get(root.usn)
+            if deadline is None:
+                continue
+            devices.append((root, wall + deadline - now))
+            for device in (root, *root.subdevices.values()):
+                if not device.location or device.location in metadata:
+                    continue
+                value = self.metadata_cache.peek(device.location)
+                if value is None and self.snapshot is not None:
+                    value = self.snapshot.metadata(device.location)
+                if value is not None:
+                    metadata[device.location] = (
+                        value[0], read_icon(value[1]), value[2])
+
+        write_snapshot(path, self.epoch, self.seq, devices, metadata.items())
+        self.checkpoint_seq = self.seq
+        logger.debug("Wrote %d devices to %s", len(devices), path)
+
+    async def run_snapshot(self, path, interval=60):
+        # revalidates a loaded snapshot, then writes one whenever devices
+        # came or went, and a last one when stopped
+        try:
+            await self.revalidate_snapshot()
+            while True:
+                await asyncio.sleep(interval)
+                if self.seq != self.checkpoint_seq:
+                    self.checkpoint(path)
+        finally:
+            self.checkpoint(path)
 
-        return metadata
+    def on_cache_evict(self, location, value):
+        if self.icon_store is not None and value and isinstance(value[1], IconRef):
+            self.icon_store.release(value[1])
 
     async def discover(self):
-        sock = socket.socket(
-            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, '0.0.0.0')
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        async for device in self.search():
+            self.on_new_device(device)
+
+    async def search(self, targets=None, rounds=None, interval=1.0,
+                     backoff=2.0, mx=2, quiet=None, timeout=None):
+        # Yields devices as their first response arrives. Searches for all
+        # targets are sent at once on every interface, repeated for several
+        # rounds with growing intervals, and the search ends early once no
+        # new usn has shown up for `quiet` seconds after the last round.
+        if targets is None:
+            targets = [self.filter or 'ssdp:all']
+        elif isinstance(targets, str):
+            targets = [targets]
+        rounds = self.rounds if rounds is None else rounds
+        quiet = self.quiet if quiet is None else quiet
+        timeout = self.wait if timeout is None else timeout
+
+        queue = asyncio.Queue()
+        seen = set()
+        last_activity = [self.loop.time()]
+
+        def on_device(device):
+            if device.usn in seen:
+                return
+            target = usn_target(device.usn)
+            if not any(target_matches(target, st) for st in targets):
+                return
+            seen.add(device.usn)
+            last_activity[0] = self.loop.time()
+            queue.put_nowait(device)
+
+        async def send_rounds(protocols):
+            delay = interval
+            for i in range(rounds):
+                if i > 0:
+                    await asyncio.sleep(delay)
+                    delay *= backoff
+                for st in targets:
+                    for protocol in protocols:
+                        protocol.send_search(search_target=st, max_delay=mx)
+                last_activity[0] = self.loop.time()
 
         def ssdp_factory(): return SimpleServiceDiscoveryProtocol(
-            device_callback=self.on_new_device, filter=self.filter)
-
-        transport, protocol = await self.loop.create_datagram_endpoint(
-            ssdp_factory, sock=sock)
-
-        protocol.search_devices()
+            device_callback=on_device, schedule_responses=False)
 
+        if self.interfaces is not None and len(self.interfaces):
+            interfaces = self.interfaces.interfaces()
+        else:
+            interfaces = list_interfaces(self.interface_names)
+        transports = []
+        protocols = []
+        for interface in interfaces or [None]:
+            try:
+                transport, protocol = await self.loop.create_datagram_endpoint(
+                    ssdp_factory, sock=search_socket(interface))
+            except OSError as e:
+                logger.warning("Cannot search on %s: %s", interface, e)
+                continue
+            transports.append(transport)
+            protocols.append(protocol)
+        sender = self.loop.create_task(send_rounds(protocols))
+
+        deadline = self.loop.time() + timeout
         try:
-            await asyncio.sleep(self.wait)
+            while True:
+                now = self.loop.time()
+                remaining = deadline - now
+                if sender.done():
+                    remaining = min(remaining, last_activity[0] + quiet - now)
+                else:
+                    remaining = min(remaining, quiet)
+                if remaining <= 0:
+                    # what arrived in time is still handed out
+                    while not queue.empty():
+                        yield queue.get_nowait()
+                    break
+                try:
+                    device = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    continue
+                yield device
         finally:
-            transport.close()
-
-    async def run_ssdp_deamon(self, discover=False, announce_devices=[]):
-        sock = socket.socket(
-            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, '0.0.0.0')
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
-        mreq = struct.pack("4sl", socket.inet_aton(
-            MULTICAST_ADDRESS), socket.INADDR_ANY)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-        sock.bind(('0.0.0.0', 1900))  # INADDR_ANY
+            sender.cancel()
+            for transport in transports:
+                transport.close()
 
+    async def start_ssdp_deamon(self, discover=False):
+        # returns the started InterfaceManager, with a socket and protocol
+        # on every interface
         device_callback = self.on_new_device if discover else None
-        def ssdp_factory(): return SimpleServiceDiscoveryProtocol(
-            device_callback=device_callback, filter=self.filter)
+        byebye_callback = self.on_byebye if discover else None
+        refresh_callback = self.registry.touch if discover else None
+        def ssdp_factory(interface): return SimpleServiceDiscoveryProtocol(
+            device_callback=device_callback, filter=self.filter,
+            byebye_callback=byebye_callback, refresh_callback=refresh_callback,
+            address=interface.address)
+
+        manager = InterfaceManager(self.loop, ssdp_factory, self.interface_names)
+        self.interfaces = manager
+        return await manager.start()
 
-        on_con_lost = self.loop.create_future()
-        transport, protocol = await self.loop.create_datagram_endpoint(
-            ssdp_factory, sock=sock)
+    async def run_ssdp_deamon(self, discover=False, announce_devices=[]):
+        manager = await self.start_ssdp_deamon(discover)
 
         for device in announce_devices:
-            protocol.announce_device(device)
+            manager.announce_device(device)
 
         try:
-            await on_con_lost
+            await manager.run()
         finally:
             for device in announce_devices:
-                protocol.remove_device(device)
-            transport.close()
+                manager.remove_device(device)
+            manager.close()
+            if self.interfaces is manager:
+                self.interfaces = None
 
     async def serve_metadata(self, device):
         server = await MetadataServer(device).start()
@@ -224,106 +648,112 @@ class UPnPy():
 
 class UPnPDevice():
 
+    __slots__ = ('host', 'port', 'uuid', 'type', 'name', 'icon', 'icon_path',
+                 'path_prefix', 'services')
+
     def __init__(self, host, port, uuid, type, name):
         self.host = host
         self.port = port
         self.uuid = uuid
-        self.type = type
+        self.type = sys.intern(type)
         self.name = name
         self.icon = None
+        self.icon_path = None  # served with sendfile, preferred over icon
+        self.path_prefix = ''  # set when sharing a server with other devices
+        self.services = []  # UPnPService, added before the device is served
 
     def to_ssdp(self):
-        location = f'http://{self.host}:{self.port}{ROOT_DESC_PATH}'
+        location = f'http://{self.host}:{self.port}{self.path_prefix}{ROOT_DESC_PATH}'
         usns = [
             f'uuid:{self.uuid}::upnp:rootdevice',
             f'uuid:{self.uuid}',
             f'uuid:{self.uuid}::{self.type}',
         ]
+        usns.extend(f'uuid:{self.uuid}::{service.service_type}'
+                    for service in self.services)
 
         return [SSDPDevice(usn, location) for usn in usns]
 
 
-async def main():
-    loop = asyncio.get_running_loop()
-    upnpy = UPnPy(loop)
+class DeviceHost():
+    # Hosts any number of devices behind the SSDP sockets of all interfaces
+    # and one metadata server, each served under /<uuid>/. Devices can be
+    # added and removed while running. On the unspecified address devices
+    # are announced with the address of each interface.
 
-    async def discover(args):
-        if args.filter and ':' not in args.filter:
-            if args.filter == 'root':
-                args.filter = 'upnp:rootdevice'
-            else:
-                args.filter = f"urn:schemas-upnp-org:device:{args.filter}:1"
-        
-        upnpy.filter = args.filter
-        upnpy.wait = args.wait
-
-        coros = []
-        if args.sock:
-            coros.append(upnpy.run_unix_socket(args.sock))
-        else:
-            coros.append(upnpy.discover())
-        if not args.no_deamon:
-            coros.append(upnpy.run_ssdp_deamon(discover=True))
-        await asyncio.gather(*coros)
-
-    async def announce(args):
-        # TODO might return 171.0.0.1
-        host = socket.gethostbyname(socket.gethostname())
-        device = UPnPDevice(
-            host, args.port,
-            uuid.uuid4(),
-            f"urn:schemas-upnp-org:device:{args.type}:1",
-            args.name,
-        )
-
-        if args.icon:
-            device.icon = args.icon.read()
-            args.icon.close()
-
-        upnpy.filter = not args.ignore_filter
-
-        await asyncio.gather(
-            upnpy.run_ssdp_deamon(announce_devices=device.to_ssdp()),
-            upnpy.serve_metadata(device),
-        )
-
-    parser = argparse.ArgumentParser(description='UPnPy')
-    parser.add_argument('-v', '--verbose', action='store_true')
-    subparsers = parser.add_subparsers()
-
-    parser_discover = subparsers.add_parser(
-        'discover', help='Control point mode.')
-    parser_discover.add_argument('--filter', default=None,
-                                 help='If not specified, "ssdp:all" will be used as search target.')
-    parser_discover.add_argument('--wait', type=int, default=6,
-                                 help='Seconds to wait for responses after search.')
-    parser_discover.add_argument('--sock', nargs='?', const=tempfile.gettempdir() + '/upnpy.sock',
-                                 help='If specified, creates a unix socket at the given path, to which listeners can connect.')
-    parser_discover.add_argument('--no-deamon', action='store_true',
-                                 help='Disables listening for NOTIFY messages. Thus only a foreground search will be performed.')
-    parser_discover.set_defaults(func=discover)
-
-    parser_announce = subparsers.add_parser('announce', help='Device mode.')
-    parser_announce.add_argument('--name', default='Basic Device',
-                                 help='Friendly name of the device.')
-    parser_announce.add_argument('--type', default='Basic',
-                                 help='Device type')
-    parser_announce.add_argument('--icon', type=argparse.FileType('rb'),
-                                 help='Path to a PNG image to use as icon.')
-    parser_announce.add_argument('--port', type=int, default=1999,
-                                 help='Port on which the metadata server listens.')
-    parser_announce.add_argument('--ignore-filter', action='store_true',
-                                 help='Reply to all searches (ignore search target).')
-    parser_announce.set_defaults(func=announce)
-
-    args = parser.parse_args()
-
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG)
-    else:
-        logging.basicConfig(level=logging.INFO)
-
-    await args.func(args)
-
-
-asyncio.run(main(), debug=True)
+    def __init__(self, upnpy, host=ANY_ADDRESS, port=1999, metrics=None):
+        self.upnpy = upnpy
+        self.host = host
+        self.port = port
+        self.devices = {}  # uuid -> (UPnPDevice, announced SSDPDevices)
+        self.metadata_server = MetadataServer(host=host, port=port,
+                                              metrics=metrics)
+        self.ssdp = None
+        self.watcher = None
+        self.server = None
+
+    def __len__(self):
+        return len(self.devices)
+
+    async def start(self):
+        self.server = await self.metadata_server.start()
+        self.ssdp = await self.upnpy.start_ssdp_deamon()
+        self.watcher = self.upnpy.loop.create_task(self.ssdp.run())
+        for device, _ in list(self.devices.values()):
+            self.announce(device)
+        return self
+
+    def add_device(self, device):
+        self.remove_device(device)
+        device.host = self.host
+        device.port = self.port
+        device.path_prefix = f'/{device.uuid}'
+        self.metadata_server.add_device(device, device.path_prefix)
+        self.devices[str(device.uuid)] = (device, [])
+        if self.ssdp is not None:
+            self.announce(device)
+
+    def announce(self, device):
+        announced = device.to_ssdp()
+        self.devices[str(device.uuid)] = (device, announced)
+        for ssdp_device in announced:
+            self.ssdp.announce_device(ssdp_device)
+
+    def remove_device(self, device):
+        entry = self.devices.pop(str(device.uuid), None)
+        if entry is None:
+            return False
+        if self.ssdp is not None:
+            for ssdp_device in entry[1]:
+                self.ssdp.remove_device(ssdp_device)
+        self.metadata_server.remove_device(device)
+        for service in device.services:
+            service.close()
+        return True
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        # devices say byebye and their services close their event pools
+        for device, _ in list(self.devices.values()):
+            self.remove_device(device)
+        if self.ssdp is not None:
+            self.watcher.cancel()
+            self.ssdp.close()
+            self.ssdp = None
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        self.metadata_server.close()
+
+
+if __name__ == '__main__':
+    # kept for "python upnpy.py ...", the command line lives in cli.py
+    from cli import run
+    run()
@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+import sys
+
+from ssdp import SimpleServiceDiscoveryProtocol, SSDPDevice, SSDPMessage
+from ssdp import USN, usn_shard
+from interfaces import InterfaceManager
+from snapshot import Encoder, Decoder, RECORD, encode_metadata, decode_metadata
+from metrics import METRICS
+
+logger = logging.getLogger('workers')
+
+# Workers send records in the snapshot's format to the coordinator, a
+# description always before the first usn located at it.
+ADD = 1  # usn, location, max-age of a usn new to the worker
+METADATA = 2  # location, description, validators and icon as in snapshots
+REFRESH = 3  # usn, max-age
+BYEBYE = 4  # usn
+# and the coordinator sends the datagrams of a worker's shard to it
+DATAGRAM = 5  # sender host, sender port, datagram
+
+REFRESH_FRACTION = 0.25  # of max-age between refreshes sent for a device
+MAX_BUFFERED = 4 * 1024 * 1024  # bytes of datagrams queued for a worker
+MAX_BATCH = 256  # datagrams read at once by the coordinator
+READ_SIZE = 64 * 1024
+
+DATAGRAMS_DROPPED = METRICS.counter(
+    'upnpy_worker_datagrams_dropped_total',
+    'Datagrams dropped by the coordinator because their worker fell behind.')
+
+
+class Dispatcher(asyncio.DatagramProtocol):
+    # Receives the SSDP multicast of one interface in the coordinator and
+    # passes every NOTIFY on to the worker of its usn's shard, picked by the
+    # uuid so all usns of a device go to the same worker. Only this socket
+    # receives from the group, so each datagram reaches one worker only.
+    # The transport reads one datagram per loop iteration, the rest that is
+    # waiting is read right away and written to each worker at once.
+
+    def __init__(self, writers):
+        self.writers = writers
+        self.batches = [[] for _ in writers]
+        self.transport = None
+        self.sock = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        self.sock = sock.dup() if sock is not None else None
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def datagram_received(self, data, addr):
+        self.dispatch(data, addr)
+        if self.sock is not None:
+            self.drain()
+        self.flush()
+
+    def drain(self):
+        for _ in range(MAX_BATCH):
+            try:
+                data, addr = self.sock.recvfrom(READ_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self.error_received(exc)
+                return
+            self.dispatch(data, addr)
+
+    def dispatch(self, data, addr):
+        # searches are not answered, there are no devices to announce
+        if not data.startswith(b'NOTIFY'):
+            return
+        usn = SSDPMessage(data).header(USN)
+        if not usn:
+            return
+        encoder = Encoder()
+        encoder.string(addr[0])
+        encoder.number(addr[1])
+        encoder.blob(data)
+        self.batches[usn_shard(usn, len(self.writers))].append(
+            encoder.record(DATAGRAM))
+
+    def flush(self):
+        for writer, batch in zip(self.writers, self.batches):
+            if not batch:
+                continue
+            if writer.is_closing():
+                pass
+            elif writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+                DATAGRAMS_DROPPED.inc(amount=len(batch))
+            else:
+                writer.write(b''.join(batch))
+            batch.clear()
+
+    def error_received(self, exc):
+        logger.warning("Error received: %s", exc)
+
+
+class SSDPWorker():
+    # Handles the SSDP traffic of one shard of the usns in its own process:
+    # parses the datagrams the coordinator dispatches to it, keeps a
+    # registry to drop repeated announcements and fetches and parses
+    # descriptions, then forwards new usns and an occasional refresh to the
+    # coordinator.
+
+    def __init__(self, upnpy, writer):
+        self.upnpy = upnpy
+        self.writer = writer
+        self.refreshed = {}  # root usn -> loop time of the last refresh sent
+        self.described = {}  # location -> metadata last sent
+        self.protocol = SimpleServiceDiscoveryProtocol(
+            device_callback=self.on_device, filter=upnpy.filter,
+            byebye_callback=self.on_byebye, refresh_callback=self.on_refresh,
+            schedule_responses=False)
+        upnpy.registry.on_gone = self.on_gone
+
+    async def run(self, reader):
+        # until the coordinator closes the connection
+        buffer = bytearray()
+        try:
+            while True:
+                try:
+                    data = await reader.read(READ_SIZE)
+                except ConnectionError:
+                    return
+                if not data:
+                    return
+                buffer += data
+                offset = self.receive(buffer)
+                del buffer[:offset]
+        finally:
+            self.upnpy.registry.close()
+
+    def receive(self, buffer):
+        # handles the whole records in buffer, returns where they end
+        offset = 0
+        while offset + RECORD.size <= len(buffer):
+            type, length = RECORD.unpack_from(buffer, offset)
+            end = offset + RECORD.size + length
+            if end > len(buffer):
+                break
+            if type == DATAGRAM:
+                decoder = Decoder(buffer, offset + RECORD.size, end)
+                try:
+                    addr = (decoder.string(), decoder.number())
+                    data = bytes(decoder.blob())
+                except (ValueError, UnicodeDecodeError) as e:
+                    logger.warning("Bad record from coordinator: %s", e)
+                else:
+                    self.protocol.datagram_received(data, addr)
+            offset = end
+        return offset
+
+    def send(self, type, *strings, number=None):
+        # a record is only written once it is fully encoded
+        if self.writer.is_closing():
+            return
+        encoder = Encoder()
+        try:
+            for string in strings:
+                encoder.string(string)
+            if type in (ADD, REFRESH):
+                encoder.number(number)
+        except ValueError as e:
+            logger.warning("Cannot forward %s: %s", strings[:1], e)
+            return
+        self.writer.write(encoder.record(type))
+
+    def on_device(self, device):
+        # known usns were refreshed by on_refresh already
+        self.upnpy.registry.add(device)
+        self.upnpy.loop.create_task(self.forward(device))
+
+    async def forward(self, device):
+        location = device.location
+        if location:
+            await self.upnpy.get_desc_and_icon(location, device.max_age)
+            value = self.upnpy.metadata_cache.peek(location)
+            if value is not None and self.described.get(location) is not value:
+                self.described[location] = value
+                if not self.writer.is_closing():
+                    self.writer.write(
+                        encode_metadata(Encoder(), location, value))
+        self.send(ADD, device.usn, location, number=device.max_age)
+
+    def on_refresh(self, usn, max_age):
+        registry = self.upnpy.registry
+        if not registry.touch(usn, max_age):
+            return False
+        root = registry.usns[usn]
+        now = self.upnpy.loop.time()
+        interval = (max_age or registry.default_max_age) * REFRESH_FRACTION
+        if now - self.refreshed.get(root, now - interval) >= interval:
+            self.refreshed[root] = now
+            self.send(REFRESH, usn, number=max_age)
+        return True
+
+    def on_byebye(self, device):
+        removed = self.upnpy.registry.remove(device.usn)
+        if removed is not None:
+            self.on_gone(removed)
+        self.send(BYEBYE, device.usn)
+
+    def on_gone(self, device):
+        # the coordinator expires devices on its own
+        self.refreshed.pop(device.usn, None)
+        if '::' not in device.usn:
+            self.described.pop(device.location, None)
+
+
+async def read_worker(upnpy, reader):
+    # applies what a worker forwards to the coordinator until it exits
+    while True:
+        try:
+            type, length = RECORD.unpack(await reader.readexactly(RECORD.size))
+            payload = await reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        decoder = Decoder(payload, 0, length)
+        try:
+            if type == ADD:
+                usn, location = decoder.string(), decoder.string()
+                upnpy.on_new_device(SSDPDevice(usn, location, decoder.number()))
+            elif type == METADATA:
+                location = decoder.string()
+                value = upnpy.with_stored_icon(decode_metadata(decoder))
+                upnpy.metadata_cache.put(location, value)
+            elif type == REFRESH:
+                upnpy.registry.touch(decoder.string(), decoder.number())
+            elif type == BYEBYE:
+                upnpy.on_byebye(SSDPDevice(decoder.string(), None))
+        except (ValueError, UnicodeDecodeError) as e:
+            logger.warning("Bad record from worker: %s", e)
+
+
+async def run_workers(upnpy, count, argv=()):
+    # Starts count worker processes running "cli.py worker" with the
+    # options in argv, dispatches the SSDP multicast to them and applies
+    # their events until cancelled.
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    verbose = ['-v'] if logging.getLogger().isEnabledFor(logging.DEBUG) else []
+    processes = []
+    readers = []
+    interfaces = None
+    watcher = None
+    try:
+        for _ in range(count):
+            parent, child = socket.socketpair()
+            with child:
+                processes.append(await asyncio.create_subprocess_exec(
+                    sys.executable, script, *verbose, 'worker', *argv,
+                    '--fd', str(child.fileno()), pass_fds=(child.fileno(),)))
+            reader, writer = await asyncio.open_unix_connection(sock=parent)
+            readers.append((reader, writer))
+        logger.info("Started %d SSDP workers", count)
+
+        writers = [writer for _, writer in readers]
+        interfaces = InterfaceManager(
+            upnpy.loop, lambda interface: Dispatcher(writers),
+            upnpy.interface_names)
+        await interfaces.start()
+        watcher = upnpy.loop.create_task(interfaces.run())
+        await asyncio.gather(*(read_worker(upnpy, reader)
+                               for reader, _ in readers))
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        if interfaces is not None:
+            interfaces.close()
+        for _, writer in readers:
+            writer.close()
+        for process in processes:
+            if process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+        for process in processes:
+            await process.wait()
+
+
+async def run_worker(upnpy, fd):
+    reader, writer = await asyncio.open_unix_connection(
+        sock=socket.socket(fileno=fd))
+    worker = SSDPWorker(upnpy, writer)
+    try:
+        await worker.run(reader)
+    finally:
+        writer.close()